@@ -0,0 +1,83 @@
+"""
+Memory and publish overhead of the entity model.
+
+    python benchmarks/bench_entities.py [entities]
+
+Builds devices of 100 entities each on a hub whose client discards every
+publish, then reports traced memory per entity and publish_state calls per
+second.
+"""
+import sys
+import time
+import tracemalloc
+
+import paho.mqtt.client
+
+import hassquitto as hq
+
+
+class NullInfo:
+    rc = 0
+    mid = 0
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+
+class NullClient:
+    """Stand-in for paho's client that drops everything."""
+
+    info = NullInfo()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        topic.encode()  # paho encodes the topic on every publish.
+        return self.info
+
+    def subscribe(self, *args, **kwargs):
+        return (0, 0)
+
+    def message_callback_add(self, *args, **kwargs):
+        pass
+
+
+class Meter(hq.Device):
+    pass
+
+
+for index in range(100):
+    setattr(Meter, f"sensor_{index}", hq.Sensor(name=f"Sensor {index}"))
+
+
+def main(count: int = 100_000):
+    paho.mqtt.client.Client = NullClient
+    hub = hq.Hub(name="Bench Hub")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    devices = [Meter(name=f"Meter {i}", hub=hub) for i in range(count // 100)]
+    for device in devices:
+        for entity in device.entities.values():
+            entity.prepare_discovery()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    entities = [e for device in devices for e in device.entities.values()]
+    print(f"entities: {len(entities)}")
+    print(f"memory: {used / 1e6:.1f} MB, {used / len(entities):.0f} B/entity")
+
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for value, entity in enumerate(entities):
+            entity.publish_state(value)
+        best = min(best, time.perf_counter() - started)
+    print(f"publish_state: {len(entities) / best:,.0f} msg/s (best of 5)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
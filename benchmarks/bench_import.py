@@ -0,0 +1,46 @@
+"""
+Import time of the hassquitto package.
+
+    python benchmarks/bench_import.py [budget_ms]
+
+Imports the package in fresh interpreters, reports the best time and exits
+non-zero if it is over budget or if a heavy dependency got imported eagerly.
+"""
+import subprocess
+import sys
+
+BUDGET_MS = 10.0
+RUNS = 7
+LAZY_MODULES = ("paho", "slugify", "orjson", "asyncio", "concurrent.futures")
+
+SCRIPT = f"""
+import sys, time
+started = time.perf_counter()
+import hassquitto
+elapsed = time.perf_counter() - started
+eager = [m for m in {LAZY_MODULES!r} if m in sys.modules]
+print(elapsed * 1000, ",".join(eager))
+"""
+
+
+def main(budget_ms: float = BUDGET_MS):
+    best = float("inf")
+    eager = ""
+    for _ in range(RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split(" ")
+        best = min(best, float(output[0]))
+        eager = output[1].strip()
+    print(f"import hassquitto: {best:.1f} ms (budget {budget_ms:.1f} ms)")
+    if eager:
+        print(f"imported eagerly: {eager}")
+    if best > budget_ms or eager:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*(float(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,85 @@
+"""
+JSON encoding of typical payloads, stdlib against orjson.
+
+    python benchmarks/bench_serializer.py [runs]
+
+Encodes a discovery config, the device block, a dict state and a shared
+state document of 100 entities with each encoder and reports microseconds
+per payload. Exits non-zero if orjson and the stdlib encoder disagree on
+any payload, the discovery cache relies on them being byte-identical.
+"""
+import sys
+import timeit
+
+import hassquitto as hq
+from hassquitto import serializer
+
+
+class Meter(hq.Device):
+    pass
+
+
+for index in range(100):
+    setattr(
+        Meter,
+        f"sensor_{index}",
+        hq.Sensor(name=f"Sensor {index}", unit_of_measurement="kWh"),
+    )
+
+
+def payloads() -> dict:
+    device = Meter(
+        name="Bench Meter",
+        client=hq.LoopbackTransport(broker=hq.LoopbackBroker()),
+        manufacturer="Hassquitto",
+        model="Bench",
+        sw_version="1.0",
+        shared_state=True,
+    )
+    device.connect()
+    sensor = device.entities["Sensor 0"]
+    return {
+        "discovery config": sensor._discovery_fields(),
+        "device block": device.device_info(),
+        "dict state": {
+            "temperature": 21.5,
+            "humidity": 48,
+            "battery": 97,
+            "linkquality": 120,
+            "state": "ON",
+            "last_seen": "2023-06-01T12:00:00+00:00",
+            "location": "Küche",
+        },
+        "shared state": {
+            entity.state_key: index * 0.25
+            for index, entity in enumerate(device.entities.values())
+        },
+    }
+
+
+def main(runs: int = 20_000):
+    fast = serializer._orjson_dumps()  # pylint: disable = protected-access
+    encoders = {"stdlib": serializer.dumps_stdlib}
+    if fast:
+        encoders["orjson"] = fast
+    else:
+        print("orjson is not installed, timing the stdlib only")
+    mismatches = 0
+    print(f"{'payload':<18}{'bytes':>7}" + "".join(f"{n:>10}" for n in encoders))
+    for name, value in payloads().items():
+        encoded = {n: encoder(value) for n, encoder in encoders.items()}
+        if len(set(encoded.values())) > 1:
+            mismatches += 1
+            print(f"{name}: encoders differ: {encoded}")
+        timings = [
+            timeit.timeit(lambda e=encoder, v=value: e(v), number=runs) / runs * 1e6
+            for encoder in encoders.values()
+        ]
+        row = f"{name:<18}{len(encoded['stdlib']):>7}"
+        print(row + "".join(f"{t:>8.2f}us" for t in timings))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
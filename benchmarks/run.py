@@ -0,0 +1,110 @@
+"""
+Benchmark suite for the hot paths, over the in-process loopback transport.
+
+    python benchmarks/run.py [--sizes 1,10,100,1000,10000] [--output FILE]
+
+For each entity count measures Device.send_discovery wall time (first run
+and unchanged rediscovery), Entity.publish_state messages per second and
+command topic to handler latency. Results are written as JSON.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import hassquitto as hq
+
+
+def make_device(size: int, run: int) -> hq.Device:
+    attrs = {f"sensor_{i}": hq.Sensor(name=f"Sensor {i}") for i in range(size)}
+    cls = type(f"Bench{size}", (hq.Device,), attrs)
+    return cls(name=f"Bench {size} {run}", client=hq.LoopbackTransport())
+
+
+def bench_discovery(device: hq.Device) -> dict:
+    started = time.perf_counter()
+    device.connect()
+    first = time.perf_counter() - started
+    started = time.perf_counter()
+    device.send_discovery()
+    unchanged = time.perf_counter() - started
+    return {"first_s": first, "unchanged_s": unchanged}
+
+
+def bench_publish(device: hq.Device, messages: int = 20_000) -> dict:
+    entities = list(device.entities.values())
+    rounds = max(1, messages // len(entities))
+    started = time.perf_counter()
+    for value in range(rounds):
+        for entity in entities:
+            entity.publish_state(value)
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": rounds * len(entities),
+        "msg_per_s": rounds * len(entities) / elapsed,
+    }
+
+
+def bench_commands(device: hq.Device, commands: int = 1_000) -> dict:
+    entities = list(device.entities.values())
+    latencies = []
+    done = threading.Semaphore(0)
+    sent_at = {}
+
+    def handler(payload):
+        latencies.append(time.perf_counter() - sent_at[payload])
+        done.release()
+
+    for entity in entities:
+        entity.on_command(handler)
+        entity.prepare_discovery()
+    for index in range(commands):
+        entity = entities[index % len(entities)]
+        payload = str(index)
+        sent_at[payload] = time.perf_counter()
+        device.client.publish(entity.topics.command, payload)
+        done.acquire()
+    latencies.sort()
+    return {
+        "commands": commands,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="1,10,100,1000,10000")
+    parser.add_argument("--output", help="JSON file, stdout if not set")
+    args = parser.parse_args()
+
+    results = []
+    for run, size in enumerate(int(s) for s in args.sizes.split(",")):
+        device = make_device(size, run)
+        result = {"entities": size}
+        result["discovery"] = bench_discovery(device)
+        result["publish_state"] = bench_publish(device)
+        result["command"] = bench_commands(device)
+        device.disconnect()
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
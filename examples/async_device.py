@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import random
+
+import hassquitto as hq
+
+# Enable logging
+logging.getLogger("hassquitto").setLevel(logging.DEBUG)
+
+
+# Define the device.
+class Device(hq.AsyncDevice):
+    temperature = hq.Sensor(name="Temperature", unit_of_measurement="°C")
+    refresh = hq.Button(name="Refresh")
+
+
+# Instantiate the device.
+device = Device(name="Example Async Device")
+
+
+# Poll every 10 seconds, as a task on the event loop.
+@device.on_interval(seconds=10)
+async def poll():
+    await asyncio.sleep(0.1)  # Pretend to read a sensor.
+    # Wait until the broker acknowledges the state.
+    await device.temperature.publish_state(round(random.uniform(18, 24), 1))
+
+
+# Handlers can be coroutine functions.
+@device.refresh.on_click
+async def refresh_on_click(_state):
+    await poll()
+
+
+async def main():
+    # Connect to MQTT.
+    await device.connect(
+        host="homeassistant.local",
+        port=1883,  # MQTT port.
+        username="example",  # MQTT username.
+        password="example",  # MQTT password.
+    )
+    device.set_available()
+    device.set_online()
+    try:
+        # Loop forever.
+        await device.run()
+    finally:
+        # Remove example device from Home Assistant.
+        await device.destroy_discovery()
+
+        # Disconnect from MQTT.
+        await device.disconnect()
+
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    # Wait for Ctrl+C.
+    pass
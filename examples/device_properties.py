@@ -33,8 +33,7 @@ try:
         username="example",  # MQTT username.
         password="example",  # MQTT password.
     )
-    # Set device availability.
-    device.set_available()
+    # Connecting marks the device available, set its state.
     device.set_online()
 
     # Loop forever.
@@ -1,7 +1,6 @@
 import logging
 import platform
 import time
-import threading
 from dataclasses import dataclass
 from typing import Iterable
 from os import environ
@@ -122,7 +121,7 @@ class TPLink4GRouterAPI:
         self._wait_until_id("pc-login-btn")
         self._click_element(By.ID, "pc-login-btn")
         logger.info("Logged in to admin page, waiting for asynchronous page load.")
-        time.sleep(5)
+        hq.scheduler.sleep(5)
         logger.info("Verifying login was sucessful...")
         try:
             self.driver.find_element(By.ID, "basic")
@@ -135,43 +134,43 @@ class TPLink4GRouterAPI:
             except NoSuchElementException as exc:
                 raise exc
         finally:
-            time.sleep(10)  # Home page takes longer to render after login
+            hq.scheduler.sleep(10)  # Home page takes longer to render after login
 
     def logout(self):
         """Log out from router web UI"""
         logger.info("Logging out.")
         self._click_element(By.ID, "topLogout")
-        time.sleep(5)
+        hq.scheduler.sleep(5)
         self._click_element(
             By.XPATH,
             '//button[contains(@class, "btn-msg-ok") and '
             'contains(@class, "btn-confirm")]',
         )
-        time.sleep(5)
+        hq.scheduler.sleep(5)
 
     def open_basic_home_page(self) -> None:
         """Open basic home page"""
         logger.info("Navigating to basic home page")
         self._click_element(By.ID, "basic")
-        time.sleep(10)
+        hq.scheduler.sleep(10)
 
     def open_sms_page(self) -> None:
         """Open SMS page"""
         logger.info("Navigating to SMS page.")
         self._click_element(By.ID, "map_icon_sms")
-        time.sleep(5)
+        hq.scheduler.sleep(5)
 
     def open_sms_detail_page(self, index=1) -> None:
         """Open SMS detail page"""
         logger.info("Navigating to SMS detail page.")
         self._click_element(By.ID, f"msg_{index}")
-        time.sleep(5)
+        hq.scheduler.sleep(5)
 
     def open_sms_detail_next_page(self) -> None:
         """Open SMS detail next page"""
         logger.info("Navigating to next SMS detail page.")
         self._click_element(By.ID, "divNextBtn")
-        time.sleep(5)
+        hq.scheduler.sleep(5)
 
     def get_sms(self) -> Message:
         """Get data from sms detail page"""
@@ -229,7 +228,7 @@ class TPLink4GRouterAPI:
         data_used_monthly = data_used_monthly.removesuffix("GB (Monthly Used)")
 
         if data_used_monthly == "--":
-            time.sleep(5)
+            hq.scheduler.sleep(5)
             return self.get_status()
 
         return Status(
@@ -271,6 +270,7 @@ class TPLink4GRouter(hq.Device):
         name="Text message",
     )
     reboot_router = hq.Button(name="Reboot Router")
+    refresh = hq.Button(name="Refresh")
     status = hq.Sensor(name="Script status", entity_category="diagnostic")
     router_url = hq.Sensor(name="Router URL", entity_category="diagnostic")
 
@@ -281,13 +281,23 @@ api = TPLink4GRouterAPI(
     headless=HEADLESS,
 )
 
-device = TPLink4GRouter(name="TPLink 4G Router")
+# Publish all sensor states as one message per poll, and republish the
+# stored ones on restart while the first slow poll runs.
+device = TPLink4GRouter(
+    name="TPLink 4G Router",
+    shared_state=True,
+    state_store_path="tplink_4g_router.db",
+    job_watchdog=True,
+)
 device.model = "Archer MR200 4G + WiFi Modem"
 device.manufacturer = "TP-Link"
 
 
+# Scraping the router is slow: poll every 2 minutes while values change,
+# backing off to every 30 minutes while they stay the same. A poll stuck in
+# the browser is abandoned after 5 minutes, its sleeps raise to unwind it.
 @device.on_connected
-@device.on_interval(minutes=5)
+@device.on_poll(min_seconds=2 * 60, max_seconds=30 * 60, timeout=5 * 60)
 def on_connected():
     try:
         device.status.publish_state("querying")
@@ -295,11 +305,15 @@ def on_connected():
         api.login()
         status = api.get_status()
 
-        device.data_used_monthly.publish_state(status.data_used_monthly)
-        device.signal_strength.publish_state(status.signal_strength)
-        device.internet_status.publish_state(status.internet_status)
-        device.ipv4_address.publish_state(status.ipv4_address)
-        device.ipv6_address.publish_state(status.ipv6_address)
+        device.publish_states(
+            {
+                device.data_used_monthly: status.data_used_monthly,
+                device.signal_strength: status.signal_strength,
+                device.internet_status: status.internet_status,
+                device.ipv4_address: status.ipv4_address,
+                device.ipv6_address: status.ipv6_address,
+            }
+        )
     except Exception as exc:
         logger.error(exc)
         device.status.publish_state("error")
@@ -309,7 +323,7 @@ def on_connected():
             device.text_message.publish_state(
                 f"{sms.text} [{sms.sender} @{sms.timestamp}]"
             )
-            time.sleep(1)
+            hq.scheduler.sleep(1)
 
         api.logout()
         device.status.publish_state("idle")
@@ -321,14 +335,18 @@ def on_connected():
         api.close_browser()
 
 
+@device.refresh.on_click
+def refresh_on_click(_state):
+    device.poll_now()
+
+
+# Command handlers run on a worker pool, blocking here is fine.
 @device.reboot_router.on_click
 def reboot_router_on_click(_state):
-    reboot_thread = threading.Thread(target=reboot_router)
-    reboot_thread.start()
-
     device.status.publish_state("rebooting router")
     device.set_not_available()
     device.set_offline()
+    reboot_router()
 
 
 def reboot_router():
@@ -1,56 +1,104 @@
-from .device import Device
-from .entity import (
-    AlarmControlPanel,
-    BinarySensor,
-    Button,
-    Camera,
-    Cover,
-    DeviceTracker,
-    DeviceTrigger,
-    Entity,
-    Fan,
-    Humidifier,
-    Climate,
-    Light,
-    Lock,
-    Number,
-    Scene,
-    Select,
-    Sensor,
-    Siren,
-    Switch,
-    Update,
-    TagScanner,
-    Text,
-    Vacuum,
-)
-from .logging import get_logger
-
-
-__all__ = [
-    "Device",
-    "AlarmControlPanel",
-    "BinarySensor",
-    "Button",
-    "Camera",
-    "Cover",
-    "DeviceTracker",
-    "DeviceTrigger",
-    "Entity",
-    "Fan",
-    "Humidifier",
-    "Climate",
-    "Light",
-    "Lock",
-    "Number",
-    "Scene",
-    "Select",
-    "Sensor",
-    "Siren",
-    "Switch",
-    "Update",
-    "TagScanner",
-    "Text",
-    "Vacuum",
-    "get_logger",
-]
+"""
+Home-Assistant MQTT Device
+
+Names are imported from their modules on first access, so that importing
+the package does not load paho, sqlite3 or slugify until needed.
+"""
+import importlib
+
+TYPE_CHECKING = False  # Avoids importing typing just for this.
+if TYPE_CHECKING:
+    from .aio import AsyncDevice
+    from .device import Device
+    from .entity import (
+        AlarmControlPanel,
+        BinarySensor,
+        Button,
+        Camera,
+        Cover,
+        DeviceTracker,
+        DeviceTrigger,
+        Entity,
+        Fan,
+        Humidifier,
+        Climate,
+        Light,
+        Lock,
+        Number,
+        Scene,
+        Select,
+        Sensor,
+        Siren,
+        Switch,
+        Update,
+        TagScanner,
+        Text,
+        Vacuum,
+    )
+    from .hub import Hub
+    from .logging import get_logger
+    from .metrics import Metrics
+    from .results import PublishResult, gather, wait_all
+    from .scheduler import Job, Scheduler
+    from .transport import LoopbackBroker, LoopbackTransport, Transport
+
+
+_MODULES = {
+    "AsyncDevice": ".aio",
+    "Device": ".device",
+    "AlarmControlPanel": ".entity",
+    "BinarySensor": ".entity",
+    "Button": ".entity",
+    "Camera": ".entity",
+    "Cover": ".entity",
+    "DeviceTracker": ".entity",
+    "DeviceTrigger": ".entity",
+    "Entity": ".entity",
+    "Fan": ".entity",
+    "Hub": ".hub",
+    "Humidifier": ".entity",
+    "Climate": ".entity",
+    "Light": ".entity",
+    "Lock": ".entity",
+    "Number": ".entity",
+    "Scene": ".entity",
+    "Select": ".entity",
+    "Sensor": ".entity",
+    "Siren": ".entity",
+    "Switch": ".entity",
+    "Update": ".entity",
+    "TagScanner": ".entity",
+    "Text": ".entity",
+    "Vacuum": ".entity",
+    "get_logger": ".logging",
+    "Metrics": ".metrics",
+    "PublishResult": ".results",
+    "gather": ".results",
+    "wait_all": ".results",
+    "Job": ".scheduler",
+    "Scheduler": ".scheduler",
+    "LoopbackBroker": ".transport",
+    "LoopbackTransport": ".transport",
+    "Transport": ".transport",
+}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name: str):
+    module = _MODULES.get(name)
+    if module is None:
+        # Submodules, e.g. hassquitto.logging.
+        try:
+            return importlib.import_module(f".{name}", __name__)
+        except ModuleNotFoundError:
+            raise AttributeError(
+                f"module {__name__!r} has no attribute {name!r}"
+            ) from None
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted([*globals(), *__all__])
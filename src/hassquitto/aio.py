@@ -0,0 +1,639 @@
+"""
+Asyncio Device
+"""
+import asyncio
+import inspect
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import paho.mqtt.client as mqtt
+
+from .commands import CommandDispatcher
+from .device import Device
+from .discovery import DiscoveryReport, read_retained_async
+from .logging import get_logger
+from .offline import backoff_delay
+from .pacing import PacedWindow
+from .results import PublishResult, gather
+from .scheduler import Job, JobCancelled, running_job
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True)
+class AsyncPublishWindow(PacedWindow):
+    """
+    Bounded window of in-flight publishes, awaiting broker acknowledgements.
+
+    Args:
+        device: AsyncDevice to publish with.
+        size (optional): Maximum number of unacknowledged publishes.
+        rate (optional): Maximum publishes per second, unlimited if not set.
+        timeout (optional): Seconds to wait for a single acknowledgement.
+    """
+
+    device: Any
+
+    async def publish(self, topic: str, payload, qos: int = 1, retain: bool = False):
+        """Publish once there is room in the window, return the PublishResult."""
+        while self._full():
+            await self._wait(self._in_flight.popleft())
+        delay = self._pace()
+        if delay:
+            await asyncio.sleep(delay)
+        result = self.device._publish_now(topic, payload, qos, retain)
+        self._in_flight.append(result)
+        return result
+
+    async def flush(self):
+        """Wait until every publish in the window is acknowledged."""
+        while self._in_flight:
+            await self._wait(self._in_flight.popleft())
+
+    async def _wait(self, result: PublishResult):
+        if not await gather([result], self.timeout):
+            logger.warning(
+                "Publish %s not acknowledged in %ss.", result.mid, self.timeout
+            )
+
+
+@dataclass(kw_only=True)
+class AsyncCommandDispatcher(CommandDispatcher):
+    """
+    Run command handlers as tasks on the event loop.
+
+    Commands for the same key (entity) run one at a time in arrival order.
+    Coroutine handlers run on the loop, plain ones on worker threads so they
+    can not stall it, at most workers at a time. The loop must not block,
+    commands arriving while queue_size commands wait are dropped.
+
+    Args:
+        spawn: Starts a task on the loop.
+        workers (optional): Number of plain handlers running at a time.
+        queue_size (optional): Maximum number of queued commands.
+        metrics (optional): Metrics recording command latency.
+    """
+
+    spawn: Callable
+    overflow: str = "drop"
+    _slots: Optional[asyncio.Semaphore] = None
+
+    def __post_init__(self):
+        assert self.overflow == "drop", "The event loop can not block."
+
+    def submit(self, key: Any, func: Callable, payload: str) -> bool:
+        if self.depth >= self.queue_size:
+            self.dropped += 1
+            logger.warning("Command queue full, dropped: %s", payload)
+            return False
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self.spawn(self._run_queue(key, queue))
+        queue.append((func, payload, time.monotonic()))
+        return True
+
+    async def _run_queue(self, key: Any, queue: deque):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        try:
+            while queue:
+                func, payload, queued_at = queue.popleft()
+                self.depth -= 1
+                started_at = time.monotonic()
+                try:
+                    await self._run(func, payload)
+                except Exception:  # pylint: disable = broad-except
+                    self.failed += 1
+                    logger.exception("Command handler failed for: %s", payload)
+                finished_at = time.monotonic()
+                run_time = finished_at - started_at
+                if self.metrics:
+                    self.metrics.command_latency.observe(finished_at - queued_at)
+                self.processed += 1
+                self.wait_time_total += started_at - queued_at
+                self.run_time_total += run_time
+                self.run_time_max = max(self.run_time_max, run_time)
+        finally:
+            self.depth -= len(queue)
+            del self._queues[key]
+
+    async def _run(self, func: Callable, payload: str):
+        if inspect.iscoroutinefunction(func):
+            await func(payload)
+            return
+        assert self._slots
+        async with self._slots:
+            result = await asyncio.to_thread(func, payload)
+        if inspect.isawaitable(result):
+            await result
+
+
+@dataclass(kw_only=True, eq=False)
+class AsyncScheduler:
+    """
+    Runs jobs as tasks on an event loop, like Scheduler runs them on threads.
+
+    Jobs keep the fixed rate, overrun policies and bookkeeping of Scheduler.
+    Coroutine functions and inline jobs run on the loop, coroutines are
+    cancelled on timeout. Plain functions run on worker threads and are
+    abandoned like in Scheduler: no new run starts before they return.
+
+    Args:
+        spawn: Starts a task on the loop.
+        loop (optional): Event loop, set once it runs.
+    """
+
+    spawn: Callable
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    _tasks: dict = field(default_factory=dict)
+    _wakes: dict = field(default_factory=dict)
+
+    def add(self, job: Job) -> Job:
+        """Schedule a job, from any thread, return it as its handle"""
+        job._scheduler = self
+        self._call(self._start, job)
+        return job
+
+    def remove(self, job: Job):
+        """Unschedule a job, from any thread, it can be added again"""
+        self._call(self._stop, job)
+
+    def reschedule(self, job: Job, delay: float):
+        """Move the next run of a scheduled job, from any thread"""
+        self._call(self._move, job, delay)
+
+    def _call(self, func: Callable, *args):
+        assert self.loop
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _start(self, job: Job):
+        if job in self._tasks:
+            return
+        delay = job.delay if job.delay is not None else job.interval
+        assert delay is not None
+        job._added_at = time.monotonic()
+        job.next_run_at = job._added_at + delay
+        self._wakes[job] = asyncio.Event()
+        self._tasks[job] = self.spawn(self._run(job))
+
+    def _stop(self, job: Job):
+        task = self._tasks.pop(job, None)
+        if task is not None:
+            task.cancel()
+        self._wakes.pop(job, None)
+        job.next_run_at = None
+        job._queued = False
+
+    def _move(self, job: Job, delay: float):
+        wake = self._wakes.get(job)
+        if wake is None or job.next_run_at is None:
+            return
+        job.next_run_at = time.monotonic() + delay
+        wake.set()
+
+    async def _run(self, job: Job):
+        wake = self._wakes[job]
+        running: Optional[asyncio.Task] = None
+        try:
+            while not job.cancelled and job.next_run_at is not None:
+                try:
+                    await asyncio.wait_for(
+                        wake.wait(), max(job.next_run_at - time.monotonic(), 0.0)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                now = time.monotonic()
+                if job.cancelled or job.next_run_at is None or job.next_run_at > now:
+                    continue  # Moved by reschedule() or an adaptive interval.
+                run_at = job.next_run_at
+                job.next_run_at = job.next_run_after(run_at, now)
+                if running is not None and not running.done():
+                    if job.overrun == "skip":
+                        job.skipped += 1
+                        logger.warning("Job %s still running, skipped a run.", job.name)
+                        continue
+                    if job.overrun == "cancel":
+                        logger.warning(
+                            "Job %s overran, cancelling the previous run.", job.name
+                        )
+                        running.cancel()
+                    await asyncio.wait({running})
+                    if job.cancelled:
+                        break
+                    run_at = time.monotonic()
+                    if job._abandoned:
+                        # Starts once the abandoned run returned.
+                        job._queued = True
+                        continue
+                elif job._abandoned:
+                    job.skipped += 1
+                    logger.warning(
+                        "Job %s is stuck in an abandoned run, skipped a run.", job.name
+                    )
+                    continue
+                job._cancel = threading.Event()
+                running = self.spawn(self._execute(job, run_at, job._cancel))
+        finally:
+            if self._tasks.get(job) is asyncio.current_task():
+                del self._tasks[job]
+                del self._wakes[job]
+                job.next_run_at = None
+
+    async def _execute(self, job: Job, run_at: float, cancel: threading.Event):
+        started_at = time.monotonic()
+        before = job.snapshot() if job.snapshot and job.adaptive else None
+        problem = None
+        try:
+            if inspect.iscoroutinefunction(job.func):
+                await asyncio.wait_for(job.func(), job.timeout)
+            elif job.inline:
+                job.func()
+            else:
+                await self._run_in_thread(job, cancel)
+        except asyncio.TimeoutError:
+            cancel.set()
+            job.timed_out += 1
+            problem = "timed out"
+            logger.warning("Job %s timed out after %ss.", job.name, job.timeout)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+        except JobCancelled:
+            logger.info("Job %s stopped.", job.name)
+        except Exception:  # pylint: disable = broad-except
+            job.failed += 1
+            problem = "failed"
+            logger.exception("Job %s failed.", job.name)
+        finally:
+            finished_at = time.monotonic()
+            job.record_run(run_at, started_at, finished_at)
+        if cancel.is_set():
+            job._problem = problem or job._problem
+            return  # Timed out or cancelled, not a completion.
+        job._problem = problem
+        job.last_finished_at = finished_at
+        if job.snapshot and job.adaptive and job.adapt(job.snapshot() != before):
+            assert job.interval
+            self._move(job, max(run_at + job.interval - finished_at, 0.0))
+
+    async def _run_in_thread(self, job: Job, cancel: threading.Event):
+        assert self.loop
+        future = self.loop.run_in_executor(None, self._call_in_thread, job, cancel)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), job.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # The thread keeps going, the job is stuck until it returns.
+            job._abandoned += 1
+            future.add_done_callback(lambda _future: self._returned(job, _future))
+            raise
+
+    def _returned(self, job: Job, future: asyncio.Future):
+        """An abandoned run returned, start the run queued behind it"""
+        if not future.cancelled():
+            future.exception()  # Nothing awaits an abandoned run.
+        job._abandoned -= 1
+        if job._queued and not job._abandoned:
+            job._queued = False
+            self._move(job, 0.0)
+
+    @staticmethod
+    def _call_in_thread(job: Job, cancel: threading.Event):
+        with running_job(job, cancel):
+            job.func()
+
+
+@dataclass(kw_only=True, eq=False)
+class AsyncDevice(Device):
+    """
+    HomeAssistant MQTT Device running on an asyncio event loop
+
+    The paho client is driven by the loop's socket callbacks instead of a
+    network thread, and jobs run as tasks of an AsyncScheduler instead of on
+    a scheduler thread, with the same timeout and overrun options and
+    bookkeeping. Command handlers and jobs may be coroutine functions run on
+    the loop, plain ones run on worker threads; the commands of an entity
+    run in arrival order.
+    publish_state returns a PublishResult to await, resolved on broker
+    acknowledgement, also when called from another thread.
+
+    A dropped connection is reconnected by a task, with backoff and jitter
+    between reconnect_min_delay and reconnect_max_delay; states published
+    meanwhile are kept in the offline buffer.
+    """
+
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _loop_thread: Optional[int] = None
+    _loop_connected: Optional[asyncio.Event] = None
+    _acks: dict = field(default_factory=dict)
+    _reconnect: Optional[asyncio.Task] = None
+    _misc: Optional[asyncio.Task] = None
+    _tasks: set = field(default_factory=set)
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.scheduler = AsyncScheduler(spawn=self._spawn)  # type: ignore[assignment]
+        self.commands = AsyncCommandDispatcher(
+            spawn=self._spawn,
+            workers=self.command_workers,
+            queue_size=self.command_queue_size,
+            metrics=self.metrics,
+        )
+
+    async def connect(
+        self,
+        *,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        host: str = "homeassistant.local",
+        port: int = 1883,
+    ):
+        assert self.client
+        assert self.topics
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.scheduler.loop = self._loop
+        self._loop_connected = asyncio.Event()
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.will_set(self.topics.availability, "offline", qos=1, retain=True)
+        logger.debug("Connecting...")
+        if username is not None:
+            self.client.username_pw_set(username=username, password=password)
+        self._stopping.clear()
+        self._connects = 0
+        self._announced = False
+        self.client.connect(host=host, port=port)
+        self._start_loop_misc()
+        try:
+            await asyncio.wait_for(self._loop_connected.wait(), self.connect_timeout)
+        except asyncio.TimeoutError as exc:
+            self._stopping.set()
+            self.client.disconnect()
+            raise ConnectionError(f"No CONNACK from {host}:{port}.") from exc
+        logger.debug("Connected.")
+        await self.send_discovery()
+        self._schedule_jobs()
+        if self._on_connected_callback:
+            await self._call(self._on_connected_callback)
+
+    async def disconnect(self):
+        assert self.client
+        assert self.topics
+        logger.debug("Disconnecting...")
+        self._stopping.set()
+        for job in self._scheduled_jobs:
+            self.scheduler.remove(job)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._connected.is_set():
+            window = self.publish_window()
+            await window.publish(self.topics.availability, "offline", retain=True)
+            await window.flush()
+        if self.state_store:
+            await asyncio.to_thread(self.state_store.close)
+        self.client.disconnect()
+        self._go_offline()
+        logger.debug("Disconnected.")
+
+    async def run(self):
+        assert self._loop
+        await self._loop.create_future()
+
+    def _on_connect(self, _client, _userdata, _flags, rc):
+        super()._on_connect(_client, _userdata, _flags, rc)
+        if rc == 0 and self._loop_connected:
+            self._loop_connected.set()
+
+    def _on_disconnect(self, _client, _userdata, rc):
+        if self._loop_connected:
+            self._loop_connected.clear()
+        super()._on_disconnect(_client, _userdata, rc)
+
+    def _schedule_reconnect(self):
+        # Runs on the loop, from the socket callbacks or loop_misc.
+        if self._reconnect is None:
+            self._reconnect = self._spawn(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        """Reconnect with backoff and jitter until connected or disconnecting"""
+        assert self.client
+        assert self._loop_connected
+        try:
+            while not self._stopping.is_set():
+                delay = backoff_delay(
+                    self._reconnect_attempts,
+                    self.reconnect_min_delay,
+                    self.reconnect_max_delay,
+                )
+                self._reconnect_attempts += 1
+                logger.warning("Reconnecting in %.1fs...", delay)
+                await asyncio.sleep(delay)
+                try:
+                    self.client.reconnect()
+                except OSError as exc:
+                    logger.warning("Reconnect failed: %s", exc)
+                    continue
+                self._start_loop_misc()
+                try:
+                    await asyncio.wait_for(
+                        self._loop_connected.wait(), self.connect_timeout
+                    )
+                    return
+                except asyncio.TimeoutError:
+                    logger.warning("No CONNACK after reconnecting.")
+        finally:
+            self._reconnect = None
+
+    def _request_rediscovery(self):
+        # Runs on the loop, a birth arriving meanwhile runs discovery once more.
+        self._rediscovery_pending = True
+        if self._rediscovery is None:
+            self._rediscovery = self._spawn(self._rediscover())
+
+    async def _rediscover(self):  # type: ignore[override]
+        try:
+            while self._rediscovery_pending:
+                self._rediscovery_pending = False
+                await self.send_discovery()
+        finally:
+            self._rediscovery = None
+
+    def _on_socket_open(self, client, _userdata, sock):
+        assert self._loop
+        self._loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, _client, _userdata, sock):
+        assert self._loop
+        self._loop.remove_reader(sock)
+
+    def _on_socket_register_write(self, client, _userdata, sock):
+        assert self._loop
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, _client, _userdata, sock):
+        assert self._loop
+        self._loop.remove_writer(sock)
+
+    def _start_loop_misc(self):
+        if self._misc is None or self._misc.done():
+            self._misc = self._spawn(self._loop_misc())
+
+    async def _loop_misc(self):
+        assert self.client
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_publish(self, _client, _userdata, mid):
+        if self.metrics:
+            self.metrics.acked(mid)
+        ack = self._acks.pop(mid, None)
+        if ack is not None and not ack.done():
+            ack.set_result(None)
+
+    def _publish(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        # Before connect() there is no loop yet, states go to the offline buffer.
+        if self._loop is not None and threading.get_ident() != self._loop_thread:
+            result = PublishResult(pending=True)
+            self._loop.call_soon_threadsafe(
+                self._publish_soon, result, topic, payload, qos, retain
+            )
+            return result
+        return super()._publish(topic, payload, qos=qos, retain=retain)
+
+    def _publish_soon(self, result: PublishResult, topic, payload, qos, retain):
+        """Publish from another thread, on the loop"""
+        sent = None
+        try:
+            sent = self._publish(topic, payload, qos=qos, retain=retain)
+        except Exception:  # pylint: disable = broad-except
+            logger.exception("Failed to publish to %s.", topic)
+        result._resolve(sent)
+
+    def _result(self, info) -> PublishResult:
+        result = PublishResult(info)
+        if self._loop is None:
+            return result
+        if info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_AGAIN):
+            # Awaiting a result that could not be queued raises like paho.
+            result._ack = self._loop.create_future()
+            if info.is_published():
+                result._ack.set_result(None)
+            else:
+                self._acks[info.mid] = result._ack
+        return result
+
+    def _dispatch_command(self, entity: Any, func: Callable, payload: str):
+        assert self.commands
+        # Entity command wrappers are plain functions, coroutines they return
+        # from a worker thread are awaited on the loop.
+        self.commands.submit(entity, func, payload)
+
+    def _spawn(self, coro):
+        assert self._loop
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Task failed.", exc_info=task.exception())
+
+    async def _call(self, func: Callable):
+        """Await coroutine functions, run plain functions off the loop"""
+        if inspect.iscoroutinefunction(func):
+            return await func()
+        return await asyncio.to_thread(func)
+
+    def publish_window(self) -> AsyncPublishWindow:  # type: ignore[override]
+        """New publish window using the device discovery settings"""
+        return AsyncPublishWindow(
+            device=self,
+            size=self.discovery_window,
+            rate=self.discovery_rate,
+            timeout=self.discovery_timeout,
+        )
+
+    async def send_discovery(self, force: bool = False) -> DiscoveryReport:
+        """Publish discovery configs the broker does not already hold"""
+        logger.debug("Sending discovery for device %s...", self.name)
+        manifest = {} if force else await self.read_discovery_manifest()
+        report, messages = self._plan_discovery(manifest, force)
+        window = self.publish_window()
+        for topic, payload, retain in messages:
+            await window.publish(topic, payload, qos=self.discovery_qos, retain=retain)
+        # Configs are acknowledged before any entity goes online.
+        await window.flush()
+        self._go_online()
+        self._discovery_sent(report)
+        return report
+
+    async def read_discovery_manifest(self) -> dict:  # type: ignore[override]
+        """Hashes of the configs the broker holds, empty if unknown"""
+        manifests = await self.read_discovery_manifests([self])
+        return manifests.get(self.manifest_topic(), {})
+
+    async def read_discovery_manifests(  # type: ignore[override]
+        self, devices: list
+    ) -> dict:
+        """Manifests of devices sharing this client, keyed by manifest topic"""
+        assert self.client
+        topics = self._retained_topics(devices)
+        if not topics:
+            return {}
+        try:
+            retained = await read_retained_async(
+                self.client, topics, self.sync_topic(), self.discovery_timeout
+            )
+        except TimeoutError as exc:
+            logger.warning("%s Sending full discovery.", exc)
+            return {}
+        return self._parse_manifests(devices, retained)
+
+    async def _publish_config(  # type: ignore[override]
+        self,
+        topic: str,
+        payload,
+        window: Optional[AsyncPublishWindow] = None,
+        then: Optional[Callable] = None,
+    ):
+        standalone = window is None
+        if window is None:
+            window = self.publish_window()
+        await window.publish(
+            topic, payload, qos=self.discovery_qos, retain=self.discovery_retain
+        )
+        if standalone:
+            await window.flush()
+            if then:
+                then()
+
+    async def destroy_discovery(self):
+        window = self.publish_window()
+        for topic, payload, retain in self._plan_destroy():
+            await window.publish(topic, payload, qos=self.discovery_qos, retain=retain)
+        await window.flush()
+        logger.warning("Device %s discovery destroyed.", self.name)
@@ -0,0 +1,141 @@
+"""
+Command dispatch
+"""
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from .logging import get_logger
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True)
+class CommandDispatcher:
+    """
+    Run command handlers on a bounded worker pool.
+
+    Commands for the same key (entity) run one at a time in arrival order,
+    commands for different keys run concurrently.
+
+    Args:
+        workers (optional): Number of worker threads.
+        queue_size (optional): Maximum number of queued commands.
+        overflow (optional): "block" the caller or "drop" the command when full.
+        metrics (optional): Metrics recording command latency.
+    """
+
+    workers: int = 4
+    queue_size: int = 100
+    overflow: str = "block"
+    metrics: Optional[Any] = None
+
+    depth: int = 0
+    max_depth: int = 0
+    processed: int = 0
+    dropped: int = 0
+    failed: int = 0
+    wait_time_total: float = 0.0
+    run_time_total: float = 0.0
+    run_time_max: float = 0.0
+
+    _queues: dict = field(default_factory=dict)
+    _condition: threading.Condition = field(default_factory=threading.Condition)
+    _executor: Optional["ThreadPoolExecutor"] = None
+
+    def __post_init__(self):
+        assert self.overflow in ("block", "drop")
+
+    def submit(self, key: Any, func: Callable, payload: str) -> bool:
+        """
+        Queue a command, return False if it was dropped.
+
+        Args:
+            key: Ordering key, commands with the same key run in order.
+            func: Command handler.
+            payload: Command payload.
+        """
+        with self._condition:
+            while self.depth >= self.queue_size:
+                if self.overflow == "drop":
+                    self.dropped += 1
+                    logger.warning("Command queue full, dropped: %s", payload)
+                    return False
+                self._condition.wait()
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            queue = self._queues.get(key)
+            idle = queue is None
+            if idle:
+                queue = self._queues[key] = deque()
+            queue.append((func, payload, time.monotonic()))
+            if idle:
+                self._pool().submit(self._run_next, key)
+        return True
+
+    def _pool(self) -> "ThreadPoolExecutor":
+        if self._executor is None:
+            # pylint: disable = import-outside-toplevel
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="hassquitto-command"
+            )
+        return self._executor
+
+    def _run_next(self, key: Any):
+        with self._condition:
+            func, payload, queued_at = self._queues[key].popleft()
+            self.depth -= 1
+            self._condition.notify_all()
+        started_at = time.monotonic()
+        try:
+            func(payload)
+        except Exception:  # pylint: disable = broad-except
+            self.failed += 1
+            logger.exception("Command handler failed for: %s", payload)
+        finished_at = time.monotonic()
+        run_time = finished_at - started_at
+        if self.metrics:
+            self.metrics.command_latency.observe(finished_at - queued_at)
+        with self._condition:
+            self.processed += 1
+            self.wait_time_total += started_at - queued_at
+            self.run_time_total += run_time
+            self.run_time_max = max(self.run_time_max, run_time)
+            # Resubmit instead of looping so one busy key can't hog a worker.
+            if self._queues[key]:
+                self._pool().submit(self._run_next, key)
+            else:
+                del self._queues[key]
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """Queue depth and handler latency"""
+        with self._condition:
+            processed = self.processed or 1
+            return {
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "wait_time_avg": self.wait_time_total / processed,
+                "run_time_avg": self.run_time_total / processed,
+                "run_time_max": self.run_time_max,
+            }
+
+    def shutdown(self, wait: bool = False):
+        """Stop the worker pool, queued commands still run if wait is set"""
+        if wait:
+            with self._condition:
+                while self._queues:
+                    self._condition.wait()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
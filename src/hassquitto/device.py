@@ -1,24 +1,60 @@
+from __future__ import annotations
+
 import json
+import threading
 import time
 from dataclasses import dataclass, field
-from typing import Callable, Optional
-
-import paho.mqtt.client as mqtt
-from apscheduler.schedulers.background import BackgroundScheduler
-from slugify import slugify
+from typing import Any, Callable, ClassVar, Iterable, Optional
 
-from .entity import Entity
+from . import serializer
+from .commands import CommandDispatcher
+from .discovery import (
+    MIGRATE_PAYLOAD,
+    ORIGIN,
+    DiscoveryReport,
+    compact_config,
+    compact_device,
+    config_digest,
+    encode_config,
+    read_retained,
+)
+from .entity import BinarySensor, Entity, Sensor, entity_templates
 from .logging import get_logger
+from .metrics import SUMMARY_UNITS, Metrics
+from .offline import OfflineBuffer, backoff_delay
+from .pacing import PublishWindow
+from .results import NOT_SENT, PublishResult
+from .scheduler import AdaptiveInterval, Job, Scheduler, default_scheduler
+from .states import States
+from .store import StateStore
+from .throttle import default_coalescer
 from .topics import Topics
+from .transport import Transport
 
 
 logger = get_logger(__name__)
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False)
 class Device:
     """
     HomeAssistant MQTT Device
+
+    Connects with a paho client unless another transport is passed as
+    client, e.g. a LoopbackTransport for in-process use.
+
+    With compact_discovery, discovery configs use HomeAssistant's key
+    abbreviations and topics relative to the "~" base topic, about a
+    quarter smaller.
+
+    With device_discovery, the device and all its entities are discovered
+    with one device based config, as components, instead of one config per
+    entity. Configs are migrated when switching between the two.
+
+    Command handlers run on command_workers threads, the commands of one
+    entity in arrival order. Once command_queue_size commands wait, new
+    ones are dropped, or with command_overflow="block" the network thread
+    waits for room, stalling keepalives and every other message.
     """
 
     name: str
@@ -38,79 +74,479 @@ class Device:
     sw_version: str = ""
     via_device: str = ""
 
-    client: Optional[mqtt.Client] = None
+    hub: Optional[Any] = None
+    connect_timeout: float = 10.0
+    discovery_qos: int = 1
+    discovery_window: int = 16
+    discovery_rate: Optional[float] = None
+    discovery_timeout: float = 10.0
+    discovery_retain: bool = True
+    compact_discovery: bool = False
+    device_discovery: bool = False
+    shared_state: bool = False
+    state_qos: int = 0
+    state_retain: bool = False
+    command_workers: int = 4
+    command_queue_size: int = 100
+    command_overflow: str = "drop"
+    metrics: Optional[Metrics] = None
+    metrics_sensors: bool = False
+    metrics_interval: int = 60
+    job_watchdog: bool = False
+    job_watchdog_interval: int = 60
+    reconnect_min_delay: float = 1.0
+    reconnect_max_delay: float = 120.0
+    offline_buffer_size: int = 1000
+    offline_buffer_path: Optional[str] = None
+    state_store_path: Optional[str] = None
+    state_store_interval: float = 5.0
+
+    client: Optional[Transport] = None
     entities: dict = field(default_factory=dict)
     base_topic: str = ""
     topics: Optional[Topics] = None
-    scheduler: Optional[BackgroundScheduler] = None
+    scheduler: Optional[Scheduler] = None
+    commands: Optional[CommandDispatcher] = None
+    offline_buffer: Optional[OfflineBuffer] = None
+    state_store: Optional[StateStore] = None
     _on_connected_callback: Optional[Callable] = None
+    _connected: threading.Event = field(default_factory=threading.Event)
+    _shared_states: dict = field(default_factory=dict)
+    _shared_lock: threading.Lock = field(default_factory=threading.Lock)
+    _device_block: Optional[bytes] = None
+    _discovery_payload: Optional[bytes] = None
+    _discovery_generation: int = 0
+    _connects: int = 0
+    _announced: bool = False
+    _reconnect_attempts: int = 0
+    _connack: threading.Event = field(default_factory=threading.Event)
+    _online_lock: threading.Lock = field(default_factory=threading.Lock)
+    _stopping: threading.Event = field(default_factory=threading.Event)
+    _command_topics: set = field(default_factory=set)
+    _rediscovery: Optional[Any] = None
+    _rediscovery_pending: bool = False
+    _rediscovery_lock: threading.Lock = field(default_factory=threading.Lock)
+    _scheduled_jobs: list = field(default_factory=list)
+
+    DEVICE_INFO_FIELDS: ClassVar[frozenset] = frozenset(
+        {
+            "configuration_url",
+            "connections",
+            "hw_version",
+            "identifiers",
+            "manufacturer",
+            "model",
+            "name",
+            "suggested_area",
+            "sw_version",
+            "via_device",
+        }
+    )
+    JOB_PROBLEM: ClassVar[str] = "Job problem"
+
+    DISCOVERY_FIELDS: ClassVar[frozenset] = frozenset(
+        {
+            "object_id",
+            "entity_category",
+            "topics",
+            "shared_state",
+            "state_qos",
+            "state_store",
+            "compact_discovery",
+        }
+    )
+
+    def __setattr__(self, name, value):
+        if (
+            name in self.DEVICE_INFO_FIELDS or name in self.DISCOVERY_FIELDS
+        ) and getattr(self, name, None) != value:
+            # Entity configs embed device fields, rebuilding the block
+            # bumps the generation they are checked against.
+            object.__setattr__(self, "_device_block", None)
+            object.__setattr__(self, "_discovery_payload", None)
+        object.__setattr__(self, name, value)
 
     def __post_init__(self):
+        from slugify import slugify  # pylint: disable = import-outside-toplevel
+
         self.name_slug = slugify(self.name)
         if not self.object_id:
             self.object_id = self.name_slug
-        self.client = mqtt.Client(client_id=self.object_id)
+        if not self.hub and self.client is None:
+            import paho.mqtt.client as mqtt  # pylint: disable = import-outside-toplevel
+
+            self.client = mqtt.Client(client_id=self.object_id)
         if not self.identifiers:
             self.identifiers = [self.object_id]
-        possible_entities = [
-            getattr(self, name)
-            for name in dir(self)
-            if name not in self.__dict__ and not name.startswith("__")
-        ]
-        entities = [e for e in possible_entities if isinstance(e, Entity)]
-        for entity in entities:
+        for attr, _template in entity_templates(type(self)):
+            entity = getattr(self, attr)  # Binds a copy of the class template.
             assert entity.name not in self.entities
-            entity.device = self
             self.entities.update({entity.name: entity})
         base_topic = f"{self.discovery_prefix}/{self.component_type}/{self.object_id}"
         self.topics = Topics(base_topic)
-        self.scheduler = BackgroundScheduler()
+        if self.hub:
+            self.hub.add(self)
+        else:
+            if self.metrics_sensors and self.metrics is None:
+                self.metrics = Metrics()
+            self.commands = CommandDispatcher(
+                workers=self.command_workers,
+                queue_size=self.command_queue_size,
+                overflow=self.command_overflow,
+                metrics=self.metrics,
+            )
+            self.offline_buffer = OfflineBuffer(
+                size=self.offline_buffer_size, path=self.offline_buffer_path
+            )
+            if self.state_store_path:
+                self.state_store = StateStore(
+                    path=self.state_store_path,
+                    flush_interval=self.state_store_interval,
+                )
+        if self.metrics:
+            self.metrics.add_device(self)
+        if self.metrics_sensors:
+            self._add_metrics_sensors()
+        if self.job_watchdog:
+            self._add_job_watchdog()
 
     def connect(
         self,
         *,
-        username: str,
-        password: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
         host: str = "homeassistant.local",
         port: int = 1883,
     ):
         assert self.client
         assert self.topics
-        assert self.scheduler
+        assert not self.hub, "Connect the hub instead."
         logger.debug("Connecting...")
-        self.client.username_pw_set(username=username, password=password)
+        if username is not None:
+            self.client.username_pw_set(username=username, password=password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_connect_fail = self._on_connect_fail
+        # The broker marks the device offline if the connection drops.
+        self.client.will_set(self.topics.availability, "offline", qos=1, retain=True)
+        if self.metrics:
+            self.client.on_publish = self._on_publish_ack
+        self.client.reconnect_delay_set(
+            self.reconnect_min_delay, self.reconnect_max_delay
+        )
+        self._stopping.clear()
+        self._connects = 0
+        self._announced = False
         self.client.connect(host=host, port=port)
-        logger.debug("Connected.")
+        # paho's network thread is the only one writing to the socket.
         self.client.loop_start()
+        if not self._connack.wait(self.connect_timeout):
+            # Stop the network thread retrying, connect() may be called again.
+            self._stopping.set()
+            self.client.disconnect()
+            self.client.loop_stop()
+            raise ConnectionError(f"No CONNACK from {host}:{port}.")
+        logger.debug("Connected.")
+        # Goes online once the configs are acknowledged, replaying the states
+        # kept offline, e.g. by a previous run, before any new one.
         self.send_discovery()
-        time.sleep(1)
-        self.scheduler.start()
+        self._schedule_jobs()
         if self._on_connected_callback:
             self._on_connected_callback()
 
     def disconnect(self):
         assert self.client
-        assert self.scheduler
         assert self.topics
+        assert not self.hub, "Disconnect the hub instead."
         logger.debug("Disconnecting...")
-        self.scheduler.shutdown()
-        self.client.loop_stop()
+        scheduler = self.job_scheduler()
+        for job in self._scheduled_jobs:
+            scheduler.remove(job)
+        if self.commands:
+            self.commands.shutdown()
+        if self._connected.is_set():
+            # A clean disconnect does not trigger the will.
+            window = self.publish_window()
+            window.publish(self.topics.availability, "offline", retain=True)
+            window.flush()
+        if self.state_store:
+            self.state_store.close()
+        self._stopping.set()
         self.client.disconnect()
+        self.client.loop_stop()
+        self._go_offline()
         logger.debug("Disconnected.")
 
+    def _on_disconnect(self, _client, _userdata, rc):
+        self._go_offline()
+        if rc != 0 and not self._stopping.is_set():
+            logger.warning("Connection lost, buffering states.")
+            self._schedule_reconnect()
+
+    def _on_connect_fail(self, _client, _userdata):
+        if not self._stopping.is_set():
+            logger.warning("Reconnect failed.")
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        """Set the delay of paho's next reconnect, with backoff and jitter"""
+        assert self.client
+        delay = backoff_delay(
+            self._reconnect_attempts, self.reconnect_min_delay, self.reconnect_max_delay
+        )
+        self._reconnect_attempts += 1
+        # paho doubles its delay up to the maximum, equal bounds pin it.
+        self.client.reconnect_delay_set(delay, delay)
+        logger.warning("Reconnecting in %.1fs...", delay)
+
+    def _go_online(self):
+        """Replay the offline buffer, then let publishes through"""
+        with self._online_lock:
+            if self._connected.is_set() or not self._connack.is_set():
+                return
+            if self.offline_buffer is not None:
+                self._replay_offline()
+            self._connected.set()
+
+    def _go_offline(self):
+        with self._online_lock:
+            self._connack.clear()
+            self._connected.clear()
+
+    def _replay_offline(self):
+        """Publish the messages buffered while disconnected, oldest first"""
+        assert self.client
+        assert self.offline_buffer is not None
+        messages = self.offline_buffer.drain()
+        if messages:
+            logger.info("Replaying %s offline messages.", len(messages))
+        for topic, payload, qos, retain, result in messages:
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            if result is not None:
+                result._resolve(self._result(info))
+
+    def _on_connect(self, _client, _userdata, _flags, rc):
+        if rc == 0:
+            self._connects += 1
+            self._reconnect_attempts = 0
+            self._on_birth()
+            self._connack.set()
+            if self._connects > 1:
+                if self.metrics:
+                    self.metrics.reconnects.inc()
+                if self._command_topics:
+                    # Clean sessions lose their subscriptions.
+                    self.client.subscribe([(t, 0) for t in self._command_topics])
+                # Buffered states go out before any new one.
+                self._go_online()
+        else:
+            import paho.mqtt.client as mqtt  # pylint: disable = import-outside-toplevel
+
+            logger.error("Connection refused: %s", mqtt.connack_string(rc))
+
+    def _on_birth(self):
+        """Mark the device online and follow HomeAssistant restarts"""
+        assert self.client
+        assert self.topics
+        self.client.publish(self.topics.availability, "online", qos=1, retain=True)
+        self.add_command_route(self.status_topic(), self._on_status)
+
+    def status_topic(self) -> str:
+        """Topic HomeAssistant announces its birth and will on"""
+        return f"{self.discovery_prefix}/status"
+
+    def _on_status(self, _client, _userdata, message):
+        if message.payload == b"online":
+            logger.info("HomeAssistant is online, sending discovery.")
+            self._request_rediscovery()
+
+    def _request_rediscovery(self):
+        """
+        Send discovery on its own thread.
+
+        Discovery waits for acknowledgements, so it runs off the network
+        thread, and outside the bounded command queue so commands can not
+        hold it up. A birth arriving meanwhile runs it once more.
+        """
+        with self._rediscovery_lock:
+            self._rediscovery_pending = True
+            if self._rediscovery is None:
+                self._rediscovery = threading.Thread(
+                    target=self._rediscover, name="hassquitto-discovery", daemon=True
+                )
+                self._rediscovery.start()
+
+    def _rediscover(self):
+        """Send discovery and republish states after HomeAssistant restarted"""
+        while True:
+            with self._rediscovery_lock:
+                if not self._rediscovery_pending:
+                    self._rediscovery = None
+                    return
+                self._rediscovery_pending = False
+            try:
+                self.send_discovery()
+            except Exception:  # pylint: disable = broad-except
+                logger.exception("Discovery for device %s failed.", self.name)
+
+    def _on_publish_ack(self, _client, _userdata, mid):
+        assert self.metrics
+        self.metrics.acked(mid)
+
+    def _add_metrics_sensors(self):
+        """Diagnostic sensors publishing the metrics summary"""
+        for name, unit in SUMMARY_UNITS.items():
+            assert name not in self.entities
+            sensor = Sensor(
+                name=name, entity_category="diagnostic", unit_of_measurement=unit
+            )
+            sensor.device = self
+            self.entities[name] = sensor
+        self.on_interval(seconds=self.metrics_interval)(self.publish_metrics)
+
+    def publish_metrics(self):
+        """Publish the metrics summary to the diagnostic sensors"""
+        assert self.metrics
+        for name, value in self.metrics.summary().items():
+            if value is not None:
+                self.entities[name].publish_state(value)
+
+    def _add_job_watchdog(self):
+        """Problem sensor flagging jobs that fail, time out or stall"""
+        assert self.JOB_PROBLEM not in self.entities
+        sensor = BinarySensor(
+            name=self.JOB_PROBLEM,
+            device_class="problem",
+            entity_category="diagnostic",
+            json_attributes=True,
+        )
+        sensor.device = self
+        self.entities[self.JOB_PROBLEM] = sensor
+        # Inline, so that jobs taking every worker do not silence it.
+        self.add_job(self.check_jobs, interval=self.job_watchdog_interval, inline=True)
+
+    def check_jobs(self) -> dict:
+        """
+        Publish the job problem sensor, return the problems by job name.
+
+        Covers every job on the connection, enable job_watchdog on the hub only.
+        """
+        now = time.monotonic()
+        problems = {}
+        for job in (self.hub or self)._scheduled_jobs:
+            problem = job.problem(now)
+            if problem:
+                problems[job.name] = problem
+        sensor = self.entities[self.JOB_PROBLEM]
+        sensor.publish_state("ON" if problems else "OFF")
+        sensor._publish_attributes({"jobs": problems})
+        if problems:
+            logger.warning("Job problems: %s", problems)
+        return problems
+
+    def job_stats(self) -> dict:
+        """Run counts and times of the jobs on the connection, by job name"""
+        return {job.name: job.stats() for job in (self.hub or self)._scheduled_jobs}
+
+    def publish_window(self) -> PublishWindow:
+        """New publish window using the device discovery settings"""
+        assert self.client
+        return PublishWindow(
+            client=self.client,
+            size=self.discovery_window,
+            rate=self.discovery_rate,
+            timeout=self.discovery_timeout,
+        )
+
     def discovery_config(self):
         assert self.topics
-        return {
+        return self._complete_config(self._discovery_fields(), self.topics.base)
+
+    def _complete_config(self, fields: dict, base_topic: Optional[str]) -> dict:
+        """Discovery config with device info, compacted if compact_discovery"""
+        fields["device"] = self.device_info()
+        if self.compact_discovery:
+            return compact_config(fields, base_topic)
+        return fields
+
+    def _encode_config(self, fields: dict, base_topic: Optional[str]) -> bytes:
+        """Encoded discovery config with device block, see _complete_config()"""
+        if self.compact_discovery:
+            return encode_config(
+                compact_config(fields, base_topic), self.device_block(), "dev"
+            )
+        return encode_config(fields, self.device_block())
+
+    def _discovery_fields(self):
+        assert self.topics
+        fields = {
             "name": "Online",
-            "availability_topic": self.topics.availability,
-            "payload_available": "online",
-            "payload_not_available": "offline",
+            "availability": [{"topic": t} for t in self.availability_topics()],
+            "availability_mode": "all",
             "state_topic": self.topics.state,
             "object_id": self.object_id,
             "unique_id": self.object_id,
             "entity_category": self.entity_category,
-            "device": self.device_info(),
         }
+        if self.state_qos:
+            fields["qos"] = self.state_qos
+        return fields
+
+    def discovery_payload(self) -> bytes:
+        """Encoded discovery config, cached until a relevant field changes"""
+        assert self.topics
+        if self._discovery_payload is None:
+            self._discovery_payload = self._encode_config(
+                self._discovery_fields(), self.topics.base
+            )
+        return self._discovery_payload
+
+    def device_block(self) -> bytes:
+        """Encoded device info shared by every entity discovery config"""
+        if self._device_block is None:
+            device_info = self.device_info()
+            if self.compact_discovery:
+                device_info = compact_device(device_info)
+            self._device_block = serializer.dumps(device_info)
+            self._discovery_generation += 1
+        return self._device_block
+
+    def device_discovery_topic(self) -> str:
+        """Config topic of the device based discovery config"""
+        return f"{self.discovery_prefix}/device/{self.object_id}/config"
+
+    def device_discovery_config(self, removed: Iterable = ()) -> dict:
+        """
+        Device based discovery config, with the device and every entity.
+
+        Args:
+            removed (optional): Entities to remove from HomeAssistant.
+        """
+        return self._complete_config(self._device_discovery_fields(removed), None)
+
+    def device_discovery_payload(self, removed: Iterable = ()) -> bytes:
+        """Encoded device based discovery config, see device_discovery_config()"""
+        return self._encode_config(self._device_discovery_fields(removed), None)
+
+    def _device_discovery_fields(self, removed: Iterable = ()) -> dict:
+        removed = set(removed)
+        components = {}
+        for component in (self, *self.entities.values()):
+            if component in removed:
+                # A component with only its platform is removed.
+                fields = {"platform": component.component_type}
+            else:
+                fields = component._discovery_fields()
+                fields["platform"] = component.component_type
+                if self.compact_discovery:
+                    fields = compact_config(fields, component.topics.base)
+            components[component.object_id] = fields
+        return {"origin": ORIGIN, "components": components}
+
+    def invalidate_discovery(self):
+        """Drop cached discovery payloads, e.g. after mutating a list field"""
+        self._device_block = None
+        self._discovery_payload = None
 
     def device_info(self):
         device_info = {
@@ -127,97 +563,610 @@ class Device:
         }
         return {k: v for k, v in device_info.items() if v}
 
-    def send_discovery(self):
+    def send_discovery(self, force: bool = False) -> DiscoveryReport:
+        """
+        Publish discovery configs the broker does not already hold.
+
+        The retained configs are read back and configs the broker holds
+        unchanged are skipped, a config cleared by someone else, e.g.
+        HomeAssistant deleting the device, is published again. A retained
+        manifest of config hashes is kept next to the device config, configs
+        listed in it whose entity no longer exists are cleared.
+
+        Args:
+            force (optional): Publish every config, without reading them back.
+
+        Returns:
+            Report of added, changed, unchanged and removed configs.
+        """
         assert self.client
         assert self.topics
         logger.debug("Sending discovery for device %s...", self.name)
-        self.client.publish(self.topics.config, json.dumps(self.discovery_config()))
+        manifest = {} if force else self.read_discovery_manifest()
+        report, messages = self._plan_discovery(manifest, force)
+        window = self.publish_window()
+        for topic, payload, retain in messages:
+            window.publish(topic, payload, qos=self.discovery_qos, retain=retain)
+        # Configs are acknowledged before any entity goes online.
+        window.flush()
+        (self.hub or self)._go_online()
+        self._discovery_sent(report)
+        return report
+
+    def _plan_discovery(self, manifest: dict, force: bool):
+        """Report and (topic, payload, retain) messages for a discovery run"""
+        assert self.topics
         for entity in self.entities.values():
-            time.sleep(0.2)
-            logger.debug("Sending discovery for %s...", entity.name)
-            entity.send_discovery()
-            time.sleep(0.4)
-            entity.set_available()
+            entity.prepare_discovery()
+        if self.device_discovery:
+            configs = {self.device_discovery_topic(): self.device_discovery_payload()}
+        else:
+            configs = {self.topics.config: self.discovery_payload()}
+            for entity in self.entities.values():
+                configs[entity.topics.config] = entity.discovery_payload()
 
-    def destroy_discovery(self):
+        report = DiscoveryReport()
+        digests = {}
+        messages = []
+        for topic, payload in configs.items():
+            digest = digests[topic] = config_digest(payload)
+            if topic not in manifest:
+                report.added.append(topic)
+            elif manifest[topic] != digest:
+                report.changed.append(topic)
+            else:
+                report.unchanged.append(topic)
+                if not force:
+                    continue
+            messages.append((topic, payload, self.discovery_retain))
+        device_topic = self.device_discovery_topic()
+        kept = {device_topic, self.topics.config}
+        kept.update(entity.topics.config for entity in self.entities.values())
+        for topic in manifest.keys() - configs.keys():
+            report.removed.append(topic)
+            if (topic == device_topic) != self.device_discovery:
+                # Switched between device based and per entity discovery,
+                # clearing the old config would remove the entities.
+                messages.insert(0, (topic, MIGRATE_PAYLOAD, True))
+            messages.append((topic, "", True))
+            if topic not in kept:
+                # The entity is gone, so is its retained availability.
+                base_topic = topic.rsplit("/", 1)[0]
+                messages.append((Topics(base_topic).availability, "", True))
+        if self.discovery_retain:
+            messages.append((self.manifest_topic(), serializer.dumps(digests), True))
+        return report, messages
+
+    def availability_topics(self) -> list:
+        """Availability topics of the device, preceded by its hub's if hosted"""
+        assert self.topics
+        if self.hub:
+            return [*self.hub.availability_topics(), self.topics.availability]
+        return [self.topics.availability]
+
+    def _discovery_sent(self, report: DiscoveryReport):
+        # Availability is retained and gated by the device's will, so it is
+        # published once per connect(), clearing an "offline" left by a
+        # previous run, and then only when a config first appears.
+        added = set(report.added)
+        if self.device_discovery:
+            # Components are not listed, a new one changes the device config.
+            added.update(report.changed)
+            if self.device_discovery_topic() in added:
+                added.update(entity.topics.config for entity in self.entities.values())
+                added.add(self.topics.config)
+        announce = not self._announced
+        self._announced = True
+        if self.hub and (announce or self.topics.config in added):
+            # Only the hub connection has a will and birth message.
+            self.set_available()
+        for entity in self.entities.values():
+            if announce or entity.topics.config in added:
+                entity.set_available()
+        self._publish_initial_states()
+        logger.info("Discovery for device %s: %s.", self.name, report)
+
+    def _publish_initial_states(self):
+        """Publish initial states of every entity, one message with shared_state"""
+        if not self.shared_state:
+            for entity in self.entities.values():
+                entity.publish_initial_state()
+            return
+        initial = {}
+        for entity in self.entities.values():
+            found = entity._initial_state()
+            if found is not None:
+                initial[entity] = (entity._encode_state(found[0]), found[1])
+        if not initial:
+            return
+        self._publish_shared(
+            {entity: state for entity, (state, _) in initial.items()}, record=False
+        )
+        now = time.monotonic()
+        for entity, (state, updated_at) in initial.items():
+            if updated_at is not None:
+                entity._restore(state, updated_at)
+                continue
+            entity._sent(state, now)
+            if self.state_store is not None:
+                entity._record(state)
+
+    def manifest_topic(self) -> str:
+        """Retained topic holding the hashes of published configs"""
+        assert self.topics
+        return f"{self.topics.base}/discovery"
+
+    def sync_topic(self) -> str:
+        """Topic used to probe the broker while reading retained messages"""
+        assert self.topics
+        return f"{self.topics.base}/sync"
+
+    def read_discovery_manifest(self) -> dict:
+        """Hashes of the configs the broker holds, empty if unknown"""
+        return self.read_discovery_manifests([self]).get(self.manifest_topic(), {})
+
+    def read_discovery_manifests(self, devices: list) -> dict:
+        """Manifests of devices sharing this client, keyed by manifest topic"""
         assert self.client
+        topics = self._retained_topics(devices)
+        if not topics:
+            return {}
+        try:
+            retained = read_retained(
+                self.client, topics, self.sync_topic(), self.discovery_timeout
+            )
+        except TimeoutError as exc:
+            logger.warning("%s Sending full discovery.", exc)
+            return {}
+        return self._parse_manifests(devices, retained)
+
+    def _config_topics(self) -> list:
+        """Config topics a discovery run publishes"""
         assert self.topics
+        if self.device_discovery:
+            return [self.device_discovery_topic()]
         for entity in self.entities.values():
-            time.sleep(0.1)
-            entity.destroy_discovery()
-        self.client.publish(self.topics.config, "")
+            entity._assign_topics()
+        return [
+            self.topics.config,
+            *(entity.topics.config for entity in self.entities.values()),
+        ]
+
+    @staticmethod
+    def _retained_topics(devices: list) -> list:
+        """Manifest and config topics to read back before discovery"""
+        topics = []
+        for device in devices:
+            if device.discovery_retain:
+                topics.append(device.manifest_topic())
+                topics.extend(device._config_topics())
+        return topics
+
+    @staticmethod
+    def _parse_manifests(devices: list, retained: dict) -> dict:
+        """
+        Manifests with the hashes of the configs the broker actually holds.
+
+        Configs missing on the broker are left out, so they count as added,
+        the manifest only tells which configs of gone entities to clear.
+        """
+        manifests = {}
+        for device in devices:
+            if not device.discovery_retain:
+                continue
+            topic = device.manifest_topic()
+            manifest = json.loads(retained[topic]) if topic in retained else {}
+            configs = device._config_topics()
+            manifest = {
+                config: digest
+                for config, digest in manifest.items()
+                if config not in configs
+            }
+            manifest.update(
+                (config, config_digest(retained[config]))
+                for config in configs
+                if config in retained
+            )
+            manifests[topic] = manifest
+        return manifests
+
+    def _publish_config(
+        self,
+        topic: str,
+        payload,
+        window: Optional[PublishWindow] = None,
+        then: Optional[Callable] = None,
+    ):
+        """
+        Publish a discovery config of one entity, see Entity.send_discovery.
+
+        Args:
+            topic: Config topic.
+            payload: Config payload, empty to clear it.
+            window (optional): Window to publish through, a new one if not set.
+            then (optional): Called once the config of a new window is acknowledged.
+        """
+        standalone = window is None
+        if window is None:
+            window = self.publish_window()
+        window.publish(
+            topic, payload, qos=self.discovery_qos, retain=self.discovery_retain
+        )
+        if standalone:
+            window.flush()
+            if then:
+                then()
+
+    def destroy_discovery(self):
+        assert self.client
+        assert self.topics
+        window = self.publish_window()
+        for topic, payload, retain in self._plan_destroy():
+            window.publish(topic, payload, qos=self.discovery_qos, retain=retain)
+        window.flush()
         logger.warning("Device %s discovery destroyed.", self.name)
 
-    def publish_state(self, state):
+    def _plan_destroy(self):
+        """(topic, payload, retain) messages clearing every discovery config"""
+        assert self.topics
+        if self.device_discovery:
+            messages = [(self.device_discovery_topic(), "", self.discovery_retain)]
+        else:
+            messages = [
+                (entity.topics.config, "", self.discovery_retain)
+                for entity in self.entities.values()
+                if entity.topics
+            ]
+            messages.append((self.topics.config, "", self.discovery_retain))
+        # Availability is retained, cleared along with the configs.
+        messages.extend(
+            (entity.topics.availability, "", True)
+            for entity in self.entities.values()
+            if entity.topics
+        )
+        if self.hub:
+            # The hub connection's will keeps its own availability.
+            messages.append((self.topics.availability, "", True))
+        if self.discovery_retain:
+            messages.append((self.manifest_topic(), "", True))
+        return messages
+
+    def _publish(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        """Publish a message, return what callers of publish_state receive"""
+        assert self.client
+        if not (self.hub or self)._connected.is_set():
+            buffered = self._buffer_offline(topic, payload, qos, retain)
+            if buffered is not None:
+                return buffered
+        return self._publish_now(topic, payload, qos, retain)
+
+    def _publish_now(self, topic: str, payload, qos: int, retain: bool):
+        """Hand a message to the client, online or not"""
         assert self.client
+        if self.metrics is None:
+            return self._result(
+                self.client.publish(topic, payload, qos=qos, retain=retain)
+            )
+        started = time.monotonic()
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        self.metrics.sent(info, started)
+        return self._result(info)
+
+    def _result(self, info) -> PublishResult:
+        """Result of a message handed to the client"""
+        return PublishResult(info)
+
+    def _buffer_offline(self, topic: str, payload, qos: int, retain: bool):
+        """Keep a message while offline, None if it is to be published"""
+        owner = self.hub or self
+        if self.offline_buffer is None:
+            return None
+        with owner._online_lock:
+            # Going online replays the buffer under the lock, a message is
+            # either replayed or published after it, never before.
+            if owner._connected.is_set():
+                return None
+            return self.offline_buffer.put(topic, payload, qos=qos, retain=retain)
+
+    def add_command_route(self, topic: str, handler: Callable):
+        """Call handler with messages on a command topic"""
+        assert self.client
+        if self.hub:
+            self.hub.add_command_route(topic, handler)
+            return
+        self._command_topics.add(topic)
+        self.client.message_callback_add(topic, handler)
+        self.client.subscribe(topic)
+
+    def _skipped(self) -> PublishResult:
+        """Returned by publish_state when nothing was published"""
+        return NOT_SENT
+
+    def _dispatch_command(self, entity: Entity, func: Callable, payload: str):
+        """Queue a command handler on the worker pool, off the network thread"""
+        assert self.commands
+        self.commands.submit(entity, func, payload)
+
+    def publish_state(
+        self, state, qos: Optional[int] = None, retain: Optional[bool] = None
+    ):
         assert self.topics
-        self.client.publish(self.topics.state, state)
+        result = self._publish(
+            self.topics.state,
+            state,
+            qos=self.state_qos if qos is None else qos,
+            retain=self.state_retain if retain is None else retain,
+        )
         logger.debug("Device %s published state: %s", self.name, state)
+        return result
+
+    def shared_state_topic(self) -> str:
+        """Topic of the JSON document holding every entity state"""
+        assert self.topics
+        return f"{self.topics.base}/states"
+
+    def publish_states(
+        self,
+        states: dict,
+        force: bool = False,
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+    ):
+        """
+        Publish many entity states as one message on the shared state topic.
+
+        Requires shared_state, entities pick their value from the document
+        with the value_template in their discovery config. Each state is
+        handled like in Entity.publish_state: duplicates are suppressed with
+        only_changes (or a Sensor deadband), and states of entities with
+        max_rate set are coalesced and follow in a later message.
+
+        Args:
+            states: Entity states, keyed by entity or entity name.
+            force (optional): Publish every state, even unchanged ones.
+            qos (optional): QoS of the message, state_qos if not set.
+            retain (optional): Retain flag of the message, state_retain if not set.
+
+        Returns:
+            PublishResult of the message, or when every state was coalesced
+            the pending result of one of them.
+        """
+        assert self.shared_state
+        now = time.monotonic()
+        batch = {}
+        pending = None
+        taken = []
+        for key, state in states.items():
+            entity = key if isinstance(key, Entity) else self.entities[key]
+            state = entity._encode_state(state)
+            if entity.max_rate and not force:
+                coalesced = default_coalescer().admit(entity, state, qos, retain)
+                if coalesced is not None:
+                    pending = coalesced
+                    continue
+            elif entity.max_rate:
+                older = default_coalescer().take(entity)
+                if older is not None:
+                    taken.append(older)
+            if not force and entity._suppress(state, now):
+                entity._suppressed(state)
+                continue
+            batch[entity] = state
+        if not batch:
+            return pending or self._skipped()
+        result = self._publish_shared(batch, record=True, qos=qos, retain=retain)
+        for entity, state in batch.items():
+            entity._sent(state, now)
+        for older in taken:
+            older._resolve(result)
+        return result
+
+    def _publish_shared(
+        self,
+        states: dict,
+        record: bool,
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+    ):
+        assert self.shared_state
+        published = []
+        with self._shared_lock:
+            for key, state in states.items():
+                entity = key if isinstance(key, Entity) else self.entities[key]
+                if isinstance(state, States):
+                    state = state.value
+                elif isinstance(state, bytes):
+                    state = state.decode()  # A dict state, already encoded.
+                self._shared_states[entity.state_key] = state
+                published.append((entity, state))
+            payload = serializer.dumps(self._shared_states)
+            result = self._publish(
+                self.shared_state_topic(),
+                payload,
+                qos=self.state_qos if qos is None else qos,
+                retain=self.state_retain if retain is None else retain,
+            )
+        if record and self.state_store is not None:
+            for entity, state in published:
+                entity._record(state)
+        logger.debug("Device %s published states: %s", self.name, payload)
+        return result
 
     def publish_availability(self, availability):
-        assert self.client
         assert self.topics
-        self.client.publish(self.topics.availability, availability)
+        result = self._publish(
+            self.topics.availability, availability, qos=1, retain=True
+        )
         logger.debug("Device %s published availability: %s", self.name, availability)
+        return result
 
     def set_available(self):
-        self.publish_availability("online")
+        result = self.publish_availability("online")
         logger.debug("Online.")
+        return result
 
     def set_not_available(self):
-        self.publish_availability("offline")
+        result = self.publish_availability("offline")
         logger.debug("Offline.")
+        return result
 
     def set_online(self):
-        self.publish_state("ON")
+        result = self.publish_state("ON")
         logger.debug("State ON.")
+        return result
 
     def set_offline(self):
-        self.publish_state("OFF")
+        result = self.publish_state("OFF")
         logger.debug("State OFF.")
+        return result
+
+    def job_scheduler(self) -> Scheduler:
+        """Scheduler running the jobs, the process-wide one by default"""
+        if self.hub:
+            return self.hub.job_scheduler()
+        return self.scheduler or default_scheduler()
+
+    def add_job(
+        self,
+        func: Callable,
+        *,
+        interval: Optional[float] = None,
+        delay: Optional[float] = None,
+        adaptive: Optional[AdaptiveInterval] = None,
+        timeout: Optional[float] = None,
+        overrun: str = "skip",
+        inline: bool = False,
+    ) -> Job:
+        """
+        Run a function on an interval, or once after a delay.
+
+        Jobs run while connected, jobs added before connecting start then.
+
+        Args:
+            func: Function to call, without arguments.
+            interval (optional): Seconds between runs, runs once if not set.
+            delay (optional): Seconds before the first run, one interval if not set.
+            adaptive (optional): Interval adapting to state changes of the device.
+            timeout (optional): Seconds after which a run is abandoned.
+            overrun (optional): "skip", "queue" or "cancel" a run falling due
+                while the previous one is still going, see Job.
+            inline (optional): Run on the scheduler thread, for quick jobs, see Job.
+        """
+        owner = self.hub or self
+        job = Job(
+            func=func,
+            interval=interval,
+            delay=delay,
+            timeout=timeout,
+            overrun=overrun,
+            inline=inline,
+            metrics=self.metrics,
+            adaptive=adaptive,
+            snapshot=self._state_snapshot,
+        )
+        owner._scheduled_jobs.append(job)
+        if owner._connected.is_set():
+            self.job_scheduler().add(job)
+        return job
+
+    def _schedule_jobs(self):
+        scheduler = self.job_scheduler()
+        self._scheduled_jobs = [job for job in self._scheduled_jobs if not job.finished]
+        for job in self._scheduled_jobs:
+            scheduler.add(job)
 
     def on_interval(
         self,
         seconds: Optional[int] = None,
         minutes: Optional[int] = None,
         hours: Optional[int] = None,
+        offset: Optional[float] = None,
+        timeout: Optional[float] = None,
+        overrun: str = "skip",
     ):
-        """Run handler on interval"""
+        """
+        Run handler on interval
+
+        Args:
+            offset (optional): Seconds before the first run, to stagger jobs
+                sharing an interval. One interval if not set.
+            timeout (optional): Seconds after which a run is abandoned.
+            overrun (optional): "skip", "queue" or "cancel" a run falling due
+                while the previous one is still going.
+        """
+        interval = (seconds or 0) + 60 * (minutes or 0) + 3600 * (hours or 0)
 
         def wrapper(func):
-            assert self.scheduler
-            kwargs = {"seconds": seconds, "minutes": minutes, "hours": hours}
-            kwargs = {k: v for k, v in kwargs.items() if v}
-            self.scheduler.add_job(func, "interval", **kwargs)
+            self.add_job(
+                func, interval=interval, delay=offset, timeout=timeout, overrun=overrun
+            )
             return func
 
         return wrapper
 
-    def call_after(self, seconds: int):
-        """Call handler after seconds"""
-        job = None
+    def on_poll(
+        self,
+        min_seconds: float,
+        max_seconds: float,
+        backoff: float = 2.0,
+        offset: Optional[float] = None,
+        timeout: Optional[float] = None,
+        overrun: str = "skip",
+    ):
+        """
+        Run handler on an interval adapting to how often states change.
+
+        Polls every min_seconds while the handler publishes changed states,
+        backing off by backoff after every poll that changed nothing, up to
+        max_seconds. Use poll_now() to poll immediately, e.g. from a button.
+
+        Args:
+            min_seconds: Interval while states change.
+            max_seconds: Interval once states are stable.
+            backoff (optional): Growth factor of the interval per stable poll.
+            offset (optional): Seconds before the first poll.
+            timeout (optional): Seconds after which a poll is abandoned.
+            overrun (optional): "skip", "queue" or "cancel" a poll falling due
+                while the previous one is still going.
+        """
 
         def wrapper(func):
-            assert self.scheduler
-
-            def inner():
-                nonlocal job
-                assert self.scheduler
-                assert job
-                func()
-                self.scheduler.remove_job(job_id=job.id)
-
-            nonlocal job
-            job = self.scheduler.add_job(
-                inner,
-                "interval",
-                seconds=seconds,
-                misfire_grace_time=5,
+            adaptive = AdaptiveInterval(
+                min_interval=min_seconds, max_interval=max_seconds, backoff=backoff
+            )
+            self.add_job(
+                func, adaptive=adaptive, delay=offset, timeout=timeout, overrun=overrun
             )
             return func
 
         return wrapper
 
+    def poll_now(self, func: Optional[Callable] = None):
+        """
+        Run adaptive polls now instead of at their next interval.
+
+        Args:
+            func (optional): Poll handler, every poll on the connection if not set.
+        """
+        for job in (self.hub or self)._scheduled_jobs:
+            if job.adaptive and (func is None or job.func is func):
+                job.trigger()
+
+    def _state_snapshot(self) -> tuple:
+        """Last published states, compared around adaptive polls"""
+        with self._shared_lock:
+            shared = dict(self._shared_states)
+        return [entity._last_state for entity in self.entities.values()], shared
+
+    def call_after(self, seconds: float, timeout: Optional[float] = None):
+        """Call handler once after seconds"""
+
+        def wrapper(func):
+            self.add_job(func, delay=seconds, timeout=timeout)
+            return func
+
+        return wrapper
+
     def on_connected(self, func):
         """Callback for connected event"""
         self._on_connected_callback = func
@@ -0,0 +1,274 @@
+"""
+Discovery payloads
+"""
+import hashlib
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from . import serializer
+
+
+# HomeAssistant's abbreviations of discovery config keys, for the keys sent
+# by the entities here and other common ones. Others are sent in full.
+ABBREVIATIONS = {
+    "availability": "avty",
+    "availability_mode": "avty_mode",
+    "availability_template": "avty_tpl",
+    "availability_topic": "avty_t",
+    "command_template": "cmd_tpl",
+    "command_topic": "cmd_t",
+    "components": "cmps",
+    "device": "dev",
+    "device_class": "dev_cla",
+    "enabled_by_default": "en",
+    "encoding": "e",
+    "entity_category": "ent_cat",
+    "entity_picture": "ent_pic",
+    "expire_after": "exp_aft",
+    "force_update": "frc_upd",
+    "icon": "ic",
+    "json_attributes_template": "json_attr_tpl",
+    "json_attributes_topic": "json_attr_t",
+    "object_id": "obj_id",
+    "optimistic": "opt",
+    "options": "ops",
+    "origin": "o",
+    "payload_available": "pl_avail",
+    "payload_not_available": "pl_not_avail",
+    "payload_off": "pl_off",
+    "payload_on": "pl_on",
+    "payload_press": "pl_prs",
+    "platform": "p",
+    "retain": "ret",
+    "state_class": "stat_cla",
+    "state_template": "stat_tpl",
+    "state_topic": "stat_t",
+    "state_value_template": "stat_val_tpl",
+    "suggested_display_precision": "sug_dsp_prc",
+    "topic": "t",
+    "unique_id": "uniq_id",
+    "unit_of_measurement": "unit_of_meas",
+    "value_template": "val_tpl",
+}
+
+DEVICE_ABBREVIATIONS = {
+    "configuration_url": "cu",
+    "connections": "cns",
+    "hw_version": "hw",
+    "identifiers": "ids",
+    "manufacturer": "mf",
+    "model": "mdl",
+    "suggested_area": "sa",
+    "sw_version": "sw",
+}
+
+# Origin of device based discovery configs, shown in HomeAssistant's logs.
+ORIGIN = {"name": "hassquitto"}
+
+# Sent to an old config topic before the entities it configured are
+# discovered on another one, so clearing it does not remove them.
+MIGRATE_PAYLOAD = b'{"migrate_discovery":true}'
+
+
+def encode_config(
+    config: dict, device_block: bytes, device_key: str = "device"
+) -> bytes:
+    """
+    Encode a discovery config, splicing in a pre-encoded device block.
+
+    Args:
+        config: Discovery config without the "device" key.
+        device_block: JSON encoded device info.
+        device_key (optional): Key of the device block, "dev" when compact.
+
+    Returns:
+        JSON encoded discovery config.
+    """
+    encoded = serializer.dumps(config)
+    return encoded[:-1] + b',"' + device_key.encode() + b'":' + device_block + b"}"
+
+
+def compact_device(device_info: dict) -> dict:
+    """Device info with abbreviated keys"""
+    return {DEVICE_ABBREVIATIONS.get(k, k): v for k, v in device_info.items()}
+
+
+def compact_config(config: dict, base_topic: Optional[str] = None) -> dict:
+    """
+    Discovery config with abbreviated keys and topics relative to "~".
+
+    HomeAssistant expands both, the config means the same as the verbose one.
+
+    Args:
+        config: Discovery config.
+        base_topic (optional): Topic that "~" stands for, the entity's base
+            topic. Topics are left as they are if not set.
+    """
+    prefix = f"{base_topic}/" if base_topic else None
+
+    def relative(topic):
+        if prefix and isinstance(topic, str) and topic.startswith(prefix):
+            return f"~/{topic[len(prefix):]}"
+        return topic
+
+    compact = {"~": base_topic} if base_topic else {}
+    for key, value in config.items():
+        if key == "availability":
+            value = [
+                {
+                    ABBREVIATIONS.get(k, k): relative(v) if k == "topic" else v
+                    for k, v in item.items()
+                }
+                for item in value
+            ]
+        elif key == "device":
+            value = compact_device(value)
+        elif key.endswith("_topic"):
+            value = relative(value)
+        compact[ABBREVIATIONS.get(key, key)] = value
+    return compact
+
+
+def expand_config(config: dict) -> dict:
+    """
+    Verbose form of a compact discovery config, expanded like HomeAssistant.
+
+    The components of a device based config are expanded one by one.
+
+    Args:
+        config: Discovery config, compact or not.
+    """
+    keys = {abbreviation: key for key, abbreviation in ABBREVIATIONS.items()}
+    device_keys = {
+        abbreviation: key for key, abbreviation in DEVICE_ABBREVIATIONS.items()
+    }
+    base = config.get("~")
+
+    def absolute(key, value):
+        if base and key.endswith("topic") and isinstance(value, str):
+            if value.startswith("~"):
+                return base + value[1:]
+            if value.endswith("~"):
+                return value[:-1] + base
+        return value
+
+    expanded = {}
+    for key, value in config.items():
+        if key == "~":
+            continue
+        key = keys.get(key, key)
+        if key == "availability":
+            value = [
+                {keys.get(k, k): absolute(keys.get(k, k), v) for k, v in item.items()}
+                for item in value
+            ]
+        elif key == "device":
+            value = {device_keys.get(k, k): v for k, v in value.items()}
+        elif key == "components":
+            value = {k: expand_config(v) for k, v in value.items()}
+        expanded[key] = absolute(key, value)
+    return expanded
+
+
+def config_digest(payload: bytes) -> str:
+    """Content hash of an encoded discovery config."""
+    return hashlib.sha1(payload).hexdigest()
+
+
+@dataclass(kw_only=True)
+class DiscoveryReport:
+    """
+    Outcome of a discovery run, as lists of config topics.
+
+    Args:
+        added: Configs the broker did not hold.
+        changed: Configs whose payload differed from the broker's.
+        unchanged: Configs left as they were.
+        removed: Configs cleared because their entity no longer exists.
+    """
+
+    added: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    def extend(self, other: "DiscoveryReport"):
+        """Add the configs of another report to this one"""
+        self.added.extend(other.added)
+        self.changed.extend(other.changed)
+        self.unchanged.extend(other.unchanged)
+        self.removed.extend(other.removed)
+
+    def __str__(self):
+        return (
+            f"{len(self.added)} added, {len(self.changed)} changed, "
+            f"{len(self.unchanged)} unchanged, {len(self.removed)} removed"
+        )
+
+
+@contextmanager
+def _retained_reader(client: Any, topics: list, sync_topic: str, on_synced: Callable):
+    """Subscribe to topics and probe the broker, yield the retained payloads"""
+    retained: dict = {}
+    token = uuid.uuid4().hex.encode()
+
+    def on_retained(_client, _userdata, message):
+        if message.payload:
+            retained[message.topic] = message.payload
+
+    def on_sync(_client, _userdata, message):
+        if message.payload == token:
+            on_synced()
+
+    for topic in topics:
+        client.message_callback_add(topic, on_retained)
+    client.message_callback_add(sync_topic, on_sync)
+    client.subscribe([(topic, 1) for topic in [*topics, sync_topic]])
+    client.publish(sync_topic, token, qos=1)
+    try:
+        yield retained
+    finally:
+        client.unsubscribe([*topics, sync_topic])
+        for topic in [*topics, sync_topic]:
+            client.message_callback_remove(topic)
+
+
+def read_retained(client: Any, topics: list, sync_topic: str, timeout: float):
+    """
+    Read the retained messages on topics.
+
+    Retained messages are delivered on subscribe, so once a probe published
+    to sync_topic after subscribing comes back, anything retained has arrived.
+
+    Args:
+        client: Connected MQTT client.
+        topics: Topics to read.
+        sync_topic: Topic used to probe the broker, not shared with others.
+        timeout: Seconds to wait for the probe.
+
+    Returns:
+        Retained payloads as bytes, keyed by topic, topics without one left out.
+    """
+    synced = threading.Event()
+    with _retained_reader(client, topics, sync_topic, synced.set) as retained:
+        if not synced.wait(timeout):
+            raise TimeoutError(f"No reply from broker on {sync_topic}.")
+    return retained
+
+
+async def read_retained_async(
+    client: Any, topics: list, sync_topic: str, timeout: float
+):
+    """read_retained for a client driven by the running event loop"""
+    import asyncio  # pylint: disable = import-outside-toplevel
+
+    synced = asyncio.Event()
+    with _retained_reader(client, topics, sync_topic, synced.set) as retained:
+        try:
+            await asyncio.wait_for(synced.wait(), timeout)
+        except asyncio.TimeoutError as exc:
+            raise TimeoutError(f"No reply from broker on {sync_topic}.") from exc
+    return retained
@@ -1,19 +1,22 @@
+import copy
+import functools
 import time
-import json
-from dataclasses import dataclass
-from typing import Callable, Optional, Any
-
-from slugify import slugify
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+from typing import Any, Callable, ClassVar, Optional
 
+from . import serializer
 from .logging import get_logger
+from .pacing import PublishWindow
 from .states import States
+from .throttle import default_coalescer
 from .topics import Topics
 
 
 logger = get_logger(__name__)
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Entity:
     """Entity"""
 
@@ -30,52 +33,268 @@ class Entity:
     device: Optional[Any] = None  # type: ignore
     command_handler: Optional[Callable] = None
     initial_state: Optional[Any] = None
+    json_attributes: bool = False
+    qos: Optional[int] = None
+    retain: Optional[bool] = None
+
+    only_changes: bool = False
+    heartbeat: Optional[float] = None
+    published_count: int = 0
+    suppressed_count: int = 0
+    _last_state: Optional[Any] = None
+    _last_published_at: Optional[float] = None
+
+    max_rate: Optional[float] = None
+    coalesced_count: int = 0
+    _pending: Optional[tuple] = None
+    _next_send_at: float = 0.0
+    _restored_at: Optional[float] = None
+    _discovery_payload: Optional[bytes] = None
+    _discovery_generation: int = 0
+    _attr_name: str = ""
+
+    DISCOVERY_FIELDS: ClassVar[frozenset] = frozenset(
+        {
+            "name",
+            "component_type",
+            "object_id",
+            "discovery_prefix",
+            "device_class",
+            "entity_category",
+            "topics",
+            "device",
+            "json_attributes",
+            "qos",
+        }
+    )
+
+    def __setattr__(self, name, value):
+        if name in self.DISCOVERY_FIELDS and getattr(self, name, None) != value:
+            object.__setattr__(self, "_discovery_payload", None)
+        object.__setattr__(self, name, value)
 
     def __post_init__(self):
+        from slugify import slugify  # pylint: disable = import-outside-toplevel
+
         self.name_slug = slugify(self.name)
 
-    def on_command(self, func):
-        def _wrapper(_client, _userdata, message):
-            func(message.payload.decode())
+    def __copy__(self):
+        # Plain slot copy, skips __setattr__ and the pickle protocol.
+        entity = object.__new__(type(self))
+        for name in _slot_names(type(self)):
+            object.__setattr__(entity, name, getattr(self, name))
+        return entity
+
+    def __set_name__(self, owner, name):
+        self._attr_name = name
+
+    def __get__(self, instance, owner=None):
+        """
+        Entities declared on a Device class are templates, each device
+        instance gets its own shallow copy on first access.
+        """
+        if instance is None:
+            return self
+        entity = copy.copy(self)
+        entity.device = instance
+        instance.__dict__[self._attr_name] = entity
+        return entity
+
+    @property
+    def state_key(self) -> str:
+        """Key of this entity in the device shared state document"""
+        return self.name_slug.replace("-", "_")
+
+    @property
+    def state_qos(self) -> int:
+        """QoS of state publishes, the device's state_qos unless qos is set"""
+        if self.qos is not None:
+            return self.qos
+        return self.device.state_qos if self.device else 0
+
+    @property
+    def state_retain(self) -> bool:
+        """Retain flag of state publishes, the device's unless retain is set"""
+        if self.retain is not None:
+            return self.retain
+        return self.device.state_retain if self.device else False
 
-        self.command_handler = _wrapper
+    def on_command(self, func):
+        self.command_handler = func
         return func
 
-    def send_discovery(self):
+    def _on_command_message(self, _client, _userdata, message):
+        assert self.device
+        self.device._dispatch_command(
+            self, self._handle_command, message.payload.decode()
+        )
+
+    def _handle_command(self, payload: str):
+        assert self.command_handler
+        return self.command_handler(payload)
+
+    def send_discovery(self, window: Optional[PublishWindow] = None):
+        """
+        Publish discovery config, through the device window if given.
+
+        Without a window the config is acknowledged before the initial state
+        is published; with one the device does this after the window flushes.
+        With device_discovery, the device based config is published instead.
+        On an AsyncDevice this returns a coroutine to await.
+        """
+        assert self.device
+        self.prepare_discovery()
+        if self.device.device_discovery:
+            # Entities are components of the one device based config.
+            topic = self.device.device_discovery_topic()
+            payload = self.device.device_discovery_payload()
+        else:
+            topic, payload = self.topics.config, self.discovery_payload()
+        return self.device._publish_config(
+            topic, payload, window, then=self.publish_initial_state
+        )
+
+    def prepare_discovery(self):
+        """Assign topics and subscribe to commands, without publishing"""
         assert self.device
         assert self.device.client
+        self._assign_topics()
+        if self.command_handler:
+            self.device.add_command_route(self.topics.command, self._on_command_message)
+
+    def _assign_topics(self):
+        assert self.device
         if not self.object_id:
             self.object_id = self.device.object_id + "_" + self.name_slug
         base_topic = f"{self.discovery_prefix}/{self.component_type}/{self.object_id}"
-        self.topics = Topics(base_topic)
-        if self.command_handler:
-            self.device.client.message_callback_add(
-                self.topics.command, self.command_handler
-            )
-            self.device.client.subscribe(self.topics.command)
-        self.device.client.publish(
-            self.topics.config, json.dumps(self.discovery_config())
-        )
+        if self.topics is None or self.topics.base != base_topic:
+            self.topics = Topics(base_topic)
+
+    def publish_initial_state(self):
+        """Publish the last state, one kept in the state store, or initial_state"""
+        assert self.device
+        initial = self._initial_state()
+        if initial is None:
+            return
+        state, updated_at = initial
+        if updated_at is None:
+            self.publish_state(state, force=True)
+            return
+        assert self.topics
+        if self.device.shared_state:
+            self.device._publish_shared({self: state}, record=False)
+        else:
+            self.device._publish(self.topics.state, state)
+        self._restore(state, updated_at)
+
+    def _initial_state(self) -> Optional[tuple]:
+        """(state, updated_at) to publish on discovery, updated_at if restored"""
+        assert self.device
+        if self._restored_at is not None:
+            return self._last_state, self._restored_at
+        if self._last_state is not None:
+            return self._last_state, None
+        store = self.device.state_store
+        stored = store.get(self.object_id) if store is not None else None
+        if stored is not None:
+            return stored
         if self.initial_state:
-            time.sleep(0.4)
-            self.publish_state(self.initial_state)
+            return self.initial_state, None
+        return None
+
+    def _restore(self, state, updated_at: float):
+        """Take a republished stored state, marked stale until the next publish"""
+        self._last_state = state
+        self._restored_at = updated_at
+        self._publish_attributes(
+            {
+                "restored": True,
+                "updated_at": datetime.fromtimestamp(
+                    updated_at, timezone.utc
+                ).isoformat(),
+                "age": round(time.time() - updated_at),
+            }
+        )
+
+    def _record(self, state):
+        """Keep a published state in the state store, dropping the stale mark"""
+        assert self.device
+        self.device.state_store.record(self.object_id, state)
+        if self._restored_at is not None:
+            self._restored_at = None
+            self._publish_attributes({"restored": False})
 
-    def destroy_discovery(self):
+    def _publish_attributes(self, attributes: dict):
+        assert self.device
+        assert self.topics
+        return self.device._publish(
+            self.topics.attributes, serializer.dumps(attributes)
+        )
+
+    def destroy_discovery(self, window: Optional[PublishWindow] = None):
+        """
+        Clear discovery config, through the device window if given.
+
+        On an AsyncDevice this returns a coroutine to await.
+        """
         assert self.device
         assert self.device.client
         assert self.topics
-        self.device.client.publish(self.topics.config, "")
+        if self.device.device_discovery:
+            topic = self.device.device_discovery_topic()
+            payload = self.device.device_discovery_payload(removed=[self])
+        else:
+            topic, payload = self.topics.config, ""
+        return self.device._publish_config(topic, payload, window)
 
     def discovery_config(self):
         assert self.device
         assert self.topics
-        entity_config = self.device.discovery_config()
+        return self.device._complete_config(self._discovery_fields(), self.topics.base)
+
+    def discovery_payload(self) -> bytes:
+        """Encoded discovery config, cached until a relevant field changes"""
+        assert self.device
+        assert self.topics
+        # Rebuilds a stale device block first, bumping the generation.
+        self.device.device_block()
+        if (
+            self._discovery_payload is None
+            or self._discovery_generation != self.device._discovery_generation
+        ):
+            self._discovery_payload = self.device._encode_config(
+                self._discovery_fields(), self.topics.base
+            )
+            self._discovery_generation = self.device._discovery_generation
+        return self._discovery_payload
+
+    def _discovery_fields(self):
+        assert self.device
+        assert self.topics
+        entity_config = self.device._discovery_fields()
         entity_config["name"] = self.name
         entity_config["object_id"] = self.object_id
         entity_config["unique_id"] = self.object_id
-        entity_config["availability_topic"] = self.topics.availability
-        entity_config["state_topic"] = self.topics.state
+        # Unavailable when either the device or the entity is offline.
+        entity_config["availability"] = [
+            *entity_config["availability"],
+            {"topic": self.topics.availability},
+        ]
+        if self.device.shared_state:
+            entity_config["state_topic"] = self.device.shared_state_topic()
+            entity_config[
+                "value_template"
+            ] = f"{{{{ value_json['{self.state_key}'] }}}}"
+        else:
+            entity_config["state_topic"] = self.topics.state
         entity_config["command_topic"] = self.topics.command
+        if self.state_qos:
+            # HomeAssistant subscribes with it, or QoS is lost on delivery.
+            entity_config["qos"] = self.state_qos
+        else:
+            entity_config.pop("qos", None)
+        if self.json_attributes or self.device.state_store is not None:
+            entity_config["json_attributes_topic"] = self.topics.attributes
         if self.entity_category:
             entity_config["entity_category"] = self.entity_category
         else:
@@ -92,45 +311,138 @@ class Entity:
 
     def set_available(self):
         assert self.device
-        assert self.device.client
         assert self.topics
-        self.device.client.publish(self.topics.availability, "online")
+        result = self.device._publish(
+            self.topics.availability, "online", qos=1, retain=True
+        )
         logger.debug("%s is Online.", self.name)
+        return result
 
     def set_not_available(self):
         assert self.device
-        assert self.device.client
         assert self.topics
-        self.device.client.publish(self.topics.availability, "offline")
+        result = self.device._publish(
+            self.topics.availability, "offline", qos=1, retain=True
+        )
         logger.debug("%s is Offline.", self.name)
-
-    def publish_state(self, state):
+        return result
+
+    def publish_state(
+        self,
+        state,
+        force: bool = False,
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+    ):
+        """
+        Publish state, unless it is a duplicate of the last published one.
+
+        Duplicates are only suppressed with only_changes (or a Sensor
+        deadband) set, and are still sent once heartbeat seconds have passed.
+        With max_rate set, states arriving faster are coalesced and only the
+        latest one is sent when the window opens.
+
+        Args:
+            state: State to publish.
+            force (optional): Publish even if the state is unchanged.
+            qos (optional): QoS of this publish, the entity's qos if not set.
+            retain (optional): Retain flag of this publish, the entity's if not set.
+
+        Returns:
+            PublishResult to wait for or await, pending while coalesced.
+        """
         assert self.device
-        assert self.device.client
         assert self.topics
+        state = self._encode_state(state)
+        taken = None
+        if self.max_rate and not force:
+            pending = default_coalescer().admit(self, state, qos, retain)
+            if pending is not None:
+                return pending
+        elif self.max_rate:
+            taken = default_coalescer().take(self)
+        result = self._send(state, force, qos, retain)
+        if taken is not None:
+            taken._resolve(result)
+        return result
+
+    @staticmethod
+    def _encode_state(state):
+        """State as published, a States member by value and a dict as JSON"""
         if isinstance(state, States):
-            state = state.value
+            return state.value
         if isinstance(state, dict):
-            state = json.dumps(state)
-        self.device.client.publish(self.topics.state, state)
+            return serializer.dumps(state)
+        return state
+
+    def _send(
+        self,
+        state,
+        force: bool = False,
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+    ):
+        assert self.device
+        assert self.topics
+        now = time.monotonic()
+        if not force and self._suppress(state, now):
+            return self._suppressed(state)
+        device = self.device
+        if qos is None:
+            qos = device.state_qos if self.qos is None else self.qos
+        if retain is None:
+            retain = device.state_retain if self.retain is None else self.retain
+        if device.shared_state:
+            result = device._publish_shared(
+                {self: state}, record=True, qos=qos, retain=retain
+            )
+        else:
+            result = device._publish(self.topics.state, state, qos=qos, retain=retain)
+            if device.state_store is not None:
+                self._record(state)
+        self._sent(state, now)
+        return result
+
+    def _suppressed(self, state):
+        """Count a suppressed duplicate, return what publish_state returns"""
+        assert self.device
+        self.suppressed_count += 1
+        logger.debug("Entity %s suppressed state: %s", self.name, state)
+        return self.device._skipped()
+
+    def _sent(self, state, now: float):
+        """Remember a published state for duplicate suppression and heartbeats"""
+        self._last_state = state
+        self._last_published_at = now
+        self.published_count += 1
         logger.debug("Entity %s published state: %s", self.name, state)
 
+    def _suppress(self, state, now: float) -> bool:
+        if self._last_published_at is None:
+            return False
+        if self.heartbeat and now - self._last_published_at >= self.heartbeat:
+            return False
+        return self._unchanged(state)
+
+    def _unchanged(self, state) -> bool:
+        return self.only_changes and state == self._last_state
 
-@dataclass(kw_only=True)
+
+@dataclass(kw_only=True, eq=False, slots=True)
 class AlarmControlPanel(Entity):
     """Alarm Control Panel Entity"""
 
     component_type: str = "alarm_control_panel"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class BinarySensor(Entity):
     """Binary Sensor Entity"""
 
     component_type: str = "binary_sensor"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Button(Entity):
     """Button Entity"""
 
@@ -140,111 +452,127 @@ class Button(Entity):
         return self.on_command(func)
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Camera(Entity):
     """Camera Entity"""
 
     component_type: str = "camera"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Cover(Entity):
     """Cover Entity"""
 
     component_type: str = "cover"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class DeviceTracker(Entity):
     """Device Tracker Entity"""
 
     component_type: str = "device_tracker"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class DeviceTrigger(Entity):
     """Device Trigger Entity"""
 
     component_type: str = "device_trigger"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Fan(Entity):
     """Fan Entity"""
 
     component_type: str = "fan"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Humidifier(Entity):
     """Humidifier Entity"""
 
     component_type: str = "humidifier"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Climate(Entity):
     """Climate Entity"""
 
     component_type: str = "climate"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Light(Entity):
     """Light Entity"""
 
     component_type: str = "light"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Lock(Entity):
     """Lock Entity"""
 
     component_type: str = "lock"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Number(Entity):
     """Number Entity"""
 
     component_type: str = "number"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Scene(Entity):
     """Scene Entity"""
 
     component_type: str = "scene"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Select(Entity):
     """Select Entity"""
 
     component_type: str = "select"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Sensor(Entity):
     """Sensor Entity"""
 
     component_type: str = "sensor"
     unit_of_measurement: Optional[str] = None
+    deadband: Optional[float] = None
+    deadband_relative: Optional[float] = None
+
+    DISCOVERY_FIELDS: ClassVar[frozenset] = Entity.DISCOVERY_FIELDS | {
+        "unit_of_measurement"
+    }
 
+    def _unchanged(self, state) -> bool:
+        if self.deadband is None and self.deadband_relative is None:
+            return Entity._unchanged(self, state)
+        try:
+            value, last = float(state), float(self._last_state)
+        except (TypeError, ValueError):
+            return Entity._unchanged(self, state)
+        limit = max(self.deadband or 0.0, (self.deadband_relative or 0.0) * abs(last))
+        return abs(value - last) <= limit
 
-@dataclass(kw_only=True)
+
+@dataclass(kw_only=True, eq=False, slots=True)
 class Siren(Entity):
     """Siren Entity"""
 
     component_type: str = "siren"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Switch(Entity):
     """Switch Entity"""
 
     initial_state: str = "OFF"
-    is_on = False
+    is_on: bool = False
     component_type: str = "switch"
 
     # def __post_init__(self):
@@ -253,53 +581,71 @@ class Switch(Entity):
 
     def toggle(self):
         if self.is_on:
-            self.turn_off()
-        else:
-            self.turn_on()
+            return self.turn_off()
+        return self.turn_on()
 
     def turn_on(self):
         self.is_on = True
-        self.publish_state("ON")
+        return self.publish_state("ON")
 
     def turn_off(self):
         self.is_on = False
-        self.publish_state("OFF")
+        return self.publish_state("OFF")
 
     def on_change(self, func):
-        def _on_change(state):
-            if state == "ON":
-                self.turn_on()
-                func(state)
-            elif state == "OFF":
-                self.turn_off()
-                func(state)
+        return self.on_command(func)
 
-        return self.on_command(_on_change)
+    def _handle_command(self, payload: str):
+        if payload == "ON":
+            self.turn_on()
+        elif payload == "OFF":
+            self.turn_off()
+        else:
+            return None
+        return Entity._handle_command(self, payload)
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Update(Entity):
     """Update Entity"""
 
     component_type: str = "update"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class TagScanner(Entity):
     """Tag Scanner Entity"""
 
     component_type: str = "tag_scanner"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Text(Entity):
     """Text Entity"""
 
     component_type: str = "text"
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, eq=False, slots=True)
 class Vacuum(Entity):
     """Vacuum Entity"""
 
     component_type: str = "vacuum"
+
+
+@functools.lru_cache(maxsize=None)
+def _slot_names(cls: type) -> tuple:
+    return tuple(f.name for f in fields(cls))
+
+
+@functools.lru_cache(maxsize=None)
+def entity_templates(cls: type) -> tuple:
+    """(attribute name, template) of the entities declared on a Device class"""
+    templates = {}
+    for klass in reversed(cls.__mro__):
+        for name, value in vars(klass).items():
+            if isinstance(value, Entity):
+                if not value._attr_name:
+                    value._attr_name = name
+                templates[name] = value
+    return tuple(templates.items())
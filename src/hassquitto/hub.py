@@ -0,0 +1,100 @@
+"""
+Hub
+"""
+from dataclasses import dataclass, field
+from typing import Callable
+
+from .device import Device
+from .discovery import DiscoveryReport
+from .logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True, eq=False)
+class Hub(Device):
+    """
+    HomeAssistant MQTT bridge Device hosting many devices on one connection
+
+    Devices created with hub=... share the hub's MQTT client, scheduler,
+    command workers, metrics, offline buffer and state store, are discovered
+    and connected with the hub, and show up in HomeAssistant as connected
+    via the hub.
+    """
+
+    devices: dict = field(default_factory=dict)
+    _command_routes: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        super().__post_init__()
+        assert self.client
+        self.client.on_message = self._on_message
+
+    def add(self, device: Device):
+        """Host a device on this hub"""
+        assert device.object_id not in self.devices
+        assert device is not self
+        device.hub = self
+        device.client = self.client
+        device.commands = self.commands
+        device.metrics = self.metrics
+        device.offline_buffer = self.offline_buffer
+        device.state_store = self.state_store
+        if not device.via_device:
+            device.via_device = self.identifiers[0]
+        self.devices[device.object_id] = device
+
+    def add_command_route(self, topic: str, handler: Callable):
+        """Call handler with messages on a command topic"""
+        assert self.client
+        self._command_routes[topic] = handler
+        self._command_topics.add(topic)
+        self.client.subscribe(topic)
+
+    def _state_snapshot(self) -> tuple:
+        # Polls of the hub may publish states of its devices.
+        return tuple(
+            device._state_snapshot() for device in [self, *self.devices.values()]
+        )
+
+    def _on_message(self, client, userdata, message):
+        # One dict lookup instead of matching every registered callback.
+        handler = self._command_routes.get(message.topic)
+        if handler:
+            handler(client, userdata, message)
+
+    def connect(self, **kwargs):
+        for device in self.devices.values():
+            device._announced = False
+        super().connect(**kwargs)
+        for device in self.devices.values():
+            if device._on_connected_callback:
+                device._on_connected_callback()
+
+    def send_discovery(self, force: bool = False) -> DiscoveryReport:
+        """Publish discovery configs of the hub and every hosted device"""
+        devices = [self, *self.devices.values()]
+        logger.debug("Sending discovery for %s devices...", len(devices))
+        manifests = {} if force else self.read_discovery_manifests(devices)
+        report = DiscoveryReport()
+        reports = []
+        window = self.publish_window()
+        for device in devices:
+            manifest = manifests.get(device.manifest_topic(), {})
+            device_report, messages = device._plan_discovery(manifest, force)
+            for topic, payload, retain in messages:
+                window.publish(topic, payload, qos=self.discovery_qos, retain=retain)
+            reports.append((device, device_report))
+            report.extend(device_report)
+        # Configs are acknowledged before any entity goes online.
+        window.flush()
+        self._go_online()
+        for device, device_report in reports:
+            device._discovery_sent(device_report)
+        return report
+
+    def destroy_discovery(self):
+        for device in self.devices.values():
+            device.destroy_discovery()
+        super().destroy_discovery()
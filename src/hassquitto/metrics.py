@@ -0,0 +1,376 @@
+"""
+Runtime metrics
+"""
+import bisect
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, ClassVar, Optional
+
+from .logging import get_logger
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+
+logger = get_logger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Diagnostic sensors of Device.metrics_sensors and their units.
+SUMMARY_UNITS = {
+    "Published messages": None,
+    "Publish queue": None,
+    "Messages in flight": None,
+    "Publish ack time": "ms",
+    "Command latency": "ms",
+    "Job lag": "ms",
+    "Job run time": "ms",
+    "Reconnects": None,
+}
+
+
+@dataclass(kw_only=True, eq=False)
+class Counter:
+    """Monotonic counter"""
+
+    name: str
+    help: str
+    value: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> list:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+@dataclass(kw_only=True, eq=False)
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets, in seconds.
+
+    Args:
+        name: Metric name.
+        help: Metric description.
+        buckets (optional): Sorted upper bounds of the buckets.
+    """
+
+    name: str
+    help: str
+    buckets: tuple = DEFAULT_BUCKETS
+    count: int = 0
+    total: float = 0.0
+    _counts: list = field(default_factory=list)
+    _taken: tuple = (0, 0.0)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self._counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def take_mean(self) -> Optional[float]:
+        """Mean of the values observed since the previous call, if any"""
+        with self._lock:
+            count, total = self.count, self.total
+            taken_count, taken_total = self._taken
+            self._taken = (count, total)
+        if count == taken_count:
+            return None
+        return (total - taken_total) / (count - taken_count)
+
+    def render(self) -> list:
+        with self._lock:
+            counts, count, total = list(self._counts), self.count, self.total
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@dataclass(kw_only=True, eq=False)
+class Metrics:
+    """
+    Counters and histograms of a device and the devices on its hub.
+
+    Rendered in the Prometheus text format by render() and serve(). A
+    Device created with metrics_sensors also publishes a summary as
+    diagnostic sensors; devices on a hub share its metrics, so enable the
+    sensors on the hub only. Per-entity publish counts and queue depths are
+    read when rendering, so only timings cost anything on the hot paths.
+    """
+
+    ack_time: Histogram = field(
+        default_factory=lambda: Histogram(
+            name="hassquitto_publish_ack_seconds",
+            help="Time from publish to broker acknowledgement.",
+        )
+    )
+    command_latency: Histogram = field(
+        default_factory=lambda: Histogram(
+            name="hassquitto_command_latency_seconds",
+            help="Time from command message to handler return.",
+        )
+    )
+    job_lag: Histogram = field(
+        default_factory=lambda: Histogram(
+            name="hassquitto_job_lag_seconds",
+            help="Delay of scheduled job runs behind their scheduled time.",
+        )
+    )
+    job_run_time: Histogram = field(
+        default_factory=lambda: Histogram(
+            name="hassquitto_job_run_seconds",
+            help="Run time of scheduled jobs.",
+        )
+    )
+    reconnects: Counter = field(
+        default_factory=lambda: Counter(
+            name="hassquitto_reconnects_total",
+            help="Connections established after the first one.",
+        )
+    )
+    devices: list = field(default_factory=list)
+    _pending: dict = field(default_factory=dict)
+    _pending_lock: threading.Lock = field(default_factory=threading.Lock)
+    _prune_at: int = 0
+
+    MAX_PENDING: ClassVar[int] = 10_000
+    _server: Optional["ThreadingHTTPServer"] = None
+
+    def add_device(self, device: Any):
+        if device not in self.devices:
+            self.devices.append(device)
+
+    def sent(self, info: Any, started: float):
+        """
+        Time a publish until its acknowledgement, see acked().
+
+        Args:
+            info: Message info returned by publish.
+            started: Monotonic time taken before publishing.
+        """
+        if info.rc != 0:
+            return  # Not queued, never acknowledged.
+        if not info.is_published():
+            with self._pending_lock:
+                self._pending[info.mid] = (started, info)
+                if len(self._pending) > max(self._prune_at, self.MAX_PENDING):
+                    self._prune()
+            # The acknowledgement may have raced the entry, and found none.
+            if not info.is_published():
+                return
+            with self._pending_lock:
+                if self._pending.pop(info.mid, None) is None:
+                    return  # acked() took it.
+        self.ack_time.observe(time.monotonic() - started)
+
+    def acked(self, mid: int):
+        with self._pending_lock:
+            pending = self._pending.pop(mid, None)
+        if pending is not None:
+            self.ack_time.observe(time.monotonic() - pending[0])
+
+    def _prune(self):
+        """Drop entries whose acknowledgement was missed, then the oldest"""
+        self._pending = {
+            mid: (started, info)
+            for mid, (started, info) in self._pending.items()
+            if not info.is_published()
+        }
+        while len(self._pending) > self.MAX_PENDING:
+            del self._pending[next(iter(self._pending))]
+        # Many messages in flight, prune again once their number doubles.
+        self._prune_at = 2 * len(self._pending)
+
+    def published_total(self) -> int:
+        return sum(
+            entity.published_count
+            for device in self.devices
+            for entity in device.entities.values()
+        )
+
+    def queue_depth(self) -> int:
+        """Messages queued in the MQTT clients, not yet acknowledged"""
+        clients = {id(device.client): device.client for device in self.devices}
+        return sum(len(getattr(c, "_out_messages", ())) for c in clients.values())
+
+    def in_flight(self) -> int:
+        """QoS > 0 messages sent and awaiting acknowledgement"""
+        clients = {id(device.client): device.client for device in self.devices}
+        return sum(getattr(c, "_inflight_messages", 0) for c in clients.values())
+
+    def summary(self) -> dict:
+        """
+        Values of the diagnostic sensors, keyed by sensor name.
+
+        Timings are means in milliseconds since the previous summary, None
+        if nothing was observed.
+        """
+
+        def mean_ms(histogram: Histogram) -> Optional[float]:
+            mean = histogram.take_mean()
+            return None if mean is None else round(mean * 1000, 3)
+
+        return {
+            "Published messages": self.published_total(),
+            "Publish queue": self.queue_depth(),
+            "Messages in flight": self.in_flight(),
+            "Publish ack time": mean_ms(self.ack_time),
+            "Command latency": mean_ms(self.command_latency),
+            "Job lag": mean_ms(self.job_lag),
+            "Job run time": mean_ms(self.job_run_time),
+            "Reconnects": self.reconnects.value,
+        }
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, help_text, attr in (
+            ("published", "State messages published.", "published_count"),
+            ("suppressed", "Unchanged states not published.", "suppressed_count"),
+            ("coalesced", "States replaced before being sent.", "coalesced_count"),
+        ):
+            metric = f"hassquitto_entity_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for device in self.devices:
+                for entity in device.entities.values():
+                    labels = (
+                        f'device="{_label(device.name)}",entity="{_label(entity.name)}"'
+                    )
+                    lines.append(f"{metric}{{{labels}}} {getattr(entity, attr)}")
+
+        dispatchers = {
+            id(device.commands): device.commands
+            for device in self.devices
+            if device.commands
+        }
+        for name, help_text, value in (
+            (
+                "publish_queue",
+                "Messages queued in the MQTT client.",
+                self.queue_depth(),
+            ),
+            ("in_flight", "Messages awaiting acknowledgement.", self.in_flight()),
+            (
+                "command_queue",
+                "Commands waiting for a worker.",
+                sum(d.depth for d in dispatchers.values()),
+            ),
+        ):
+            metric = f"hassquitto_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+
+        jobs = {
+            id(job): job
+            for device in self.devices
+            for job in (device.hub or device)._scheduled_jobs
+        }
+        for name, kind, help_text, attr in (
+            ("runs_total", "counter", "Job runs, abandoned ones included.", "runs"),
+            (
+                "skipped_total",
+                "counter",
+                "Runs skipped as overruns or while stuck.",
+                "skipped",
+            ),
+            ("failures_total", "counter", "Job runs that raised.", "failed"),
+            ("timeouts_total", "counter", "Job runs abandoned.", "timed_out"),
+            ("duration_seconds_total", "counter", "Job run time.", "run_time_total"),
+            ("duration_seconds_max", "gauge", "Longest job run.", "run_time_max"),
+            ("interval_seconds", "gauge", "Current job interval.", "interval"),
+        ):
+            metric = f"hassquitto_job_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for job in jobs.values():
+                value = getattr(job, attr)
+                if value is not None:
+                    lines.append(f'{metric}{{job="{_label(job.name)}"}} {value}')
+
+        for metric in (
+            self.ack_time,
+            self.command_latency,
+            self.job_lag,
+            self.job_run_time,
+            self.reconnects,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, host: str = "") -> "ThreadingHTTPServer":
+        """
+        Serve render() over HTTP for Prometheus, on a daemon thread.
+
+        Args:
+            port (optional): Port to listen on.
+            host (optional): Address to bind, every interface if empty.
+        """
+        # pylint: disable = import-outside-toplevel
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable = invalid-name
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable = redefined-builtin
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="hassquitto-metrics", daemon=True
+        ).start()
+        logger.info("Serving metrics on port %s.", self._server.server_port)
+        return self._server
+
+    def shutdown(self):
+        """Stop the HTTP endpoint, if serving"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,147 @@
+"""
+Offline buffering and reconnect backoff
+"""
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .logging import get_logger
+from .results import PublishResult
+
+
+logger = get_logger(__name__)
+
+
+def backoff_delay(attempt: int, min_delay: float, max_delay: float) -> float:
+    """
+    Seconds to wait before a reconnect attempt.
+
+    Doubles with every attempt up to max_delay, with the upper half jittered
+    so that devices sharing a broker do not reconnect in lockstep.
+
+    Args:
+        attempt: Number of failed attempts so far.
+        min_delay: Delay before the first attempt.
+        max_delay: Maximum delay.
+    """
+    cap = min(max_delay, min_delay * 2 ** min(attempt, 32))
+    return random.uniform(cap / 2, cap)
+
+
+@dataclass(kw_only=True, eq=False)
+class OfflineBuffer:
+    """
+    Latest outbound message per topic, kept while disconnected.
+
+    Messages are kept in the order of their last update. Once full, the
+    topic updated longest ago is dropped.
+
+    Args:
+        size (optional): Maximum number of topics.
+        path (optional): Append-only file keeping the buffer across restarts.
+    """
+
+    size: int = 1000
+    path: Optional[str] = None
+    dropped: int = 0
+    _messages: OrderedDict = field(default_factory=OrderedDict)
+    _results: dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _lines: int = 0
+
+    def __post_init__(self):
+        assert self.size > 0
+        if self.path:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def put(
+        self, topic: str, payload, qos: int = 0, retain: bool = False
+    ) -> PublishResult:
+        """
+        Keep a message, replacing any buffered one on the same topic.
+
+        Returns a pending result, resolved when the message is replayed or
+        dropped. Messages replacing each other share it.
+        """
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode()
+        evicted = None
+        with self._lock:
+            self._messages.pop(topic, None)
+            self._messages[topic] = (payload, qos, retain)
+            result = self._results.get(topic)
+            if result is None:
+                result = self._results[topic] = PublishResult(pending=True)
+            if len(self._messages) > self.size:
+                oldest, _message = self._messages.popitem(last=False)
+                evicted = self._results.pop(oldest, None)
+                self.dropped += 1
+            if self.path:
+                self._append(topic, payload, qos, retain)
+        if evicted is not None:
+            evicted._resolve(None)
+        return result
+
+    def drain(self) -> list:
+        """
+        Remove and return the buffered messages.
+
+        Messages are (topic, payload, qos, retain, result) tuples, result is
+        the pending result returned by put(), None for messages loaded from
+        the file.
+        """
+        with self._lock:
+            messages = [
+                (topic, *message, self._results.pop(topic, None))
+                for topic, message in self._messages.items()
+            ]
+            self._messages.clear()
+            if self.path and self._lines:
+                open(self.path, "w", encoding="utf-8").close()
+                self._lines = 0
+        return messages
+
+    def _append(self, topic: str, payload, qos: int, retain: bool):
+        assert self.path
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps([topic, payload, qos, retain]) + "\n")
+        self._lines += 1
+        if self._lines > 2 * self.size:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the file with only the buffered messages"""
+        assert self.path
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for topic, (payload, qos, retain) in self._messages.items():
+                file.write(json.dumps([topic, payload, qos, retain]) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._messages)
+
+    def _load(self):
+        assert self.path
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    topic, payload, qos, retain = json.loads(line)
+                except ValueError:
+                    # A write cut short by a crash.
+                    logger.warning("Skipping corrupt line in %s.", self.path)
+                    continue
+                self._messages.pop(topic, None)
+                self._messages[topic] = (payload, qos, retain)
+        while len(self._messages) > self.size:
+            self._messages.popitem(last=False)
+            self.dropped += 1
+        self._compact()
+        logger.info("Loaded %s offline messages from %s.", len(self), self.path)
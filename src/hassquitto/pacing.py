@@ -0,0 +1,80 @@
+"""
+Publish pacing
+"""
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from .logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True)
+class PacedWindow:
+    """
+    Window bookkeeping shared by the blocking and the asyncio publish windows.
+
+    Args:
+        size (optional): Maximum number of unacknowledged publishes.
+        rate (optional): Maximum publishes per second, unlimited if not set.
+        timeout (optional): Seconds to wait for a single acknowledgement.
+    """
+
+    size: int = 16
+    rate: Optional[float] = None
+    timeout: float = 10.0
+    _in_flight: deque = field(default_factory=deque)
+    _next_publish_at: float = 0.0
+
+    def _full(self) -> bool:
+        return len(self._in_flight) >= self.size
+
+    def _pace(self) -> float:
+        """Claim the next publish slot, return the seconds to sleep until it"""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        delay = max(self._next_publish_at - now, 0.0)
+        self._next_publish_at = max(now, self._next_publish_at) + 1 / self.rate
+        return delay
+
+
+@dataclass(kw_only=True)
+class PublishWindow(PacedWindow):
+    """
+    Bounded window of in-flight publishes, paced by broker acknowledgements.
+
+    Args:
+        client: MQTT client to publish with.
+        size (optional): Maximum number of unacknowledged publishes.
+        rate (optional): Maximum publishes per second, unlimited if not set.
+        timeout (optional): Seconds to wait for a single acknowledgement.
+    """
+
+    client: Any
+
+    def publish(self, topic: str, payload, qos: int = 1, retain: bool = False):
+        """Publish once there is room in the window, return the message info."""
+        while self._full():
+            self._wait(self._in_flight.popleft())
+        delay = self._pace()
+        if delay:
+            time.sleep(delay)
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        self._in_flight.append(info)
+        return info
+
+    def flush(self):
+        """Wait until every publish in the window is acknowledged."""
+        while self._in_flight:
+            self._wait(self._in_flight.popleft())
+
+    def _wait(self, info):
+        info.wait_for_publish(timeout=self.timeout)
+        if not info.is_published():
+            logger.warning(
+                "Publish %s not acknowledged in %ss.", info.mid, self.timeout
+            )
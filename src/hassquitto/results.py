@@ -0,0 +1,200 @@
+"""
+Publish results
+"""
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional
+
+
+# Guards the callbacks of pending results, resolution is rare and quick.
+_lock = threading.Lock()
+
+
+class PublishResult:
+    """
+    Handle of a publish, returned by publish_state and friends.
+
+    Wraps the paho MQTTMessageInfo and has the same interface, plus wait()
+    and await. States that were coalesced or kept in the offline buffer
+    return a pending result, resolved once the state is actually sent, or
+    dropped if it never is. Results of suppressed states have nothing to
+    wait for and count as published. Wait for many at once with wait_all()
+    or gather().
+    """
+
+    __slots__ = ("info", "sent", "dropped", "_done", "_callbacks", "_ack")
+
+    def __init__(self, info: Any = None, pending: bool = False):
+        self.info = info
+        self.sent = info is not None
+        self.dropped = False
+        self._done: Optional[threading.Event] = None
+        self._callbacks: Optional[list] = None
+        # Future resolved on acknowledgement, set by the AsyncDevice.
+        self._ack: Any = None
+        if pending:
+            self._done = threading.Event()
+            self._callbacks = []
+
+    @property
+    def pending(self) -> bool:
+        """Whether the message is still waiting to be sent"""
+        return self._done is not None and not self._done.is_set()
+
+    @property
+    def mid(self) -> Optional[int]:
+        return self.info.mid if self.sent else None
+
+    @property
+    def rc(self) -> int:
+        return self.info.rc if self.sent else 0
+
+    def is_published(self) -> bool:
+        if self.pending or self.dropped:
+            return False
+        return not self.sent or self.info.is_published()
+
+    def wait_for_publish(self, timeout: Optional[float] = None):
+        self.wait(timeout)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the broker acknowledgement, return whether it arrived.
+
+        Raises like paho when the message could not be queued.
+
+        Args:
+            timeout (optional): Seconds to wait, forever if not set.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._done is not None and not self._done.wait(timeout):
+            return False
+        if self.sent:
+            remaining = (
+                None if deadline is None else max(deadline - time.monotonic(), 0)
+            )
+            self.info.wait_for_publish(timeout=remaining)
+        return self.is_published()
+
+    def __await__(self):
+        if not self.is_published():
+            yield from gather([self]).__await__()
+        return self
+
+    def _resolve(self, result: Optional["PublishResult"] = None):
+        """
+        Resolve a pending result with the result of the actual publish.
+
+        Args:
+            result (optional): Result of the publish, dropped if not set.
+        """
+        if result is not None and result.pending:
+            result._on_resolve(self._resolve)
+            return
+        if result is None:
+            self.dropped = True
+        else:
+            self.info, self.sent = result.info, result.sent
+            self.dropped, self._ack = result.dropped, result._ack
+        assert self._done is not None
+        with _lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks or [], []
+        for callback in callbacks:
+            callback(self)
+
+    def _on_resolve(self, callback: Callable):
+        """Call callback with the result once it is resolved, now if it is"""
+        with _lock:
+            if self.pending:
+                assert self._callbacks is not None
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _resolved(self, loop: Any) -> Any:
+        """Future on loop, done once the result is resolved"""
+        future = loop.create_future()
+        self._on_resolve(lambda _result: loop.call_soon_threadsafe(_set_done, future))
+        return future
+
+    def __repr__(self) -> str:
+        if self.pending:
+            return "<PublishResult pending>"
+        if self.dropped:
+            return "<PublishResult dropped>"
+        if not self.sent:
+            return "<PublishResult not sent>"
+        return f"<PublishResult mid={self.mid} published={self.is_published()}>"
+
+
+# Shared result of publishes that sent nothing.
+NOT_SENT = PublishResult()
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def wait_all(results: Iterable, timeout: Optional[float] = None) -> bool:
+    """
+    Wait for many publishes, return whether all were acknowledged in time.
+
+    Args:
+        results: Publish results, e.g. of one poll.
+        timeout (optional): Seconds to wait for all of them, forever if not set.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for result in results:
+        if result.is_published():
+            continue
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not result.wait(remaining):
+            return False
+    return True
+
+
+async def gather(results: Iterable, timeout: Optional[float] = None) -> bool:
+    """
+    Await many publishes, see wait_all().
+
+    Acknowledgements of an AsyncDevice on the running loop are awaited
+    directly, the others are waited for on one thread, not one per result.
+
+    Args:
+        results: Publish results, e.g. of one poll.
+        timeout (optional): Seconds to wait for all of them, forever if not set.
+    """
+    import asyncio  # pylint: disable = import-outside-toplevel
+
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+
+    def remaining() -> Optional[float]:
+        return None if deadline is None else max(deadline - loop.time(), 0)
+
+    results = list(results)
+    pending = [result._resolved(loop) for result in results if result.pending]
+    if pending:
+        _, not_done = await asyncio.wait(pending, timeout=remaining())
+        if not_done:
+            return False
+    acks = [
+        result._ack
+        for result in results
+        if result._ack is not None and result._ack.get_loop() is loop
+    ]
+    if acks:
+        _, not_done = await asyncio.wait(acks, timeout=remaining())
+        if not_done:
+            return False
+    others = [
+        result
+        for result in results
+        if (result._ack is None or result._ack.get_loop() is not loop)
+        and not result.is_published()
+    ]
+    if others and not await asyncio.to_thread(wait_all, others, remaining()):
+        return False
+    return all(result.is_published() for result in results)
@@ -0,0 +1,490 @@
+"""
+Job scheduling
+"""
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Optional
+
+from .logging import get_logger
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True, eq=False)
+class AdaptiveInterval:
+    """
+    Interval following how often polled values change.
+
+    Drops back to min_interval after a run that changed something and grows
+    by backoff after every run that did not, up to max_interval.
+
+    Args:
+        min_interval: Seconds between runs while values change.
+        max_interval: Seconds between runs once values are stable.
+        backoff (optional): Growth factor of the interval per stable run.
+    """
+
+    min_interval: float
+    max_interval: float
+    backoff: float = 2.0
+    current: float = 0.0
+
+    def __post_init__(self):
+        assert 0 < self.min_interval <= self.max_interval
+        assert self.backoff >= 1
+        self.current = self.min_interval
+
+    def update(self, changed: bool) -> float:
+        """Interval to wait after a run, given whether it changed values"""
+        if changed:
+            self.current = self.min_interval
+        else:
+            self.current = min(self.current * self.backoff, self.max_interval)
+        return self.current
+
+
+class JobCancelled(BaseException):
+    """
+    Raised in a job run that timed out or was cancelled, see sleep().
+
+    Not an Exception, like asyncio.CancelledError, so that handlers catching
+    every error in a job do not keep it running.
+    """
+
+
+_local = threading.local()
+
+
+def current_job() -> Optional["Job"]:
+    """Job running in this thread, if any"""
+    return getattr(_local, "job", None)
+
+
+def check_cancelled():
+    """Raise JobCancelled if the job run in this thread should stop"""
+    cancel = getattr(_local, "cancel", None)
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled()
+
+
+@contextmanager
+def running_job(job: "Job", cancel: threading.Event):
+    """Make job and its cancel event current in this thread, see sleep()"""
+    _local.job, _local.cancel = job, cancel
+    try:
+        yield
+    finally:
+        _local.job = _local.cancel = None
+
+
+def sleep(seconds: float):
+    """
+    Sleep in a job, raising JobCancelled as soon as the run should stop.
+
+    Threads can not be interrupted, a run that timed out keeps its worker
+    until it returns. Long jobs use this instead of time.sleep to return
+    early. Outside jobs it is time.sleep.
+    """
+    cancel = getattr(_local, "cancel", None)
+    if cancel is None:
+        time.sleep(seconds)
+    elif cancel.wait(seconds):
+        raise JobCancelled()
+
+
+@dataclass(kw_only=True, eq=False)
+class Job:
+    """
+    Handle of a scheduled job.
+
+    Args:
+        func: Function to call, without arguments.
+        interval (optional): Seconds between runs, runs once if not set.
+        delay (optional): Seconds before the first run, one interval if not set.
+        timeout (optional): Seconds after which a run is abandoned.
+        overrun (optional): When a run falls due while the previous one is
+            still going, "skip" it, "queue" it to start once the previous one
+            returns, or "cancel" the previous one and start once it stopped.
+        inline (optional): Run on the scheduler thread (or event loop) instead
+            of a worker, for quick jobs that must run when every worker is
+            busy, like the job watchdog.
+        metrics (optional): Metrics recording job lag and run time.
+        adaptive (optional): Adapts the interval to changes, see AdaptiveInterval.
+        snapshot (optional): Values compared before and after runs, for adaptive.
+    """
+
+    func: Callable
+    interval: Optional[float] = None
+    delay: Optional[float] = None
+    timeout: Optional[float] = None
+    overrun: str = "skip"
+    inline: bool = False
+    metrics: Optional[Any] = None
+    adaptive: Optional[AdaptiveInterval] = None
+    snapshot: Optional[Callable[[], Any]] = None
+    name: str = ""
+    cancelled: bool = False
+    next_run_at: Optional[float] = None
+
+    runs: int = 0
+    skipped: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    run_time_total: float = 0.0
+    run_time_max: float = 0.0
+    last_run_time: Optional[float] = None
+    last_finished_at: Optional[float] = None
+
+    _running: bool = False
+    _queued: bool = False
+    # Abandoned runs that have not returned yet.
+    _abandoned: int = 0
+    _run_id: int = 0
+    _cancel: Optional[threading.Event] = None
+    _problem: Optional[str] = None
+    _added_at: Optional[float] = None
+    _generation: int = 0
+    # Scheduler or AsyncScheduler running the job.
+    _scheduler: Optional[Any] = None
+
+    # A job that has not completed a run for this many intervals is stalled.
+    STALL_INTERVALS: ClassVar[int] = 3
+
+    def __post_init__(self):
+        assert self.overrun in ("skip", "queue", "cancel")
+        assert self.timeout is None or self.timeout > 0
+        assert not (self.inline and self.timeout), "Inline runs can not time out."
+        if self.adaptive:
+            assert self.snapshot is not None
+            self.interval = self.adaptive.current
+        assert self.interval is None or self.interval > 0
+        assert self.interval is not None or self.delay is not None
+        if not self.name:
+            self.name = getattr(self.func, "__name__", repr(self.func))
+
+    @property
+    def finished(self) -> bool:
+        """Cancelled, or a one-shot job that has run"""
+        return self.cancelled or (self.interval is None and self.runs > 0)
+
+    def cancel(self):
+        """Stop scheduling the job and ask a run in progress to stop"""
+        self.cancelled = True
+        if self._cancel is not None:
+            self._cancel.set()
+        if self._scheduler is not None:
+            self._scheduler.remove(self)
+
+    def trigger(self):
+        """Run the job now, if scheduled"""
+        if self._scheduler is not None:
+            self._scheduler.reschedule(self, 0.0)
+
+    def next_run_after(self, run_at: float, now: float) -> Optional[float]:
+        """Run following the one due at run_at, at a fixed rate without catching up"""
+        if not self.interval:
+            return None
+        next_run_at = run_at + self.interval
+        if next_run_at <= now:
+            missed = (now - next_run_at) // self.interval + 1
+            next_run_at += missed * self.interval
+        return next_run_at
+
+    def record_run(self, run_at: float, started_at: float, finished_at: float):
+        """Count a run due at run_at, in the stats and the metrics"""
+        run_time = finished_at - started_at
+        if self.metrics:
+            self.metrics.job_lag.observe(max(started_at - run_at, 0.0))
+            self.metrics.job_run_time.observe(run_time)
+        self.runs += 1
+        self.run_time_total += run_time
+        self.run_time_max = max(self.run_time_max, run_time)
+        self.last_run_time = run_time
+
+    def adapt(self, changed: bool) -> bool:
+        """Update the adaptive interval after a run, return whether it moved"""
+        assert self.adaptive
+        interval = self.adaptive.update(changed)
+        if interval == self.interval:
+            return False
+        self.interval = interval
+        return True
+
+    def problem(self, now: Optional[float] = None) -> Optional[str]:
+        """
+        Why the job is unhealthy, if it is.
+
+        "stuck" while an abandoned run has not returned, "timed out" or
+        "failed" after such a run, "stalled" when no run completed for
+        STALL_INTERVALS intervals.
+        """
+        if self._abandoned:
+            return "stuck"
+        if self._problem:
+            return self._problem
+        if self.interval is None or self.next_run_at is None:
+            return None
+        since = self.last_finished_at or self._added_at
+        if since is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if now - since > self.STALL_INTERVALS * self.interval + (self.timeout or 0):
+            return "stalled"
+        return None
+
+    def stats(self) -> dict:
+        """Run counts and run times"""
+        runs = self.runs or 1
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "interval": self.interval,
+            "run_time_avg": self.run_time_total / runs,
+            "run_time_max": self.run_time_max,
+            "last_run_time": self.last_run_time,
+        }
+
+
+@dataclass(kw_only=True, eq=False)
+class Scheduler:
+    """
+    Timer heap running the jobs of every device on one thread.
+
+    Due jobs are handed to a worker pool, so a slow job does not delay the
+    others. The overrun policy of a job decides what happens to a run
+    falling due while the previous one is still going. Intervals keep a
+    fixed rate and do not catch up on missed runs.
+
+    Runs exceeding the timeout of their job, or cancelled by the "cancel"
+    overrun policy, are abandoned and asked to stop, see sleep(). Threads can
+    not be interrupted: until an abandoned run returns it keeps its worker,
+    and the runs of its job falling due are skipped rather than taking more
+    workers. Such a job is "stuck", see Job.problem(). Inline jobs run on the
+    scheduler thread, so they keep running when every worker is taken.
+
+    Args:
+        workers (optional): Number of threads running jobs.
+    """
+
+    workers: int = 8
+    _heap: list = field(default_factory=list)
+    _deadlines: list = field(default_factory=list)
+    _counter: Any = field(default_factory=itertools.count)
+    _condition: threading.Condition = field(default_factory=threading.Condition)
+    _thread: Optional[threading.Thread] = None
+    _executor: Optional["ThreadPoolExecutor"] = None
+
+    def add(self, job: Job) -> Job:
+        """Schedule a job, return it as its handle"""
+        delay = job.delay if job.delay is not None else job.interval
+        assert delay is not None
+        with self._condition:
+            job._scheduler = self
+            job._generation += 1
+            job._added_at = time.monotonic()
+            self._push(job, job._added_at + delay)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="hassquitto-scheduler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return job
+
+    def remove(self, job: Job):
+        """Unschedule a job, it can be added again"""
+        with self._condition:
+            # Heap entries of older generations are dropped when they surface.
+            job._generation += 1
+            job.next_run_at = None
+            job._queued = False
+
+    def reschedule(self, job: Job, delay: float):
+        """Move the next run of a scheduled job, later runs follow its interval"""
+        with self._condition:
+            if job.next_run_at is None:
+                return
+            job._generation += 1
+            self._push(job, time.monotonic() + delay)
+            self._condition.notify()
+
+    def call_later(self, delay: float, func: Callable) -> Job:
+        return self.add(Job(func=func, delay=delay))
+
+    def every(
+        self, interval: float, func: Callable, offset: Optional[float] = None
+    ) -> Job:
+        return self.add(Job(func=func, interval=interval, delay=offset))
+
+    def __len__(self) -> int:
+        with self._condition:
+            return sum(1 for entry in self._heap if entry[2] == entry[3]._generation)
+
+    def _push(self, job: Job, run_at: float):
+        job.next_run_at = run_at
+        heapq.heappush(self._heap, (run_at, next(self._counter), job._generation, job))
+
+    def _run(self):
+        while True:
+            pool = self._pool()
+            for run in self._take_due():
+                if run[0].inline:
+                    self._execute(*run)
+                else:
+                    pool.submit(self._execute, *run)
+
+    def _take_due(self) -> list:
+        """Wait for due jobs and reschedule them, the lock is not held to run them"""
+        with self._condition:
+            while True:
+                due: list = []
+                now = time.monotonic()
+                self._expire(now)
+                while self._heap:
+                    run_at, _, generation, job = self._heap[0]
+                    if generation != job._generation:
+                        heapq.heappop(self._heap)
+                        continue
+                    if run_at > now:
+                        break
+                    heapq.heappop(self._heap)
+                    next_run_at = job.next_run_after(run_at, now)
+                    if next_run_at is not None:
+                        self._push(job, next_run_at)
+                    else:
+                        job.next_run_at = None
+                    if job._running:
+                        self._overrun(job)
+                    elif job._abandoned:
+                        self._stuck(job)
+                    else:
+                        due.append(self._start(job, run_at))
+                if due:
+                    return due
+                wake_at = min(
+                    self._heap[0][0] if self._heap else float("inf"),
+                    self._deadlines[0][0] if self._deadlines else float("inf"),
+                )
+                self._condition.wait(None if wake_at == float("inf") else wake_at - now)
+
+    def _start(self, job: Job, run_at: float) -> tuple:
+        """Mark a run started, return the arguments of _execute"""
+        job._running = True
+        job._run_id += 1
+        job._cancel = threading.Event()
+        if job.timeout:
+            heapq.heappush(
+                self._deadlines,
+                (time.monotonic() + job.timeout, next(self._counter), job._run_id, job),
+            )
+        return (job, run_at, job._run_id, job._cancel)
+
+    def _overrun(self, job: Job):
+        if job.overrun == "queue":
+            job._queued = True
+        elif job.overrun == "cancel":
+            logger.warning("Job %s overran, cancelling the previous run.", job.name)
+            self._abandon(job)
+            # Starts once the cancelled run returned.
+            job._queued = True
+        else:
+            job.skipped += 1
+            logger.warning("Job %s still running, skipped a run.", job.name)
+
+    @staticmethod
+    def _stuck(job: Job):
+        job.skipped += 1
+        logger.warning("Job %s is stuck in an abandoned run, skipped a run.", job.name)
+
+    def _expire(self, now: float):
+        """Abandon runs past their deadline"""
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, run_id, job = heapq.heappop(self._deadlines)
+            if job._running and job._run_id == run_id:
+                job.timed_out += 1
+                job._problem = "timed out"
+                logger.warning("Job %s timed out after %ss.", job.name, job.timeout)
+                self._abandon(job)
+
+    def _abandon(self, job: Job):
+        assert job._cancel
+        job._cancel.set()
+        job._running = False
+        job._abandoned += 1
+
+    def _execute(self, job: Job, run_at: float, run_id: int, cancel: threading.Event):
+        started_at = time.monotonic()
+        before = job.snapshot() if job.snapshot and job.adaptive else None
+        problem = None
+        try:
+            with running_job(job, cancel):
+                job.func()
+        except JobCancelled:
+            logger.info("Job %s stopped.", job.name)
+        except Exception:  # pylint: disable = broad-except
+            job.failed += 1
+            problem = "failed"
+            logger.exception("Job %s failed.", job.name)
+        finished_at = time.monotonic()
+        if job.snapshot and job.adaptive and not cancel.is_set():
+            self._adapt(job, run_at, job.snapshot() != before)
+        with self._condition:
+            job.record_run(run_at, started_at, finished_at)
+            if job._run_id != run_id or not job._running:
+                # Abandoned, a run queued behind it starts once none is left.
+                job._abandoned -= 1
+                if job._abandoned or job._running or not job._queued:
+                    return
+            else:
+                job._running = False
+                if cancel.is_set():
+                    return  # Cancelled with the job, not a completion.
+                job._problem = problem
+                job.last_finished_at = finished_at
+                if not job._queued:
+                    return
+            job._queued = False
+            run = self._start(job, finished_at)
+        self._pool().submit(self._execute, *run)
+
+    def _adapt(self, job: Job, run_at: float, changed: bool):
+        with self._condition:
+            if not job.adapt(changed) or job.next_run_at is None:
+                return
+            assert job.interval
+            job._generation += 1
+            self._push(job, max(run_at + job.interval, time.monotonic()))
+            self._condition.notify()
+
+    def _pool(self) -> "ThreadPoolExecutor":
+        if self._executor is None:
+            # pylint: disable = import-outside-toplevel
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="hassquitto-job"
+            )
+        return self._executor
+
+
+_scheduler: Optional[Scheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def default_scheduler() -> Scheduler:
+    """Process wide scheduler, created on first use."""
+    global _scheduler  # pylint: disable = global-statement
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
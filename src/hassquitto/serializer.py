@@ -0,0 +1,58 @@
+"""
+JSON serialization
+
+Discovery configs, dict states and attributes are encoded with dumps(),
+compact and UTF-8, straight to bytes. orjson is used when installed and
+gives the same bytes as the stdlib for the payloads sent here, except for
+floats in exponent notation and NaN or infinity. Values orjson can not
+encode, e.g. dicts with int keys, fall back to the stdlib.
+
+Callers look up serializer.dumps on every call, so set_serializer() takes
+effect everywhere.
+"""
+import json
+from typing import Any, Callable, Optional
+
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def dumps_stdlib(value: Any) -> bytes:
+    """Encode with the json module"""
+    return _encoder.encode(value).encode()
+
+
+def _orjson_dumps() -> Optional[Callable[[Any], bytes]]:
+    try:
+        import orjson  # pylint: disable = import-outside-toplevel
+    except ImportError:
+        return None
+    fast = orjson.dumps
+
+    def dumps_orjson(value: Any) -> bytes:
+        """Encode with orjson, with the stdlib as fallback"""
+        try:
+            return fast(value)
+        except TypeError:
+            return dumps_stdlib(value)
+
+    return dumps_orjson
+
+
+def set_serializer(func: Optional[Callable[[Any], bytes]] = None):
+    """
+    Replace the JSON encoder.
+
+    Payloads already cached, e.g. discovery configs, are not re-encoded.
+
+    Args:
+        func (optional): Function encoding a value to JSON bytes, the default
+            (orjson if installed, else the stdlib) if not set.
+    """
+    global dumps  # pylint: disable = global-statement, invalid-name
+    dumps = func or _orjson_dumps() or dumps_stdlib
+
+
+def dumps(value: Any) -> bytes:
+    """Encode a value to JSON bytes, picking the encoder on first use"""
+    set_serializer()
+    return dumps(value)
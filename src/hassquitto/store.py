@@ -0,0 +1,117 @@
+"""
+Persistent state store
+"""
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Optional
+
+from .logging import get_logger
+
+if TYPE_CHECKING:
+    import sqlite3
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True, eq=False)
+class StateStore:
+    """
+    Last published state and time of every entity, kept in SQLite.
+
+    Stored states are read once on creation. Recording a state only updates
+    a dict, a background thread writes the changes in one transaction every
+    flush_interval seconds.
+
+    Args:
+        path: Database file.
+        flush_interval (optional): Seconds between batched writes.
+    """
+
+    path: str
+    flush_interval: float = 5.0
+    written: int = 0
+    _states: dict = field(default_factory=dict)
+    _dirty: dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _stopping: threading.Event = field(default_factory=threading.Event)
+    _thread: Optional[threading.Thread] = None
+    _connection: Optional["sqlite3.Connection"] = None
+
+    def __post_init__(self):
+        connection = self._open()
+        for key, state, updated_at in connection.execute(
+            "SELECT key, state, updated_at FROM states"
+        ):
+            self._states[key] = (json.loads(state), updated_at)
+        logger.debug("Loaded %s stored states from %s.", len(self._states), self.path)
+
+    def _open(self) -> "sqlite3.Connection":
+        """Connect to the database, again after close()"""
+        import sqlite3  # pylint: disable = import-outside-toplevel
+
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS states"
+                " (key TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._connection
+
+    def get(self, key: str) -> Optional[tuple]:
+        """Stored (state, updated_at) of an entity, None if unknown"""
+        return self._states.get(key)
+
+    def record(self, key: str, state: Any):
+        """Remember a published state, written with the next batch"""
+        if isinstance(state, bytes):
+            state = state.decode()
+        value = (state, time.time())
+        with self._lock:
+            self._states[key] = self._dirty[key] = value
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="hassquitto-store", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write recorded states now"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        with self._open() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO states (key, state, updated_at)"
+                " VALUES (?, ?, ?)",
+                [
+                    (key, json.dumps(state), updated_at)
+                    for key, (state, updated_at) in dirty.items()
+                ],
+            )
+        self.written += len(dirty)
+
+    def close(self):
+        """Stop the writer, write what is left and close the database"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
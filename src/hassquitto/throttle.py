@@ -0,0 +1,130 @@
+"""
+Publish rate limiting
+"""
+import heapq
+import itertools
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from .logging import get_logger
+from .results import PublishResult
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(kw_only=True)
+class Coalescer:
+    """
+    Latest-wins publish queue for rate limited entities.
+
+    Each entity holds at most one pending state; a newer state replaces it.
+    A single flusher thread sends pending states once the entity's window
+    opens, so memory is bounded by the number of entities.
+    """
+
+    _heap: list = field(default_factory=list)
+    _counter: itertools.count = field(default_factory=itertools.count)
+    _condition: threading.Condition = field(default_factory=threading.Condition)
+    _thread: Optional[threading.Thread] = None
+
+    def admit(
+        self,
+        entity: Any,
+        state,
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+    ) -> Optional[PublishResult]:
+        """
+        Return None if the entity may publish now, else keep state pending.
+
+        The returned pending result resolves once the latest pending state
+        of the entity is sent, states replacing each other share it.
+
+        Args:
+            entity: Entity with max_rate set.
+            state: Serialized state.
+            qos (optional): QoS to send the state with.
+            retain (optional): Retain flag to send the state with.
+        """
+        now = time.monotonic()
+        with self._condition:
+            if entity._pending is None and now >= entity._next_send_at:
+                entity._next_send_at = now + 1 / entity.max_rate
+                return None
+            if entity._pending is not None:
+                entity.coalesced_count += 1
+                result = entity._pending[3]
+            else:
+                heapq.heappush(
+                    self._heap, (entity._next_send_at, next(self._counter), entity)
+                )
+                self._ensure_thread()
+                self._condition.notify()
+                result = PublishResult(pending=True)
+            entity._pending = (state, qos, retain, result)
+            return result
+
+    def take(self, entity: Any) -> Optional[PublishResult]:
+        """
+        Clear the pending state of an entity about to publish a forced one.
+
+        The forced state opens a new window, so the older pending state is
+        not sent after it. Returns the pending result, to be resolved with
+        the result of the forced publish, or None if nothing was pending.
+
+        Args:
+            entity: Entity with max_rate set.
+        """
+        with self._condition:
+            entity._next_send_at = time.monotonic() + 1 / entity.max_rate
+            if entity._pending is None:
+                return None
+            result = entity._pending[3]
+            entity._pending = None
+            return result
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="hassquitto-coalescer", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                due, _, entity = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                if entity._pending is None or due != entity._next_send_at:
+                    continue  # Taken by a forced publish.
+                state, qos, retain, result = entity._pending
+                entity._pending = None
+                entity._next_send_at = now + 1 / entity.max_rate
+            sent = None
+            try:
+                sent = entity._send(state, qos=qos, retain=retain)
+            except Exception:  # pylint: disable = broad-except
+                logger.exception("Entity %s failed to publish state.", entity.name)
+            result._resolve(sent)
+
+
+_coalescer: Optional[Coalescer] = None
+_coalescer_lock = threading.Lock()
+
+
+def default_coalescer() -> Coalescer:
+    """Process wide coalescer, created on first use."""
+    global _coalescer  # pylint: disable = global-statement
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = Coalescer()
+        return _coalescer
@@ -1,27 +1,100 @@
-from dataclasses import dataclass
+import sys
+
+
+_DEFAULTS = (
+    ("_availability", "availability"),
+    ("_config", "config"),
+    ("_command", "command"),
+    ("_state", "state"),
+    ("_attributes", "attributes"),
+)
 
 
-@dataclass
 class Topics:
     """
     Entity MQTT Topics
 
+    Topics are built on first access and kept as interned strings.
+
     Args:
         base: Base topic.
         availability (optional): Availability topic.
         config (optional): Config topic.
         command (optional): Command topic.
         state (optional): State topic.
+        attributes (optional): JSON attributes topic.
     """
 
-    base: str
-    availability: str = ""
-    config: str = ""
-    command: str = ""
-    state: str = ""
-
-    def __post_init__(self):
-        self.availability = self.availability or f"{self.base}/availability"
-        self.config = self.config or f"{self.base}/config"
-        self.command = self.command or f"{self.base}/command"
-        self.state = self.state or f"{self.base}/state"
+    __slots__ = (
+        "base",
+        "_availability",
+        "_config",
+        "_command",
+        "_state",
+        "_attributes",
+    )
+
+    def __init__(
+        self,
+        base: str,
+        availability: str = "",
+        config: str = "",
+        command: str = "",
+        state: str = "",
+        attributes: str = "",
+    ):
+        self.base = sys.intern(base)
+        self._availability = availability
+        self._config = config
+        self._command = command
+        self._state = state
+        self._attributes = attributes
+
+    @property
+    def availability(self) -> str:
+        if not self._availability:
+            self._availability = sys.intern(f"{self.base}/availability")
+        return self._availability
+
+    @property
+    def config(self) -> str:
+        if not self._config:
+            self._config = sys.intern(f"{self.base}/config")
+        return self._config
+
+    @property
+    def command(self) -> str:
+        if not self._command:
+            self._command = sys.intern(f"{self.base}/command")
+        return self._command
+
+    @property
+    def state(self) -> str:
+        if not self._state:
+            self._state = sys.intern(f"{self.base}/state")
+        return self._state
+
+    @property
+    def attributes(self) -> str:
+        if not self._attributes:
+            self._attributes = sys.intern(f"{self.base}/attributes")
+        return self._attributes
+
+    def __eq__(self, other):
+        if not isinstance(other, Topics):
+            return NotImplemented
+        if self.base != other.base:
+            return False
+        # Compares without building topics, an unset one is its default.
+        for name, suffix in _DEFAULTS:
+            mine, theirs = getattr(self, name), getattr(other, name)
+            if mine != theirs and (mine or f"{self.base}/{suffix}") != (
+                theirs or f"{self.base}/{suffix}"
+            ):
+                return False
+        return True
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return f"Topics(base={self.base!r})"
@@ -0,0 +1,287 @@
+"""
+Transports
+
+A Device talks to its broker through a transport: any object with the part
+of the paho Client interface below. paho's Client is the default, the
+loopback transport delivers messages to subscribers in the same process.
+"""
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Protocol, Union
+
+from .logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class Transport(Protocol):
+    """Interface of the MQTT client used by Device and Entity"""
+
+    on_connect: Optional[Callable]
+    on_connect_fail: Optional[Callable]
+    on_disconnect: Optional[Callable]
+    on_message: Optional[Callable]
+
+    def username_pw_set(self, username: str, password: Optional[str] = None):
+        ...
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        ...
+
+    def connect(self, host: str, port: int = 1883) -> int:
+        ...
+
+    def reconnect(self) -> int:
+        ...
+
+    def reconnect_delay_set(self, min_delay: float = 1, max_delay: float = 120):
+        ...
+
+    def loop_start(self):
+        ...
+
+    def loop_stop(self):
+        ...
+
+    def disconnect(self):
+        ...
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        ...
+
+    def subscribe(self, topic: Union[str, list], qos: int = 0):
+        ...
+
+    def unsubscribe(self, topic: Union[str, list]):
+        ...
+
+    def message_callback_add(self, sub: str, callback: Callable):
+        ...
+
+    def message_callback_remove(self, sub: str):
+        ...
+
+
+def topic_matches(sub: str, topic: str) -> bool:
+    """Whether a topic matches a subscription filter with + and # wildcards"""
+    if sub == topic:
+        return True
+    sub_levels = sub.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class LoopbackMessage:
+    """Message as delivered by paho, sharing one payload between subscribers"""
+
+    __slots__ = ("topic", "payload", "qos", "retain", "mid")
+
+    def __init__(self, topic: str, payload: bytes, qos: int, retain: bool, mid: int):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+
+
+class LoopbackInfo:
+    """Publish result, delivered by the time it is returned"""
+
+    __slots__ = ("mid",)
+    rc = 0
+
+    def __init__(self, mid: int):
+        self.mid = mid
+
+    def wait_for_publish(self, timeout: Optional[float] = None):
+        pass
+
+    def is_published(self) -> bool:
+        return True
+
+
+@dataclass(kw_only=True, eq=False)
+class LoopbackBroker:
+    """
+    In-process broker shared by loopback transports.
+
+    Keeps retained messages and routes each publish to matching subscribers
+    in the publishing thread. Payloads are not copied: bytes are delivered
+    as published, other values are encoded once like paho does.
+    """
+
+    retained: dict = field(default_factory=dict)
+    published: int = 0
+    _exact: dict = field(default_factory=dict)
+    _wildcards: dict = field(default_factory=dict)
+    _lock: threading.RLock = field(default_factory=threading.RLock)
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode()
+        with self._lock:
+            self.published += 1
+            message = LoopbackMessage(topic, payload, qos, retain, self.published)
+            if retain:
+                if payload:
+                    self.retained[topic] = message
+                else:
+                    self.retained.pop(topic, None)
+            subscribers = set(self._exact.get(topic, ()))
+            for sub, transports in self._wildcards.items():
+                if topic_matches(sub, topic):
+                    subscribers.update(transports)
+        # Live messages are not flagged retained, like on a real broker.
+        live = LoopbackMessage(topic, payload, qos, False, message.mid)
+        for transport in subscribers:
+            transport._deliver(live)
+        return LoopbackInfo(message.mid)
+
+    def subscribe(self, transport: "LoopbackTransport", subs: list):
+        """Add subscriptions, return the retained messages they match"""
+        retained = []
+        with self._lock:
+            for sub in subs:
+                if "+" in sub or "#" in sub:
+                    self._wildcards.setdefault(sub, set()).add(transport)
+                    retained.extend(
+                        message
+                        for topic, message in self.retained.items()
+                        if topic_matches(sub, topic)
+                    )
+                else:
+                    self._exact.setdefault(sub, set()).add(transport)
+                    if sub in self.retained:
+                        retained.append(self.retained[sub])
+        return retained
+
+    def unsubscribe(self, transport: "LoopbackTransport", subs: list):
+        with self._lock:
+            for sub in subs:
+                table = self._wildcards if "+" in sub or "#" in sub else self._exact
+                transports = table.get(sub)
+                if transports:
+                    transports.discard(transport)
+                    if not transports:
+                        del table[sub]
+
+
+_default_broker: Optional[LoopbackBroker] = None
+
+
+def default_broker() -> LoopbackBroker:
+    """Process-wide loopback broker"""
+    global _default_broker  # pylint: disable = global-statement
+    if _default_broker is None:
+        _default_broker = LoopbackBroker()
+    return _default_broker
+
+
+@dataclass(kw_only=True, eq=False)
+class LoopbackTransport:
+    """
+    Transport exchanging messages with other loopback transports in-process.
+
+    Messages are delivered to subscribers synchronously, without sockets or
+    a broker, e.g. between devices and a local automation engine or tests.
+
+    Args:
+        broker (optional): Broker to attach to, the process-wide one if not set.
+        client_id (optional): Identifier, for logging only.
+    """
+
+    broker: LoopbackBroker = field(default_factory=default_broker)
+    client_id: str = ""
+    on_connect: Optional[Callable] = None
+    on_connect_fail: Optional[Callable] = None
+    on_disconnect: Optional[Callable] = None
+    on_message: Optional[Callable] = None
+    userdata: Any = None
+    _connected: threading.Event = field(default_factory=threading.Event)
+    _subscriptions: set = field(default_factory=set)
+    _callbacks: dict = field(default_factory=dict)
+
+    def username_pw_set(self, username: str, password: Optional[str] = None):
+        pass
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        # In-process connections do not drop, the will is never published.
+        pass
+
+    def connect(self, host: str = "localhost", port: int = 1883, **_kwargs) -> int:
+        logger.debug("Loopback transport %s connected.", self.client_id)
+        self._connected.set()
+        if self.on_connect:
+            self.on_connect(self, self.userdata, {}, 0)
+        return 0
+
+    def reconnect(self) -> int:
+        return self.connect()
+
+    def reconnect_delay_set(self, min_delay: float = 1, max_delay: float = 120):
+        # In-process connections do not drop.
+        pass
+
+    def loop_start(self):
+        # Delivery happens in the publishing thread, there is no network loop.
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def loop_misc(self) -> int:
+        # Keepalives are not needed in-process.
+        return 0 if self._connected.is_set() else 4  # MQTT_ERR_NO_CONN
+
+    def disconnect(self):
+        self._connected.clear()
+        self.broker.unsubscribe(self, list(self._subscriptions))
+        self._subscriptions.clear()
+        if self.on_disconnect:
+            self.on_disconnect(self, self.userdata, 0)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        return self.broker.publish(topic, payload, qos=qos, retain=retain)
+
+    def subscribe(self, topic: Union[str, list], qos: int = 0):
+        subs = [sub for sub, _qos in topic] if isinstance(topic, list) else [topic]
+        self._subscriptions.update(subs)
+        for message in self.broker.subscribe(self, subs):
+            self._deliver(message)
+        return (0, self.broker.published)
+
+    def unsubscribe(self, topic: Union[str, list]):
+        subs = topic if isinstance(topic, list) else [topic]
+        self._subscriptions.difference_update(subs)
+        self.broker.unsubscribe(self, subs)
+        return (0, self.broker.published)
+
+    def message_callback_add(self, sub: str, callback: Callable):
+        self._callbacks[sub] = callback
+
+    def message_callback_remove(self, sub: str):
+        self._callbacks.pop(sub, None)
+
+    def _deliver(self, message: LoopbackMessage):
+        callback = self._callbacks.get(message.topic)
+        if callback is None:
+            for sub, candidate in self._callbacks.items():
+                if topic_matches(sub, message.topic):
+                    callback = candidate
+                    break
+            else:
+                callback = self.on_message
+        if callback:
+            callback(self, self.userdata, message)
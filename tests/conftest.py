@@ -0,0 +1,36 @@
+import pytest
+
+import hassquitto as hq
+
+
+class Recorder:
+    """Loopback subscriber keeping every message it receives"""
+
+    def __init__(self, broker: hq.LoopbackBroker, sub: str = "#"):
+        self.messages = []
+        self.client = hq.LoopbackTransport(broker=broker, client_id="recorder")
+        self.client.on_message = self._on_message
+        self.client.connect()
+        self.client.subscribe(sub)
+        self.messages.clear()  # Retained ones.
+
+    def _on_message(self, _client, _userdata, message):
+        self.messages.append((message.topic, message.payload.decode()))
+
+    def payloads(self, topic: str) -> list:
+        return [payload for found, payload in self.messages if found == topic]
+
+
+@pytest.fixture
+def broker():
+    return hq.LoopbackBroker()
+
+
+@pytest.fixture
+def recorder(broker):
+    return Recorder(broker)
+
+
+@pytest.fixture
+def client(broker):
+    return hq.LoopbackTransport(broker=broker)
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import threading
+import time
+
+import hassquitto as hq
+from hassquitto.scheduler import JobCancelled, sleep
+
+
+class Thermostat(hq.AsyncDevice):
+    temperature = hq.Sensor(name="Temperature", unit_of_measurement="°C")
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+def test_connect_without_credentials(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        await device.connect()
+        assert device._connected.is_set()
+        await device.disconnect()
+
+    run(main())
+
+
+def test_states_published_before_connect_are_buffered(client, recorder):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        result = device.publish_state("ON")
+        assert result.pending
+        await device.connect()
+        assert await result
+        assert recorder.payloads(device.topics.state)[-1] == "ON"
+        await device.disconnect()
+
+    run(main())
+
+
+def test_entity_send_discovery_is_awaitable(client, recorder):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        await device.connect()
+        recorder.messages.clear()
+        device.temperature.initial_state = "21"
+        await device.temperature.send_discovery()
+        config = recorder.payloads(device.temperature.topics.config)
+        assert json.loads(config[-1])["unique_id"] == device.temperature.object_id
+        assert recorder.payloads(device.temperature.topics.state)
+        await device.temperature.destroy_discovery()
+        assert recorder.payloads(device.temperature.topics.config)[-1] == ""
+        await device.disconnect()
+
+    run(main())
+
+
+def test_discovery_manifest_skips_unchanged_configs(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        await device.connect()
+        report = await device.send_discovery()
+        assert report.unchanged and not report.added
+        await device.disconnect()
+
+    run(main())
+
+
+class Lamp(hq.AsyncDevice):
+    switch = hq.Button(name="Switch")
+    dimmer = hq.Number(name="Dimmer")
+
+
+def test_commands_run_in_order_off_the_loop(client):
+    async def main():
+        device = Lamp(name="Async Lamp", client=client)
+        seen = []
+        loop_thread = threading.get_ident()
+
+        @device.switch.on_command
+        def on_switch(payload):
+            time.sleep(0.01 * (3 - int(payload)))
+            seen.append((payload, threading.get_ident() != loop_thread))
+
+        @device.dimmer.on_command
+        async def on_dimmer(payload):
+            await asyncio.sleep(0.01)
+            seen.append(("dimmer " + payload, True))
+
+        await device.connect()
+        for payload in "123":
+            client.publish(device.switch.topics.command, payload)
+        client.publish(device.dimmer.topics.command, "5")
+        while len(seen) < 4:
+            await asyncio.sleep(0.01)
+        assert [payload for payload, _ in seen if payload != "dimmer 5"] == list("123")
+        assert all(off_loop for _, off_loop in seen)
+        assert device.commands.stats()["processed"] == 4
+        await device.disconnect()
+
+    run(main())
+
+
+def test_full_command_queue_drops(client):
+    async def main():
+        device = Lamp(name="Async Lamp", client=client, command_queue_size=2)
+        started = asyncio.Event()
+
+        @device.switch.on_command
+        async def on_switch(_payload):
+            started.set()
+            await asyncio.sleep(1)
+
+        await device.connect()
+        for payload in "1234":
+            client.publish(device.switch.topics.command, payload)
+        assert device.commands.dropped == 2
+        await device.disconnect()
+
+    run(main())
+
+
+def test_jobs_keep_stats_and_skip_overruns(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+
+        async def slow():
+            await asyncio.sleep(0.12)
+
+        job = device.add_job(slow, interval=0.05, delay=0)
+        await device.connect()
+        await asyncio.sleep(0.3)
+        await device.disconnect()
+        assert job.runs >= 2
+        assert job.skipped >= 2
+        assert device.job_stats()["slow"]["runs"] == job.runs
+        assert job.next_run_at is None
+
+    run(main())
+
+
+def test_cancel_overrun_caps_runs(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        finished = []
+
+        async def stuck():
+            await asyncio.sleep(1)
+            finished.append(True)
+
+        job = device.add_job(stuck, interval=0.05, delay=0, overrun="cancel")
+        await device.connect()
+        await asyncio.sleep(0.2)
+        await device.disconnect()
+        assert job.runs >= 3 and not finished
+        assert job.skipped == 0
+
+    run(main())
+
+
+def test_timed_out_job_is_a_problem(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client, job_watchdog=True)
+        stopped = threading.Event()
+
+        @device.on_interval(seconds=0.05, offset=0, timeout=0.05)
+        def hang():
+            try:
+                sleep(1)
+            except JobCancelled:
+                stopped.set()
+                raise
+
+        await device.connect()
+        await asyncio.sleep(0.1)
+        assert await asyncio.to_thread(device.check_jobs) == {"hang": "timed out"}
+        assert await asyncio.to_thread(stopped.wait, 1)
+        await device.disconnect()
+
+    run(main())
+
+
+def test_poll_now_runs_an_adaptive_poll(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        polled = []
+
+        @device.on_poll(min_seconds=60, max_seconds=120)
+        async def poll():
+            polled.append(time.monotonic())
+
+        await device.connect()
+        await asyncio.to_thread(device.poll_now)
+        await asyncio.sleep(0.05)
+        assert len(polled) == 1
+        (job,) = device._scheduled_jobs
+        assert job.interval == 120  # Nothing changed, backed off.
+        await device.disconnect()
+
+    run(main())
+
+
+def test_trigger_runs_an_async_job_now(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client)
+        ran = asyncio.Event()
+
+        async def tick():
+            ran.set()
+
+        job = device.add_job(tick, interval=60)
+        await device.connect()
+        await asyncio.to_thread(job.trigger)
+        await asyncio.wait_for(ran.wait(), 1)
+        assert job.runs == 1 and job.next_run_at > time.monotonic() + 50
+        await device.disconnect()
+
+    run(main())
+
+
+def test_stuck_thread_job_is_skipped_not_doubled(client):
+    async def main():
+        device = Thermostat(name="Async Thermostat", client=client, job_watchdog=True)
+        release = threading.Event()
+        job = device.add_job(release.wait, interval=0.02, delay=0, timeout=0.01)
+        await device.connect()
+        await asyncio.sleep(0.15)
+        assert job.problem() == "stuck" and job.skipped >= 3
+        assert device.check_jobs() == {"wait": "stuck"}
+        release.set()
+        await asyncio.sleep(0.1)
+        assert job.problem() != "stuck"
+        await device.disconnect()
+
+    run(main())
@@ -0,0 +1,80 @@
+import pytest
+
+import hassquitto as hq
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power")
+
+
+@pytest.mark.parametrize("device_discovery", [False, True])
+def test_entity_availability_is_sent_once_per_connect(
+    client, recorder, device_discovery
+):
+    device = Meter(name="Meter", client=client, device_discovery=device_discovery)
+    device.connect()
+    topic = device.power.topics.availability
+    assert recorder.payloads(topic) == ["online"]
+    client.publish("homeassistant/status", "online")
+    device._rediscovery.join()
+    assert recorder.payloads(topic) == ["online"]
+    device.disconnect()
+    device.connect()
+    assert recorder.payloads(topic) == ["online", "online"]
+
+
+def test_offline_entity_is_online_after_restart(broker):
+    device = Meter(name="Meter", client=hq.LoopbackTransport(broker=broker))
+    device.connect()
+    device.power.set_not_available()
+    device.disconnect()
+    device = Meter(name="Meter", client=hq.LoopbackTransport(broker=broker))
+    device.connect()
+    assert broker.retained[device.power.topics.availability].payload == b"online"
+
+
+def test_new_entity_goes_online(broker, recorder):
+    device = Meter(name="Meter", client=hq.LoopbackTransport(broker=broker))
+    device.connect()
+    device.disconnect()
+
+    class Bigger(Meter):
+        energy = hq.Sensor(name="Energy")
+
+    bigger = Bigger(name="Meter", client=hq.LoopbackTransport(broker=broker))
+    bigger.connect()
+    assert recorder.payloads(bigger.energy.topics.availability) == ["online"]
+    assert recorder.payloads(bigger.power.topics.availability) == ["online"] * 2
+
+
+def test_hosted_device_goes_online_once(client, recorder):
+    hub = hq.Hub(name="Hub", client=client)
+    hosted = Meter(name="Hosted", hub=hub)
+    hub.connect()
+    client.publish("homeassistant/status", "online")
+    hub._rediscovery.join()
+    assert recorder.payloads(hosted.topics.availability) == ["online"]
+
+
+def test_removed_entity_availability_is_cleared(broker):
+    class Bigger(Meter):
+        energy = hq.Sensor(name="Energy")
+
+    bigger = Bigger(name="Meter", client=hq.LoopbackTransport(broker=broker))
+    bigger.connect()
+    energy = bigger.energy.topics.availability
+    bigger.disconnect()
+    device = Meter(name="Meter", client=hq.LoopbackTransport(broker=broker))
+    device.connect()
+    assert energy not in broker.retained
+    assert device.power.topics.availability in broker.retained
+
+
+def test_destroy_clears_entity_availability(client, broker):
+    hub = hq.Hub(name="Hub", client=client)
+    hosted = Meter(name="Hosted", hub=hub)
+    hub.connect()
+    hub.destroy_discovery()
+    assert hosted.power.topics.availability not in broker.retained
+    assert hosted.topics.availability not in broker.retained
+    assert hub.topics.availability in broker.retained
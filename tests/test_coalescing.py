@@ -0,0 +1,66 @@
+import json
+import time
+
+import hassquitto as hq
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power", max_rate=10)
+    energy = hq.Sensor(name="Energy", max_rate=10)
+
+
+def test_latest_state_wins(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    results = [device.power.publish_state(state) for state in range(5)]
+    assert hq.wait_all(results, timeout=1)
+    assert recorder.payloads(device.power.topics.state)[-2:] == ["0", "4"]
+    assert device.power.coalesced_count == 3
+
+
+def test_rate_is_kept_per_entity(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    started = time.monotonic()
+    for state in range(3):
+        device.power.publish_state(state).wait(1)
+    device.energy.publish_state(1)
+    assert recorder.payloads(device.energy.topics.state)[-1] == "1"
+    assert time.monotonic() - started >= 0.15
+
+
+def test_force_bypasses_the_rate_limit(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    device.power.publish_state(1)
+    assert device.power.publish_state(2, force=True).sent
+    assert recorder.payloads(device.power.topics.state)[-2:] == ["1", "2"]
+
+
+def test_forced_state_replaces_the_pending_one(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    device.power.publish_state(1)
+    pending = device.power.publish_state(2)
+    assert pending.pending
+    forced = device.power.publish_state(3, force=True)
+    assert pending.wait(1) and pending.mid == forced.mid
+    time.sleep(0.2)
+    assert recorder.payloads(device.power.topics.state)[-2:] == ["1", "3"]
+
+
+class SharedMeter(hq.Device):
+    power = hq.Sensor(name="Power", max_rate=10)
+
+
+def test_forced_shared_states_replace_pending_ones(client, recorder):
+    device = SharedMeter(name="Shared Meter", client=client, shared_state=True)
+    device.connect()
+    device.publish_states({"Power": 1})
+    pending = device.publish_states({"Power": 2})
+    assert pending.pending
+    forced = device.publish_states({"Power": 3}, force=True)
+    assert pending.wait(1) and pending.mid == forced.mid
+    time.sleep(0.2)
+    payloads = recorder.payloads(device.shared_state_topic())
+    assert [json.loads(payload)["power"] for payload in payloads[-2:]] == [1, 3]
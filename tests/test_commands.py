@@ -0,0 +1,45 @@
+import threading
+
+import hassquitto as hq
+
+
+class Lamp(hq.Device):
+    button = hq.Button(name="Button")
+
+
+def test_commands_run_in_order(client):
+    device = Lamp(name="Lamp", client=client)
+    seen = []
+    device.button.on_click(seen.append)
+    device.connect()
+    for payload in map(str, range(20)):
+        client.publish(device.button.topics.command, payload)
+    device.commands.shutdown(wait=True)
+    assert seen == list(map(str, range(20)))
+
+
+def test_full_queue_drops_by_default(client):
+    device = Lamp(name="Lamp", client=client, command_queue_size=2)
+    release = threading.Event()
+    device.button.on_click(lambda _payload: release.wait(5))
+    device.connect()
+    for payload in "12345":
+        client.publish(device.button.topics.command, payload)
+    assert device.commands.dropped >= 2
+    release.set()
+    device.commands.shutdown(wait=True)
+
+
+def test_birth_rediscovers_while_commands_are_stuck(client, recorder):
+    device = Lamp(name="Lamp", client=client, command_queue_size=1)
+    release = threading.Event()
+    device.button.on_click(lambda _payload: release.wait(5))
+    device.connect()
+    for payload in "123":
+        client.publish(device.button.topics.command, payload)
+    recorder.messages.clear()
+    client.publish("homeassistant/status", "online")
+    device._rediscovery.join(5)
+    assert recorder.payloads(device.manifest_topic())
+    release.set()
+    device.commands.shutdown(wait=True)
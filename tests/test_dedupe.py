@@ -0,0 +1,52 @@
+import hassquitto as hq
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power", only_changes=True, heartbeat=60)
+    voltage = hq.Sensor(name="Voltage", deadband=1.0)
+    current = hq.Sensor(name="Current", deadband_relative=0.1)
+    relay = hq.Switch(name="Relay")
+
+
+def test_unchanged_states_are_suppressed(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    for state in (1, 1, 2, 2, 1):
+        device.power.publish_state(state)
+    assert recorder.payloads(device.power.topics.state)[-3:] == ["1", "2", "1"]
+    assert device.power.suppressed_count == 2
+
+
+def test_duplicates_go_out_without_only_changes(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    device.relay.publish_state("ON")
+    device.relay.publish_state("ON")
+    assert recorder.payloads(device.relay.topics.state)[-2:] == ["ON", "ON"]
+
+
+def test_force_and_heartbeat_send_duplicates(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    device.power.publish_state(5)
+    device.power.publish_state(5, force=True)
+    device.power._last_published_at -= 61
+    device.power.publish_state(5)
+    device.power.publish_state(5)
+    assert recorder.payloads(device.power.topics.state)[-3:] == ["5", "5", "5"]
+    assert device.power.suppressed_count == 1
+
+
+def test_deadbands(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    for state in (230.0, 230.5, 231.5, 230.9):
+        device.voltage.publish_state(state)
+    for state in (10.0, 10.9, 11.2, "unknown"):
+        device.current.publish_state(state)
+    assert recorder.payloads(device.voltage.topics.state)[-2:] == ["230.0", "231.5"]
+    assert recorder.payloads(device.current.topics.state)[-3:] == [
+        "10.0",
+        "11.2",
+        "unknown",
+    ]
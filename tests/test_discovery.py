@@ -0,0 +1,155 @@
+import json
+
+import pytest
+
+import hassquitto as hq
+from hassquitto.discovery import MIGRATE_PAYLOAD, expand_config
+
+# Compact configs spelled with HomeAssistant's own abbreviations, see
+# homeassistant/components/mqtt/abbreviations.py, not with hassquitto's table.
+DEVICE = {"ids": ["meter"], "mf": "Acme", "mdl": "M1", "name": "Meter"}
+AVAILABILITY = [
+    {"t": "homeassistant/binary_sensor/meter/availability"},
+    {"t": "~/availability"},
+]
+POWER = {
+    "~": "homeassistant/sensor/meter_power",
+    "name": "Power",
+    "avty": AVAILABILITY,
+    "avty_mode": "all",
+    "stat_t": "~/state",
+    "obj_id": "meter_power",
+    "uniq_id": "meter_power",
+    "cmd_t": "~/command",
+    "qos": 1,
+    "dev_cla": "power",
+    "unit_of_meas": "W",
+}
+RELAY = {
+    "~": "homeassistant/switch/meter_relay",
+    "name": "Relay",
+    "avty": AVAILABILITY,
+    "avty_mode": "all",
+    "stat_t": "~/state",
+    "obj_id": "meter_relay",
+    "uniq_id": "meter_relay",
+    "cmd_t": "~/command",
+    "json_attr_t": "~/attributes",
+}
+ONLINE = {
+    "~": "homeassistant/binary_sensor/meter",
+    "name": "Online",
+    "avty": [{"t": "~/availability"}],
+    "avty_mode": "all",
+    "stat_t": "~/state",
+    "obj_id": "meter",
+    "uniq_id": "meter",
+    "ent_cat": "diagnostic",
+}
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(
+        name="Power", device_class="power", unit_of_measurement="W", qos=1
+    )
+    relay = hq.Switch(name="Relay", json_attributes=True)
+
+
+def meter(broker, **options) -> Meter:
+    device = Meter(
+        name="Meter",
+        client=hq.LoopbackTransport(broker=broker),
+        manufacturer="Acme",
+        model="M1",
+        **options,
+    )
+    device.connect()
+    return device
+
+
+def test_compact_entity_configs(broker):
+    device = meter(broker, compact_discovery=True)
+    assert json.loads(device.power.discovery_payload()) == {**POWER, "dev": DEVICE}
+    assert json.loads(device.relay.discovery_payload()) == {**RELAY, "dev": DEVICE}
+    assert json.loads(device.discovery_payload()) == {**ONLINE, "dev": DEVICE}
+
+
+def test_compact_device_config(broker):
+    device = meter(broker, compact_discovery=True, device_discovery=True)
+    assert json.loads(device.device_discovery_payload()) == {
+        "o": {"name": "hassquitto"},
+        "cmps": {
+            "meter": {**ONLINE, "p": "binary_sensor"},
+            "meter_power": {**POWER, "p": "sensor"},
+            "meter_relay": {**RELAY, "p": "switch"},
+        },
+        "dev": DEVICE,
+    }
+
+
+def test_compact_configs_expand_to_verbose_ones(broker):
+    verbose = meter(hq.LoopbackBroker())
+    compact = meter(broker, compact_discovery=True)
+    for entity in ("Power", "Relay"):
+        assert (
+            expand_config(compact.entities[entity].discovery_config())
+            == verbose.entities[entity].discovery_config()
+        )
+    assert expand_config(compact.discovery_config()) == verbose.discovery_config()
+    assert len(compact.power.discovery_payload()) < len(
+        verbose.power.discovery_payload()
+    )
+
+
+def test_unchanged_configs_are_skipped(broker):
+    device = meter(broker)
+    report = device.send_discovery()
+    assert not report.added and not report.changed
+    assert len(report.unchanged) == 3
+
+
+def test_config_cleared_by_others_is_added_again(broker, recorder):
+    device = meter(broker)
+    # HomeAssistant's "Delete device" clears the retained config.
+    recorder.client.publish(device.power.topics.config, "", retain=True)
+    report = device.send_discovery()
+    assert report.added == [device.power.topics.config]
+    assert device.power.topics.config in broker.retained
+
+
+def config_messages(recorder) -> list:
+    return [
+        (topic, payload)
+        for topic, payload in recorder.messages
+        if topic.endswith("/config")
+    ]
+
+
+@pytest.mark.parametrize("device_discovery", [False, True])
+def test_switching_discovery_mode_migrates_first(broker, recorder, device_discovery):
+    meter(broker, device_discovery=not device_discovery).disconnect()
+    old = {topic for topic, _payload in config_messages(recorder)}
+    recorder.messages.clear()
+    device = meter(broker, device_discovery=device_discovery)
+    new = set(device._config_topics())
+    kinds = {MIGRATE_PAYLOAD.decode(): "migrate", "": "clear"}
+    order = [
+        kinds.get(payload, "add")
+        for topic, payload in config_messages(recorder)
+        if topic in old or topic in new
+    ]
+    assert order == ["migrate"] * len(old) + ["add"] * len(new) + ["clear"] * len(old)
+    assert new <= broker.retained.keys()
+    assert not old & broker.retained.keys()
+
+
+@pytest.mark.parametrize("compact_discovery", [False, True])
+def test_removed_component_carries_only_its_platform(broker, compact_discovery):
+    device = meter(broker, device_discovery=True, compact_discovery=compact_discovery)
+    device.power.destroy_discovery()
+    message = broker.retained[device.device_discovery_topic()]
+    components = json.loads(message.payload)[
+        "cmps" if compact_discovery else "components"
+    ]
+    assert components[device.power.object_id] == {"platform": "sensor"}
+    assert len(components[device.relay.object_id]) > 1
@@ -0,0 +1,66 @@
+import json
+import threading
+
+import hassquitto as hq
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power")
+    reset = hq.Button(name="Reset")
+
+
+def hub_with_meters(client, count: int = 2):
+    hub = hq.Hub(name="Hub", client=client)
+    meters = [Meter(name=f"Meter {index}", hub=hub) for index in range(count)]
+    return hub, meters
+
+
+def test_devices_share_the_hub_connection(client):
+    hub, meters = hub_with_meters(client)
+    assert list(hub.devices) == [meter.object_id for meter in meters]
+    for meter in meters:
+        assert meter.client is client
+        assert meter.commands is hub.commands
+        assert meter.job_scheduler() is hub.job_scheduler()
+
+
+def test_hub_discovers_hosted_devices_via_itself(client, recorder):
+    hub, meters = hub_with_meters(client)
+    hub.connect()
+    for meter in meters:
+        config = json.loads(recorder.payloads(meter.power.topics.config)[-1])
+        assert config["device"]["via_device"] == hub.identifiers[0]
+        assert config["availability"][0]["topic"] == hub.topics.availability
+        assert recorder.payloads(meter.power.topics.availability) == ["online"]
+    hub.send_discovery()
+    assert all(
+        len(recorder.payloads(meter.power.topics.config)) == 1 for meter in meters
+    )
+
+
+def test_commands_reach_the_hosted_device(client, broker):
+    hub, meters = hub_with_meters(client)
+    pressed = threading.Event()
+    clicks = []
+
+    @meters[1].reset.on_click
+    def reset(_payload):
+        clicks.append(meters[1].name)
+        pressed.set()
+
+    hub.connect()
+    sender = hq.LoopbackTransport(broker=broker, client_id="sender")
+    sender.connect()
+    sender.publish(meters[1].reset.topics.command, "PRESS")
+    assert pressed.wait(1)
+    assert clicks == ["Meter 1"]
+
+
+def test_jobs_of_hosted_devices_run_on_the_hub(client):
+    hub, meters = hub_with_meters(client)
+    ran = threading.Event()
+    job = meters[0].add_job(ran.set, delay=0)
+    assert job in hub._scheduled_jobs
+    hub.connect()
+    assert ran.wait(1)
+    hub.disconnect()
@@ -0,0 +1,50 @@
+import hassquitto as hq
+
+clicks = []
+
+
+class Lamp(hq.Device):
+    button = hq.Button(name="Button")
+    power = hq.Sensor(name="Power")
+
+    @button.on_command
+    def pressed(payload):  # pylint: disable = no-self-argument
+        clicks.append(payload)
+
+
+def test_instances_keep_their_own_entities(broker, recorder):
+    kitchen = Lamp(name="Kitchen", client=hq.LoopbackTransport(broker=broker))
+    hall = Lamp(name="Hall", client=hq.LoopbackTransport(broker=broker))
+    assert kitchen.power is not hall.power
+    assert kitchen.power.device is kitchen and hall.power.device is hall
+    assert kitchen.entities["Power"] is kitchen.power
+    kitchen.connect()
+    hall.connect()
+    kitchen.power.publish_state(1)
+    hall.power.publish_state(2)
+    assert kitchen.power.topics.state != hall.power.topics.state
+    assert recorder.payloads(kitchen.power.topics.state) == ["1"]
+    assert recorder.payloads(hall.power.topics.state) == ["2"]
+
+
+def test_class_template_is_left_unchanged(client):
+    device = Lamp(name="Kitchen", client=client)
+    device.connect()
+    device.power.publish_state(3)
+    template = Lamp.__dict__["power"]
+    assert template.device is None
+    assert template.topics is None
+    assert template._last_state is None
+
+
+def test_template_handler_reaches_every_instance(broker):
+    clicks.clear()
+    devices = [
+        Lamp(name=name, client=hq.LoopbackTransport(broker=broker))
+        for name in ("Kitchen", "Hall")
+    ]
+    for device in devices:
+        device.connect()
+        broker.publish(device.button.topics.command, device.name)
+        device.commands.shutdown(wait=True)
+    assert clicks == ["Kitchen", "Hall"]
@@ -0,0 +1,61 @@
+import time
+
+from hassquitto.metrics import Metrics
+
+
+class Info:
+    """Message info acknowledged by the test"""
+
+    def __init__(self, mid: int, rc: int = 0, published: bool = False):
+        self.mid = mid
+        self.rc = rc
+        self.published = published
+
+    def is_published(self) -> bool:
+        if self.rc:
+            raise RuntimeError("Message publish failed.")
+        return self.published
+
+
+def test_ack_is_timed():
+    metrics = Metrics()
+    metrics.sent(Info(1), time.monotonic())
+    metrics.acked(1)
+    assert metrics.ack_time.count == 1
+    assert not metrics._pending
+
+
+def test_published_before_sent_is_timed_once():
+    metrics = Metrics()
+    info = Info(1, published=True)
+    metrics.acked(1)  # Raced the publish, nothing to time yet.
+    metrics.sent(info, time.monotonic())
+    assert metrics.ack_time.count == 1
+    assert not metrics._pending
+
+
+def test_failed_publish_is_not_kept():
+    metrics = Metrics()
+    metrics.sent(Info(1, rc=4), time.monotonic())
+    assert not metrics._pending
+    assert metrics.ack_time.count == 0
+
+
+def test_missed_acks_are_pruned():
+    metrics = Metrics()
+    metrics.MAX_PENDING = 10
+    infos = [Info(mid) for mid in range(10)]
+    for info in infos:
+        metrics.sent(info, time.monotonic())
+    for info in infos:
+        info.published = True  # Acknowledged without acked() finding them.
+    metrics.sent(Info(10), time.monotonic())
+    assert list(metrics._pending) == [10]
+
+
+def test_pending_is_bounded():
+    metrics = Metrics()
+    metrics.MAX_PENDING = 10
+    for mid in range(100):
+        metrics.sent(Info(mid), time.monotonic())
+    assert len(metrics._pending) <= 2 * metrics.MAX_PENDING
@@ -0,0 +1,109 @@
+import pytest
+
+import hassquitto as hq
+from hassquitto.offline import OfflineBuffer, backoff_delay
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power")
+    energy = hq.Sensor(name="Energy")
+
+
+def lose_connection(device: hq.Device):
+    device._on_disconnect(device.client, None, 1)
+
+
+def test_buffer_keeps_latest_per_topic():
+    buffer = OfflineBuffer(size=10)
+    first = buffer.put("a", "1")
+    buffer.put("b", "2")
+    assert buffer.put("a", "3", qos=1, retain=True) is first
+    messages = buffer.drain()
+    assert [message[:4] for message in messages] == [
+        ("b", "2", 0, False),
+        ("a", "3", 1, True),
+    ]
+    assert messages[1][4] is first and first.pending
+    assert len(buffer) == 0
+
+
+def test_buffer_drops_topic_updated_longest_ago():
+    buffer = OfflineBuffer(size=2)
+    results = [buffer.put(topic, topic) for topic in "abc"]
+    assert [topic for topic, *_ in buffer.drain()] == ["b", "c"]
+    assert buffer.dropped == 1
+    assert results[0].dropped and not results[0].wait(0)
+
+
+def test_buffer_survives_restart(tmp_path):
+    path = str(tmp_path / "offline.jsonl")
+    buffer = OfflineBuffer(size=10, path=path)
+    buffer.put("a", b"1")
+    buffer.put("a", "2")
+    buffer.put("b", "3")
+    assert OfflineBuffer(size=10, path=path).drain() == [
+        ("a", "2", 0, False, None),
+        ("b", "3", 0, False, None),
+    ]
+
+
+@pytest.mark.parametrize("attempt", range(10))
+def test_backoff_delay_is_jittered_and_capped(attempt):
+    cap = min(30.0, 2**attempt)
+    assert cap / 2 <= backoff_delay(attempt, 1.0, 30.0) <= cap
+
+
+def test_states_are_buffered_while_offline(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    lose_connection(device)
+    for state in range(3):
+        device.power.publish_state(state)
+    assert recorder.payloads(device.power.topics.state) == []
+    assert len(device.offline_buffer) == 1
+
+
+def test_buffered_states_go_out_before_fresh_ones(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    lose_connection(device)
+    device.power.publish_state(1)
+    client.connect()  # Reconnected, replays before going online.
+    device.power.publish_state(2)
+    assert recorder.payloads(device.power.topics.state) == ["1", "2"]
+    assert device._connects == 2
+
+
+def test_states_of_a_previous_run_follow_the_configs(broker, recorder, tmp_path):
+    path = str(tmp_path / "offline.jsonl")
+    OfflineBuffer(path=path).put("meter/extra", "kept")
+    device = Meter(
+        name="Meter",
+        client=hq.LoopbackTransport(broker=broker),
+        offline_buffer_path=path,
+    )
+    device.connect()
+    topics = [topic for topic, _payload in recorder.messages]
+    assert topics.index("meter/extra") > topics.index(device.manifest_topic())
+
+
+class Silent(hq.LoopbackTransport):
+    """Transport whose broker never answers the connect"""
+
+    stopped = 0
+
+    def connect(self, host: str = "localhost", port: int = 1883, **_kwargs) -> int:
+        return 0
+
+    def loop_stop(self):
+        self.stopped += 1
+
+
+def test_connect_without_connack_stops_the_network_loop(broker):
+    client = Silent(broker=broker)
+    device = Meter(name="Meter", client=client, connect_timeout=0.01)
+    for attempt in (1, 2):
+        with pytest.raises(ConnectionError):
+            device.connect()
+        assert client.stopped == attempt
+        assert device._stopping.is_set()
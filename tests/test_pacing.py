@@ -0,0 +1,76 @@
+import time
+
+import hassquitto as hq
+from hassquitto.pacing import PublishWindow
+
+
+class Info:
+    """Message info acknowledged once waited for, like a prompt broker"""
+
+    def __init__(self, client, mid: int):
+        self.client = client
+        self.mid = mid
+        self.published = False
+
+    def wait_for_publish(self, timeout=None):
+        self.client.events.append(("ack", self.mid))
+        self.published = True
+
+    def is_published(self) -> bool:
+        return self.published
+
+
+class Client:
+    def __init__(self):
+        self.events = []
+        self.mid = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.mid += 1
+        self.events.append(("publish", self.mid))
+        return Info(self, self.mid)
+
+
+def test_window_bounds_unacknowledged_publishes():
+    client = Client()
+    window = PublishWindow(client=client, size=2)
+    for _ in range(4):
+        window.publish("topic", "payload")
+    window.flush()
+    assert client.events == [
+        ("publish", 1),
+        ("publish", 2),
+        ("ack", 1),
+        ("publish", 3),
+        ("ack", 2),
+        ("publish", 4),
+        ("ack", 3),
+        ("ack", 4),
+    ]
+
+
+def test_window_paces_publishes():
+    window = PublishWindow(client=Client(), rate=100)
+    started = time.monotonic()
+    for _ in range(5):
+        window.publish("topic", "payload")
+    assert time.monotonic() - started >= 0.035
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power")
+    energy = hq.Sensor(name="Energy")
+
+
+def test_configs_are_acknowledged_before_states(client, recorder):
+    device = Meter(name="Meter", client=client, discovery_window=1)
+    device.connect()
+    topics = [topic for topic, _payload in recorder.messages]
+    configs = [
+        device.topics.config,
+        device.power.topics.config,
+        device.energy.topics.config,
+    ]
+    assert all(topic in topics for topic in configs)
+    last_config = max(topics.index(topic) for topic in configs)
+    assert topics.index(device.power.topics.availability) > last_config
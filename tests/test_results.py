@@ -0,0 +1,70 @@
+import asyncio
+
+import hassquitto as hq
+from hassquitto.results import NOT_SENT, PublishResult
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power", max_rate=20)
+
+
+class AsyncMeter(hq.AsyncDevice):
+    power = hq.Sensor(name="Power")
+    energy = hq.Sensor(name="Energy", max_rate=20)
+
+
+def test_pending_result_follows_the_actual_publish():
+    pending = PublishResult(pending=True)
+    assert pending.pending and not pending.is_published()
+    assert not pending.wait(0)
+    inner = PublishResult(pending=True)
+    pending._resolve(inner)
+    assert pending.pending
+    inner._resolve(NOT_SENT)
+    assert not pending.pending and pending.is_published()
+
+
+def test_dropped_result_is_not_published():
+    pending = PublishResult(pending=True)
+    pending._resolve(None)
+    assert pending.dropped and not pending.wait()
+    assert not hq.wait_all([NOT_SENT, pending])
+
+
+def test_coalesced_state_resolves_when_sent(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    assert device.power.publish_state(1).sent
+    second = device.power.publish_state(2)
+    third = device.power.publish_state(3)
+    assert third is second and second.pending
+    assert second.wait(1) and second.mid is not None
+    assert recorder.payloads(device.power.topics.state) == ["1", "3"]
+
+
+def test_buffered_state_resolves_on_replay(client, recorder):
+    device = Meter(name="Meter", client=client)
+    device.connect()
+    device._on_disconnect(client, None, 1)
+    result = device.power.publish_state(1, force=True)
+    assert result.pending
+    client.connect()
+    assert result.sent and result.is_published()
+
+
+def test_async_results_are_one_type(client):
+    async def main():
+        device = AsyncMeter(name="Meter", client=client)
+        await device.connect()
+        direct = device.power.publish_state(1)
+        device.energy.publish_state(1)
+        coalesced = device.energy.publish_state(2)
+        threaded = await asyncio.to_thread(device.power.publish_state, 2)
+        results = [direct, coalesced, threaded]
+        assert all(isinstance(result, PublishResult) for result in results)
+        assert await hq.gather(results, timeout=1)
+        assert await threaded is threaded and threaded.sent
+        assert await asyncio.to_thread(hq.wait_all, results, 1)
+        await device.disconnect()
+
+    asyncio.run(asyncio.wait_for(main(), 10))
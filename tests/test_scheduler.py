@@ -0,0 +1,203 @@
+import threading
+import time
+
+import hassquitto as hq
+from hassquitto.scheduler import AdaptiveInterval, Job, JobCancelled, Scheduler, sleep
+
+
+def wait_until(predicate, timeout: float = 1.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def test_one_shot_runs_once():
+    scheduler = Scheduler(workers=2)
+    runs = []
+    job = scheduler.call_later(0.01, lambda: runs.append(time.monotonic()))
+    assert wait_until(lambda: job.finished)
+    time.sleep(0.05)
+    assert len(runs) == 1 and len(scheduler) == 0
+
+
+def test_cancelled_one_shot_never_runs():
+    scheduler = Scheduler(workers=2)
+    ran = threading.Event()
+    job = scheduler.call_later(0.05, ran.set)
+    job.cancel()
+    assert not ran.wait(0.1)
+    assert job.finished and len(scheduler) == 0
+
+
+def test_interval_keeps_a_fixed_rate():
+    scheduler = Scheduler(workers=2)
+    runs = []
+    job = scheduler.every(0.02, lambda: runs.append(time.monotonic()), offset=0)
+    assert wait_until(lambda: len(runs) >= 5)
+    job.cancel()
+    gaps = [later - earlier for earlier, later in zip(runs, runs[1:])]
+    assert 0.01 < sum(gaps) / len(gaps) < 0.04
+
+
+def test_slow_job_does_not_delay_others():
+    scheduler = Scheduler(workers=2)
+    fast = []
+    slow = scheduler.every(0.01, lambda: time.sleep(0.2), offset=0)
+    job = scheduler.every(0.01, lambda: fast.append(1), offset=0)
+    assert wait_until(lambda: len(fast) >= 5, timeout=0.15)
+    slow.cancel()
+    job.cancel()
+
+
+def test_trigger_runs_now():
+    scheduler = Scheduler(workers=2)
+    ran = threading.Event()
+    job = scheduler.add(Job(func=ran.set, interval=60))
+    job.trigger()
+    assert ran.wait(1)
+    assert job.next_run_at is not None and job.next_run_at > time.monotonic() + 50
+    job.cancel()
+
+
+def test_overrun_policies():
+    scheduler = Scheduler(workers=4)
+    running = {}
+    overlaps = []
+
+    def run(policy):
+        running[policy] = running.get(policy, 0) + 1
+        overlaps.extend([policy] if running[policy] > 1 else [])
+        time.sleep(0.05)
+        running[policy] -= 1
+
+    jobs = {
+        policy: scheduler.add(
+            Job(func=lambda p=policy: run(p), interval=0.02, delay=0, overrun=policy)
+        )
+        for policy in ("skip", "queue", "cancel")
+    }
+    time.sleep(0.2)
+    for job in jobs.values():
+        job.cancel()
+    assert not overlaps
+    assert jobs["skip"].skipped >= 2
+    assert jobs["queue"].skipped == 0 and jobs["queue"].runs >= 3
+    assert jobs["cancel"].runs >= 2
+
+
+def test_stuck_job_does_not_take_more_workers():
+    scheduler = Scheduler(workers=2)
+    release = threading.Event()
+    stuck = scheduler.add(Job(func=release.wait, interval=0.02, delay=0, timeout=0.01))
+    ran = []
+    other = scheduler.every(0.02, lambda: ran.append(1), offset=0)
+    time.sleep(0.2)
+    assert stuck.problem() == "stuck" and stuck.skipped >= 3
+    assert len(ran) >= 5
+    release.set()
+    assert wait_until(lambda: stuck.problem() != "stuck")
+    stuck.cancel()
+    other.cancel()
+
+
+def test_inline_job_runs_when_workers_are_taken():
+    scheduler = Scheduler(workers=1)
+    release = threading.Event()
+    blocker = scheduler.every(0.01, release.wait, offset=0)
+    ran = threading.Event()
+    scheduler.add(Job(func=ran.set, delay=0.05, inline=True))
+    assert ran.wait(1)
+    release.set()
+    blocker.cancel()
+
+
+def test_timed_out_run_is_asked_to_stop():
+    scheduler = Scheduler(workers=2)
+    stopped = threading.Event()
+
+    def hang():
+        try:
+            sleep(1)
+        except JobCancelled:
+            stopped.set()
+            raise
+
+    job = scheduler.add(Job(func=hang, delay=0, timeout=0.05))
+    assert stopped.wait(1)
+    assert job.timed_out == 1 and job.problem() == "timed out"
+
+
+def test_stalled_job_is_a_problem():
+    job = Job(func=lambda: None, interval=1)
+    job._added_at = job.next_run_at = 0.0
+    assert job.problem(now=2.0) is None
+    assert job.problem(now=4.0) == "stalled"
+
+
+def test_watchdog_reports_failed_jobs(client, recorder):
+    device = hq.Device(
+        name="Meter", client=client, scheduler=Scheduler(), job_watchdog=True
+    )
+
+    def broken():
+        raise RuntimeError("sensor gone")
+
+    job = device.add_job(broken, interval=60, delay=0)
+    device.connect()
+    assert wait_until(lambda: job.failed == 1)
+    assert device.check_jobs() == {"broken": "failed"}
+    sensor = device.entities[device.JOB_PROBLEM]
+    assert recorder.payloads(sensor.topics.state)[-1] == "ON"
+    assert device.job_stats()["broken"]["failed"] == 1
+    device.disconnect()
+
+
+def test_adaptive_poll_backs_off_and_resets_on_change():
+    scheduler = Scheduler(workers=2)
+    value = [0]
+    change = threading.Event()
+    intervals = []
+
+    def poll():
+        intervals.append(job.interval)
+        if change.is_set():
+            change.clear()
+            value[0] += 1  # Seen by comparing snapshots around the run.
+
+    job = scheduler.add(
+        Job(
+            func=poll,
+            adaptive=AdaptiveInterval(min_interval=0.01, max_interval=0.04),
+            snapshot=lambda: value[0],
+        )
+    )
+    assert wait_until(lambda: job.interval == 0.04)
+    assert intervals[:2] == [0.01, 0.02]
+    change.set()
+    assert wait_until(lambda: job.interval == 0.01)
+    assert wait_until(lambda: job.interval == 0.04)
+    job.cancel()
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power")
+
+
+def test_device_poll_follows_published_states(client):
+    device = Meter(name="Meter", client=client, scheduler=Scheduler())
+    power = [1]
+
+    @device.on_poll(min_seconds=0.01, max_seconds=0.04, offset=0)
+    def poll():
+        device.power.publish_state(power[0])
+
+    (job,) = device._scheduled_jobs
+    device.connect()
+    assert wait_until(lambda: job.interval == 0.04)
+    power[0] = 2  # A new state resets the interval, repeating one let it grow.
+    assert wait_until(lambda: job.interval == 0.01)
+    assert wait_until(lambda: job.interval == 0.04)
+    device.disconnect()
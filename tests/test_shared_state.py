@@ -0,0 +1,107 @@
+import json
+
+import hassquitto as hq
+from hassquitto.results import NOT_SENT
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power", only_changes=True)
+    energy = hq.Sensor(name="Energy")
+
+
+def connected(client, **kwargs) -> Meter:
+    device = Meter(name="Shared Meter", client=client, shared_state=True, **kwargs)
+    device.connect()
+    return device
+
+
+def test_publish_states_sends_one_document(client, recorder):
+    device = connected(client)
+    device.publish_states({device.power: 10, "Energy": 2.5})
+    payloads = recorder.payloads(device.shared_state_topic())
+    assert json.loads(payloads[-1]) == {"power": 10, "energy": 2.5}
+
+
+def test_publish_states_keeps_entity_bookkeeping(client):
+    device = connected(client)
+    device.publish_states({device.power: 10, device.energy: 1})
+    assert device.power._last_state == 10
+    assert device.power.published_count == 1
+    assert device.energy.published_count == 1
+
+
+def test_publish_states_suppresses_unchanged(client, recorder):
+    device = connected(client)
+    device.publish_states({device.power: 10})
+    recorder.messages.clear()
+    result = device.publish_states({device.power: 10})
+    assert result is NOT_SENT
+    assert device.power.suppressed_count == 1
+    assert recorder.messages == []
+    device.publish_states({device.power: 10}, force=True)
+    assert device.power.published_count == 2
+
+
+def test_publish_states_only_sends_changed_entities(client, recorder):
+    device = connected(client)
+    device.publish_states({device.power: 10, device.energy: 1})
+    device.publish_states({device.power: 10, device.energy: 2})
+    assert device.power.published_count == 1
+    assert device.energy.published_count == 2
+    payloads = recorder.payloads(device.shared_state_topic())
+    assert json.loads(payloads[-1]) == {"power": 10, "energy": 2}
+
+
+def test_publish_states_coalesces_rate_limited_entities(client):
+    device = connected(client)
+    device.power.max_rate = 0.001
+    device.publish_states({device.power: 1})
+    device.publish_states({device.power: 2})
+    device.publish_states({device.power: 3})
+    assert device.power.published_count == 1
+    assert device.power.coalesced_count == 1
+    assert device.power._pending[0] == 3
+
+
+def test_entity_publish_state_updates_shared_document(client, recorder):
+    device = connected(client)
+    device.energy.publish_state(4)
+    device.power.publish_state(5)
+    payloads = recorder.payloads(device.shared_state_topic())
+    assert json.loads(payloads[-1]) == {"energy": 4, "power": 5}
+    assert device.energy.published_count == 1
+
+
+def test_birth_republishes_last_states(client, recorder):
+    device = connected(client)
+    device.publish_states({device.power: 7})
+    recorder.messages.clear()
+    client.publish("homeassistant/status", "online")
+    device._rediscovery.join()
+    assert '{"restored":true' not in "".join(
+        recorder.payloads(device.power.topics.attributes)
+    )
+    payloads = recorder.payloads(device.shared_state_topic())
+    assert json.loads(payloads[-1])["power"] == 7
+
+
+def test_birth_republishes_one_document(client, recorder):
+    device = connected(client)
+    device.publish_states({device.power: 7, device.energy: 3})
+    recorder.messages.clear()
+    client.publish("homeassistant/status", "online")
+    device._rediscovery.join()
+    payloads = recorder.payloads(device.shared_state_topic())
+    assert [json.loads(payload) for payload in payloads] == [{"power": 7, "energy": 3}]
+
+
+def test_stored_states_are_restored_in_one_document(broker, recorder, tmp_path):
+    path = str(tmp_path / "states.db")
+    device = connected(hq.LoopbackTransport(broker=broker), state_store_path=path)
+    device.publish_states({device.power: 7, device.energy: 3})
+    device.disconnect()
+    recorder.messages.clear()
+    restarted = connected(hq.LoopbackTransport(broker=broker), state_store_path=path)
+    payloads = recorder.payloads(restarted.shared_state_topic())
+    assert [json.loads(payload) for payload in payloads] == [{"power": 7, "energy": 3}]
+    assert restarted.power._restored_at is not None
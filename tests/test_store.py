@@ -0,0 +1,64 @@
+import asyncio
+
+import hassquitto as hq
+from hassquitto.store import StateStore
+
+
+class Meter(hq.Device):
+    power = hq.Sensor(name="Power")
+
+
+class AsyncMeter(hq.AsyncDevice):
+    power = hq.Sensor(name="Power")
+
+
+def test_recorded_states_survive_close(tmp_path):
+    path = str(tmp_path / "states.db")
+    store = StateStore(path=path, flush_interval=60)
+    store.record("power", "10")
+    store.close()
+    assert store._connection is None
+    assert StateStore(path=path).get("power")[0] == "10"
+
+
+def test_store_reopens_after_close(tmp_path):
+    path = str(tmp_path / "states.db")
+    store = StateStore(path=path)
+    store.close()
+    store.record("power", "11")
+    store.close()
+    assert StateStore(path=path).get("power")[0] == "11"
+
+
+def test_device_restores_stored_state(broker, recorder, tmp_path):
+    path = str(tmp_path / "states.db")
+    device = Meter(
+        name="Meter", client=hq.LoopbackTransport(broker=broker), state_store_path=path
+    )
+    device.connect()
+    device.power.publish_state(12)
+    device.disconnect()
+    assert device.state_store._connection is None
+
+    restarted = Meter(
+        name="Meter", client=hq.LoopbackTransport(broker=broker), state_store_path=path
+    )
+    recorder.messages.clear()
+    restarted.connect()
+    assert recorder.payloads(restarted.power.topics.state) == ["12"]
+    assert '"restored":true' in recorder.payloads(restarted.power.topics.attributes)[0]
+
+
+def test_async_disconnect_closes_store(client, tmp_path):
+    path = str(tmp_path / "states.db")
+
+    async def main():
+        device = AsyncMeter(name="Meter", client=client, state_store_path=path)
+        await device.connect()
+        await device.power.publish_state(13)
+        await device.disconnect()
+        return device
+
+    device = asyncio.run(main())
+    assert device.state_store._connection is None
+    assert StateStore(path=path).get(device.power.object_id)[0] == 13
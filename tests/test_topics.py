@@ -0,0 +1,29 @@
+from hassquitto.topics import Topics
+
+
+def test_topics_are_built_from_base():
+    topics = Topics("homeassistant/sensor/meter_power")
+    assert topics.state == "homeassistant/sensor/meter_power/state"
+    assert topics.command == "homeassistant/sensor/meter_power/command"
+    assert topics.attributes == "homeassistant/sensor/meter_power/attributes"
+
+
+def test_overrides_are_kept():
+    topics = Topics("base", state="elsewhere/state")
+    assert topics.state == "elsewhere/state"
+    assert topics.config == "base/config"
+
+
+def test_equality_does_not_build_topics():
+    first, second = Topics("base"), Topics("base")
+    assert first == second
+    assert first._state == "" and second._state == ""
+
+
+def test_equality_treats_unset_topics_as_defaults():
+    built = Topics("base")
+    assert built.state  # Built on access.
+    assert built == Topics("base")
+    assert Topics("base", state="base/state") == Topics("base")
+    assert Topics("base", state="other/state") != Topics("base")
+    assert Topics("other") != Topics("base")